@@ -0,0 +1,80 @@
+"""Benchmark CategoryMapper against the np.unique remapping it replaced."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import timeit
+from typing import Callable, List
+
+import click
+import numpy as np
+
+from landshark.basetypes import CategoricalType
+from landshark.category import CategoryMapper
+
+MISSING = -1
+
+
+def _unique_mapper(mappings: List[np.ndarray]
+                   ) -> Callable[[np.ndarray], np.ndarray]:
+    """Remap with the previous np.unique approach.
+
+    This is the old CategoryMapper, sorting the mapping and the batch
+    together for each column.
+    """
+    def f(x: np.ndarray) -> np.ndarray:
+        x_new = np.empty_like(x)
+        for i, cats in enumerate(mappings):
+            x_i = x[..., i].ravel()
+            mask = x_i != MISSING
+            flat = np.hstack((cats, x_i[mask].flatten()))
+            _, remap = np.unique(flat, return_inverse=True)
+            x_i_new = np.full_like(x_i, MISSING)
+            x_i_new[mask] = remap[len(cats):]
+            x_new[..., i] = x_i_new.reshape(x[..., i].shape)
+        return x_new
+    return f
+
+
+@click.command()
+@click.option("--npoints", type=click.IntRange(1, None), default=10 ** 6,
+              help="Pixels in each batch")
+@click.option("--nbands", type=click.IntRange(1, None), default=4,
+              help="Categorical bands")
+@click.option("--repeats", type=click.IntRange(1, None), default=5,
+              help="Timing repeats (the best is reported)")
+def cli(npoints: int, nbands: int, repeats: int) -> None:
+    """Time remapping one batch with categories of various layouts."""
+    rnd = np.random.RandomState(0)
+    layouts = [
+        ("20 classes", np.arange(20)),
+        ("10^5 ids, compact", np.arange(10 ** 5)),
+        ("10^5 ids, sparse", np.unique(rnd.randint(0, 2 ** 30, 10 ** 5))),
+    ]
+    for name, cats in layouts:
+        mappings = [cats] * nbands
+        x = rnd.choice(cats, size=(npoints, nbands)).astype(CategoricalType)
+        x[rnd.rand(npoints, nbands) < 0.05] = MISSING
+        new = CategoryMapper(mappings, MISSING)
+        old = _unique_mapper(mappings)
+        assert np.array_equal(new(x), old(x))
+        t_old = min(timeit.repeat(lambda: old(x), number=1, repeat=repeats))
+        t_new = min(timeit.repeat(lambda: new(x), number=1, repeat=repeats))
+        click.echo("{:<20} np.unique {:7.1f}ms  lookup {:7.1f}ms  "
+                   "({:.1f}x)".format(name, t_old * 1000, t_new * 1000,
+                                      t_old / t_new))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,71 @@
+"""Benchmark category discovery on a high-cardinality categorical layer."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from multiprocessing import cpu_count
+
+import click
+import numpy as np
+
+from landshark.basetypes import CategoricalArraySource, CategoricalType
+from landshark.category import get_maps
+
+
+class _SyntheticLayer(CategoricalArraySource):
+    """An image of small square polygons with IDs drawn from ncats."""
+
+    def __init__(self, height: int, width: int, ncats: int, block: int
+                 ) -> None:
+        super().__init__()
+        rnd = np.random.RandomState(0)
+        shape = (-(-height // block), -(-width // block))
+        ids = rnd.randint(ncats, size=shape).astype(CategoricalType)
+        blocks = ids.repeat(block, axis=0).repeat(block, axis=1)
+        self._data = blocks[:height, :width, np.newaxis]
+        self._data[rnd.rand(height, width) < 0.01] = -1
+        self._shape = self._data.shape
+        self._native = 1
+        self._missing = CategoricalType(-1)
+        self._columns = ["geology"]
+
+    def _arrayslice(self, start: int, stop: int) -> np.ndarray:
+        return self._data[start:stop]
+
+
+@click.command()
+@click.option("--nworkers", type=click.IntRange(0, None), default=cpu_count(),
+              help="Number of worker processes")
+@click.option("--size", type=click.IntRange(1, None), default=4000,
+              help="Height and width of the layer in pixels")
+@click.option("--ncats", type=click.IntRange(1, None), default=10 ** 6,
+              help="Number of distinct categories")
+@click.option("--block", type=click.IntRange(1, None), default=2,
+              help="Width in pixels of the square polygons")
+@click.option("--batchrows", type=click.IntRange(1, None), default=100,
+              help="Rows in each batch")
+def cli(nworkers: int, size: int, ncats: int, block: int, batchrows: int
+        ) -> None:
+    """Time get_maps on a synthetic layer with many categories."""
+    src = _SyntheticLayer(size, size, ncats, block)
+    start = time.perf_counter()
+    info = get_maps(src, batchrows, n_workers=nworkers)
+    elapsed = time.perf_counter() - start
+    click.echo("{}x{} layer, {} categories found, {} workers: {:.2f}s"
+               .format(size, size, len(info.mappings[0]), nworkers, elapsed))
+
+
+if __name__ == "__main__":
+    cli()
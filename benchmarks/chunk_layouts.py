@@ -0,0 +1,155 @@
+"""Benchmark patch extraction from features stored in different chunks."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+import click
+import numpy as np
+import tables
+
+from landshark.basetypes import (ContinuousArraySource, ContinuousType,
+                                 IndexType)
+from landshark.dataprocess import _process_query, _process_training
+from landshark.featurewrite import write_continuous, write_feature_metadata
+from landshark.hread import H5Features
+from landshark.image import ImageSpec
+from landshark.metadata import ContinuousFeatureSet, FeatureSet
+from landshark.util import patch_chunkshape
+
+
+class _SyntheticLayer(ContinuousArraySource):
+    """Smooth random bands with a little noise, like most covariates."""
+
+    def __init__(self, size: int, nbands: int) -> None:
+        super().__init__()
+        rnd = np.random.RandomState(0)
+        coarse = rnd.randn(size // 32 + 1, size // 32 + 1, nbands)
+        smooth = coarse.repeat(32, axis=0).repeat(32, axis=1)[:size, :size]
+        noise = 0.01 * rnd.randn(size, size, nbands)
+        self._data = (smooth + noise).astype(ContinuousType)
+        self._shape = self._data.shape
+        self._native = 1
+        self._dtype = ContinuousType
+        self._missing = None
+        self._columns = ["band{}".format(i) for i in range(nbands)]
+
+    def _arrayslice(self, start: int, stop: int) -> np.ndarray:
+        return self._data[start:stop]
+
+
+def _write_features(path: str,
+                    source: _SyntheticLayer,
+                    chunkshape: Optional[Tuple[int, int]]
+                    ) -> ImageSpec:
+    height, width = source.shape[0:2]
+    spec = ImageSpec(np.arange(width + 1, dtype=np.float64),
+                     np.arange(height + 1, dtype=np.float64), {})
+    with tables.open_file(path, "w") as hfile:
+        write_continuous(source, hfile, 0, 64, chunkshape=chunkshape)
+        meta = ContinuousFeatureSet(source.columns, source.missing, None)
+        write_feature_metadata(FeatureSet(meta, None, spec, height * width,
+                                          0), hfile)
+    return spec
+
+
+def _training(features: H5Features,
+              spec: ImageSpec,
+              halfwidth: int,
+              npoints: int,
+              batchsize: int
+              ) -> float:
+    rnd = np.random.RandomState(1)
+    coords = np.column_stack((rnd.randint(spec.width, size=npoints),
+                              rnd.randint(spec.height, size=npoints))) + 0.5
+    targets = np.zeros((npoints, 1), dtype=ContinuousType)
+    start = time.perf_counter()
+    for i in range(0, npoints, batchsize):
+        _process_training(coords[i:i + batchsize], targets[i:i + batchsize],
+                          features, spec, halfwidth)
+    return npoints / (time.perf_counter() - start)
+
+
+def _query(features: H5Features,
+           spec: ImageSpec,
+           halfwidth: int,
+           nrows: int,
+           batchsize: int
+           ) -> float:
+    y, x = np.divmod(np.arange(nrows * spec.width, dtype=IndexType),
+                     spec.width)
+    indices = np.column_stack((x, y + spec.height // 3))
+    start = time.perf_counter()
+    for i in range(0, len(indices), batchsize):
+        _process_query(indices[i:i + batchsize], features, spec, halfwidth)
+    return len(indices) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--size", type=click.IntRange(1, None), default=2048,
+              help="Height and width of the features in pixels")
+@click.option("--nbands", type=click.IntRange(1, None), default=8,
+              help="Number of continuous bands")
+@click.option("--halfwidth", type=click.IntRange(0, None), multiple=True,
+              default=[0, 1, 3, 7], help="Patch halfwidths to extract")
+@click.option("--tile", type=click.IntRange(1, None), multiple=True,
+              default=[8, 16, 32, 64, 128],
+              help="Sides of the square chunks to try")
+@click.option("--npoints", type=click.IntRange(1, None), default=5000,
+              help="Number of random training points")
+@click.option("--nrows", type=click.IntRange(1, None), default=32,
+              help="Number of image rows to query")
+@click.option("--batchsize", type=click.IntRange(1, None), default=1000,
+              help="Points in each batch")
+def cli(size: int,
+        nbands: int,
+        halfwidth: List[int],
+        tile: List[int],
+        npoints: int,
+        nrows: int,
+        batchsize: int
+        ) -> None:
+    """Time training and query extraction for each chunk layout."""
+    source = _SyntheticLayer(size, nbands)
+    layouts: List[Tuple[str, Optional[Tuple[int, int]]]] = \
+        [("auto", None), ("rows", (1, size))]
+    layouts += [("{0}x{0}".format(t), (t, t)) for t in tile]
+    for h in halfwidth:
+        click.echo("Default chunks for halfwidth {}: {}x{}".format(
+            h, *patch_chunkshape(h, source.shape, source.dtype)))
+    click.echo("{:>10} {:>10} {:>9} {:>9} {:>14} {:>14}".format(
+        "layout", "chunks", "MB", "halfwidth", "train pts/s", "query pts/s"))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, chunkshape in layouts:
+            path = os.path.join(directory, name + ".hdf5")
+            spec = _write_features(path, source, chunkshape)
+            features = H5Features(path)
+            assert features.continuous is not None
+            chunks = "{}x{}".format(*features.continuous.chunkshape)
+            mbytes = os.path.getsize(path) * 1e-6
+            for h in halfwidth:
+                train = _training(features, spec, h, npoints, batchsize)
+                query = _query(features, spec, h, nrows, batchsize)
+                click.echo("{:>10} {:>10} {:>9.1f} {:>9} {:>14.0f} "
+                           "{:>14.0f}".format(name, chunks, mbytes, h,
+                                              train, query))
+            del features
+
+
+if __name__ == "__main__":
+    cli()
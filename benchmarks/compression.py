@@ -0,0 +1,128 @@
+"""Benchmark the compression codecs on the arrays of a features file."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+import click
+import numpy as np
+import tables
+
+from landshark.featurewrite import (CODECS, SHUFFLES, Compression,
+                                    compression_filters, feature_parts)
+
+
+def _load(path: str, name: str, rows: Optional[int]
+          ) -> Optional[Tuple[np.ndarray, Tuple[int, ...]]]:
+    """Read (some rows of) the first part of an array and its chunks."""
+    with tables.open_file(path, "r") as hfile:
+        if not hasattr(hfile.root, name):
+            return None
+        array = feature_parts(hfile, name)[0]
+        return array[:rows], array.chunkshape
+
+
+def _time_codec(data: np.ndarray,
+                chunkshape: Tuple[int, ...],
+                compression: Compression,
+                path: str,
+                nwindows: int,
+                side: int
+                ) -> Tuple[float, float, float, float]:
+    """Write and read an array, returning the ratio and throughputs."""
+    atom = tables.Atom.from_dtype(np.dtype((data.dtype, data.shape[2:])))
+    start = time.perf_counter()
+    with tables.open_file(path, "w") as hfile:
+        array = hfile.create_carray(hfile.root, "data", atom=atom,
+                                    shape=data.shape[0:2],
+                                    filters=compression_filters(compression),
+                                    chunkshape=chunkshape)
+        array[:] = data
+    write_time = time.perf_counter() - start
+    ratio = data.nbytes / os.path.getsize(path)
+
+    start = time.perf_counter()
+    with tables.open_file(path, "r") as hfile:
+        hfile.root.data[:]
+    read_time = time.perf_counter() - start
+
+    rnd = np.random.RandomState(0)
+    ys = rnd.randint(max(1, data.shape[0] - side), size=nwindows)
+    xs = rnd.randint(max(1, data.shape[1] - side), size=nwindows)
+    start = time.perf_counter()
+    with tables.open_file(path, "r") as hfile:
+        for y, x in zip(ys, xs):
+            hfile.root.data[y:y + side, x:x + side]
+    window_time = time.perf_counter() - start
+    os.remove(path)
+    mbytes = data.nbytes * 1e-6
+    return (ratio, mbytes / write_time, mbytes / read_time,
+            nwindows / window_time)
+
+
+@click.command()
+@click.argument("features", type=click.Path(exists=True, dir_okay=False))
+@click.option("--rows", type=click.IntRange(1, None), default=None,
+              help="Use only the first rows of each array (default: all)")
+@click.option("--codec", type=click.Choice(CODECS[1:]), multiple=True,
+              default=["blosc:lz4", "blosc:lz4hc", "blosc:zstd",
+                       "blosc:zlib"], help="Codecs to try")
+@click.option("--complevel", type=click.IntRange(1, 9), multiple=True,
+              default=[1, 5, 9], help="Compression levels to try")
+@click.option("--shuffle", type=click.Choice(SHUFFLES), multiple=True,
+              default=["byte", "bit"], help="Shuffles to try")
+@click.option("--nwindows", type=click.IntRange(1, None), default=2000,
+              help="Number of random square windows to read")
+@click.option("--side", type=click.IntRange(1, None), default=15,
+              help="Side of the random windows (a patch width)")
+def cli(features: str,
+        rows: Optional[int],
+        codec: List[str],
+        complevel: List[int],
+        shuffle: List[str],
+        nwindows: int,
+        side: int
+        ) -> None:
+    """Time writing and reading the arrays of FEATURES with each codec."""
+    configs = [Compression("none", 0, "none")]
+    configs += [Compression(c, l, s) for c, l, s in
+                itertools.product(codec, complevel, shuffle)
+                if s != "bit" or c.startswith("blosc:")]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "codec.hdf5")
+        for name in ["continuous_data", "categorical_data"]:
+            loaded = _load(features, name, rows)
+            if loaded is None:
+                continue
+            data, chunkshape = loaded
+            click.echo("{}: {:.1f}MB in {} chunks".format(
+                name, data.nbytes * 1e-6,
+                "x".join(str(c) for c in chunkshape)))
+            click.echo("{:>12} {:>5} {:>7} {:>7} {:>10} {:>10} {:>10}".format(
+                "codec", "level", "shuffle", "ratio", "write MB/s",
+                "read MB/s", "windows/s"))
+            for compression in configs:
+                result = _time_codec(data, chunkshape, compression, path,
+                                     nwindows, side)
+                click.echo("{:>12} {:>5} {:>7} {:>7.2f} {:>10.0f} {:>10.0f} "
+                           "{:>10.0f}".format(*compression, *result))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,79 @@
+"""Benchmark the end-of-stage latency of many short task lists."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from multiprocessing import cpu_count
+from typing import List
+
+import click
+import numpy as np
+
+from landshark.basetypes import IdReader, IdWorker
+from landshark.multiproc import WorkerPool, task_list
+
+
+def _summary(label: str, seconds: List[float]) -> str:
+    t = np.array(seconds) * 1000
+    return "{:>8}: mean {:7.1f}ms, median {:7.1f}ms, max {:7.1f}ms".format(
+        label, t.mean(), np.median(t), t.max())
+
+
+@click.command()
+@click.option("--nworkers", type=click.IntRange(1, None), default=cpu_count(),
+              help="Number of worker processes")
+@click.option("--ncalls", type=click.IntRange(1, None), default=50,
+              help="Number of task_list calls (eg small query strips)")
+@click.option("--ntasks", type=click.IntRange(1, None), default=4,
+              help="Number of (trivial) tasks per call")
+@click.option("--pool/--no-pool", default=False,
+              help="Share one WorkerPool between all the calls")
+def cli(nworkers: int, ncalls: int, ntasks: int, pool: bool) -> None:
+    """Time many short task_list calls.
+
+    The work itself is trivial, so the timings are dominated by starting
+    the workers, the round trips of the tasks, and shutting the workers
+    down (sending the sentinels and joining them), each timed separately.
+    Without --pool every call starts and closes its own pool.
+    """
+    starts, runs, closes = [], [], []
+    shared = WorkerPool(nworkers) if pool else None
+    for _ in range(ncalls):
+        start = time.perf_counter()
+        call_pool = shared if shared else WorkerPool(nworkers)
+        started = time.perf_counter()
+        for _ in task_list(range(ntasks), IdReader(), IdWorker(), nworkers,
+                           pool=call_pool):
+            pass
+        finished = time.perf_counter()
+        if shared is None:
+            call_pool.close()
+            closes.append(time.perf_counter() - finished)
+            starts.append(started - start)
+        runs.append(finished - started)
+    if shared is not None:
+        finished = time.perf_counter()
+        shared.close()
+        closes.append(time.perf_counter() - finished)
+    click.echo("{} calls x {} tasks on {} workers{}".format(
+        ncalls, ntasks, nworkers, ", one shared pool" if pool else ""))
+    if starts:
+        click.echo(_summary("start", starts))
+    click.echo(_summary("tasks", runs))
+    click.echo(_summary("close", closes))
+
+
+if __name__ == "__main__":
+    cli()
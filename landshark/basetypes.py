@@ -49,6 +49,13 @@ class FixedSlice(NamedTuple):
     stop: int
 
 
+class FixedWindow(NamedTuple):
+    """A block of rows and columns of an image."""
+
+    rows: FixedSlice
+    cols: FixedSlice
+
+
 T = TypeVar("T")
 
 
@@ -66,6 +73,10 @@ class Reader:
         """Read data at index and return."""
         raise NotImplementedError
 
+    def release(self) -> None:
+        """Free any caches while the (still open) reader is not in use."""
+        pass
+
 
 class Worker:
     """Generic worker (callable)."""
@@ -166,18 +177,21 @@ class ArraySource(Sized, Reader):
         """
         return self._columns
 
-    def __call__(self, s: FixedSlice) -> np.ndarray:
+    def __call__(self, s: Union[FixedSlice, FixedWindow]) -> np.ndarray:
         """
         Get a slice from the array along the first dimension.
 
         Parameters
         ----------
-        s : FixedSlice
-            The section of the array to get
+        s : Union[FixedSlice, FixedWindow]
+            The section of the array to get: either whole rows, or a
+            window of the first two dimensions of an image.
 
         """
         if not hasattr(self, "_open") or not self._open:
             raise RuntimeError("Array access must be within context manager")
+        elif isinstance(s, FixedWindow):
+            return self._arraywindow(s.rows, s.cols)
         else:
             return self._arrayslice(s.start, s.stop)
 
@@ -205,6 +219,10 @@ class ArraySource(Sized, Reader):
         """Perform the array slice. This gets overridden by children."""
         raise NotImplementedError
 
+    def _arraywindow(self, rows: FixedSlice, cols: FixedSlice) -> np.ndarray:
+        """Read a window of an image. Children can avoid the whole rows."""
+        return self._arrayslice(rows.start, rows.stop)[:, cols.start:cols.stop]
+
     def __len__(self) -> int:
         """Return the number of rows (1st dimension)."""
         return self._shape[0]
@@ -15,17 +15,22 @@
 # limitations under the License.
 
 import logging
-from collections import OrderedDict
+from functools import partial
 from typing import List, NamedTuple, Optional, Tuple
 
 import numpy as np
-from tqdm import tqdm
 
 from landshark import iteration
-from landshark.basetypes import CategoricalArraySource, CategoricalType, Worker
+from landshark.basetypes import (CategoricalArraySource, CategoricalType,
+                                 MissingType, Worker)
+from landshark.multiproc import WorkerPool, task_list
 
 log = logging.getLogger(__name__)
 
+# CategoryMapper uses a lookup table for categories spanning at most this
+# many times as many values as there are categories
+LUT_SPARSITY = 4
+
 
 class CategoryInfo(NamedTuple):
     """
@@ -42,6 +47,17 @@ class CategoryInfo(NamedTuple):
     counts: List[np.ndarray]
 
 
+def select_categories(info: CategoryInfo, bands: slice) -> CategoryInfo:
+    """Get the categories of just some of the features."""
+    return CategoryInfo(info.mappings[bands], info.counts[bands])
+
+
+def stack_categories(infos: List[CategoryInfo]) -> CategoryInfo:
+    """Join the categories of different features."""
+    return CategoryInfo([m for i in infos for m in i.mappings],
+                        [c for i in infos for c in i.counts])
+
+
 def _unique_values(x: np.ndarray) -> Tuple[List[np.ndarray], List[int]]:
     """Provide the unique entries and their counts for each column x."""
     x = x.reshape((-1), x.shape[-1])
@@ -51,31 +67,104 @@ def _unique_values(x: np.ndarray) -> Tuple[List[np.ndarray], List[int]]:
 
 
 class _CategoryAccumulator:
-    """Class for accumulating categorical values and their counts."""
+    """
+    Class for accumulating categorical values and their counts.
+
+    The values are kept sorted, so new values are merged in with a binary
+    search rather than one at a time.
+    """
 
     def __init__(self, missing_value: CategoricalType) -> None:
         """Initialise the object."""
-        self.counts: OrderedDict = OrderedDict()
+        self.values = np.zeros(0, dtype=CategoricalType)
+        self.counts = np.zeros(0, dtype=np.int64)
         self.missing = missing_value
 
     def update(self, values: np.ndarray, counts: np.ndarray) -> None:
-        """Add a new set of values from a batch."""
+        """Add a new set of (unique) values from a batch."""
         assert values.ndim == 1
         assert counts.ndim == 1
         assert values.shape == counts.shape
-        assert counts.dtype == int
+        assert np.issubdtype(counts.dtype, np.integer)
         assert np.all(counts >= 0)
-        for v, c in zip(values, counts):
-            if v in self.counts:
-                self.counts[v] += c
-            else:
-                self.counts[v] = c
         # Dont include the missing value
-        if self.missing in self.counts:
-            self.counts.pop(self.missing)
+        if self.missing is not None:
+            keep = values != self.missing
+            values, counts = values[keep], counts[keep]
+        idx = np.searchsorted(self.values, values)
+        found = idx < len(self.values)
+        found[found] = self.values[idx[found]] == values[found]
+        self.counts[idx[found]] += counts[found]
+        new = ~found
+        if np.any(new):
+            self.values = np.insert(self.values, idx[new], values[new])
+            self.counts = np.insert(self.counts, idx[new], counts[new])
+
+    def merge(self, other: "_CategoryAccumulator") -> None:
+        """Add in the values and counts of another accumulator."""
+        self.update(other.values, other.counts)
+
+
+class CategoryCounter:
+    """
+    Accumulate the categories, and their counts, of each feature.
+
+    Arguments
+    ---------
+    n_features : int
+        The number of categorical features (the last dimension of the data).
+    missing_value : Optional[int]
+        The value marking missing data, which is not counted.
 
+    """
 
-def get_maps(src: CategoricalArraySource, batchrows: int) -> CategoryInfo:
+    def __init__(self,
+                 n_features: int,
+                 missing_value: MissingType
+                 ) -> None:
+        """Initialise the accumulators."""
+        if missing_value is not None and missing_value > 0:
+            raise ValueError("Missing value must be negative")
+        self._accums = [_CategoryAccumulator(missing_value)
+                        for _ in range(n_features)]
+
+    def update(self, x: np.ndarray) -> None:
+        """Count the categories in a batch of data."""
+        unique, counts = _unique_values(x)
+        for a, u, c in zip(self._accums, unique, counts):
+            a.update(u, c)
+
+    def merge(self, other: "CategoryCounter") -> None:
+        """Add in the categories counted by another counter."""
+        for a, b in zip(self._accums, other._accums):
+            a.merge(b)
+
+    @property
+    def info(self) -> CategoryInfo:
+        """Get the sorted categories and counts seen so far."""
+        mappings = [a.values for a in self._accums]
+        counts = [a.counts for a in self._accums]
+        return CategoryInfo(mappings=mappings, counts=counts)
+
+
+class _CategoryWorker(Worker):
+    """Count the categories of a batch of data."""
+
+    def __init__(self, missing: MissingType) -> None:
+        self._missing = missing
+
+    def __call__(self, x: np.ndarray) -> CategoryCounter:
+        counter = CategoryCounter(x.shape[-1], self._missing)
+        counter.update(x)
+        return counter
+
+
+def get_maps(src: CategoricalArraySource,
+             batchrows: int,
+             batchcols: Optional[int] = None,
+             n_workers: int = 0,
+             pool: Optional[WorkerPool] = None
+             ) -> CategoryInfo:
     """
     Extract the unique categorical variables and their counts.
 
@@ -90,6 +179,13 @@ def get_maps(src: CategoricalArraySource, batchrows: int) -> CategoryInfo:
     batchrows : int
         The number of rows to read from src in a single batch. Larger
         values are probably faster but will use more memory.
+    batchcols : Optional[int]
+        If given, read images wider than this in windows of batchrows by
+        batchcols rather than whole rows.
+    n_workers : int
+        The number of workers counting batches, 0 to count in this process.
+    pool : Optional[WorkerPool]
+        An existing pool of workers to use.
 
     Returns
     -------
@@ -97,32 +193,17 @@ def get_maps(src: CategoricalArraySource, batchrows: int) -> CategoryInfo:
         The mappings and counts for each categorical column in the dataset.
 
     """
-    n_rows = src.shape[0]
+    n_points = int(np.prod(src.shape[:-1]))
     n_features = src.shape[-1]
-    missing_value = src.missing
-    accums = [_CategoryAccumulator(missing_value) for _ in range(n_features)]
-
-    if missing_value is not None and missing_value > 0:
-        raise ValueError("Missing value must be negative")
-
-    with tqdm(total=n_rows) as pbar:
-        with src:
-            for s in iteration.batch_slices(batchrows, n_rows):
-                x = src(s)
-                unique, counts = _unique_values(x)
-                for a, u, c in zip(accums, unique, counts):
-                    a.update(u, c)
-                pbar.update(x.shape[0])
-
-    count_dicts = [m.counts for m in accums]
-    unsorted_mappings = [np.array(list(c.keys())) for c in count_dicts]
-    unsorted_counts = [np.array(list(c.values()), dtype=np.int64)
-                       for c in count_dicts]
-    sortings = [np.argsort(m, kind="mergesort") for m in unsorted_mappings]
-    mappings = [m[s] for m, s in zip(unsorted_mappings, sortings)]
-    counts = [c[s] for c, s in zip(unsorted_counts, sortings)]
-    result = CategoryInfo(mappings=mappings, counts=counts)
-    return result
+    counter = CategoryCounter(n_features, src.missing)
+    batches = iteration.image_batches(batchrows, batchcols, src.shape)
+    batch_size = partial(iteration.image_batch_size, src.shape)
+    out_it = task_list(batches, src, _CategoryWorker(src.missing), n_workers,
+                       total=n_points, pool=pool, task_size=batch_size,
+                       ordered=False)
+    for _, batch_counter in out_it:
+        counter.merge(batch_counter)
+    return counter.info
 
 
 class CategoryMapper(Worker):
@@ -149,6 +230,7 @@ class CategoryMapper(Worker):
             is_sorted = np.all(m[:-1] <= m[1:])
             assert is_sorted
         self._mappings = mappings
+        self._lookups = [_CategoryLookup(m) for m in mappings]
         self._missing = missing_value
 
     def __call__(self, x: np.ndarray) -> np.ndarray:
@@ -168,16 +250,62 @@ class CategoryMapper(Worker):
         """
         fill = self._missing if self._missing is not None else 0
         x_new = np.empty_like(x)
-        for i, cats in enumerate(self._mappings):
-            x_i = x[..., i].ravel()
-            mask = x_i != self._missing if self._missing \
-                else np.ones_like(x_i, dtype=bool)
-            x_i_valid = x_i[mask].flatten()
-            flat = np.hstack((cats, x_i_valid))
-            actual_cat, remap = np.unique(flat, return_inverse=True)
-            x_i_new_valid = remap[len(cats):]
+        for i, lookup in enumerate(self._lookups):
+            x_i = x[..., i]
+            if self._missing is None:
+                x_new[..., i] = lookup(x_i)
+                continue
+            valid = x_i != self._missing
             x_i_new = np.full_like(x_i, fill)
-            x_i_new[mask] = x_i_new_valid
-            x_new[..., i] = x_i_new.reshape(x[..., i].shape)
-            assert np.all(actual_cat == cats)
+            x_i_new[valid] = lookup(x_i[valid])
+            x_new[..., i] = x_i_new
         return x_new
+
+
+class _CategoryLookup:
+    """
+    Find the indices of values in a sorted array of categories.
+
+    Categories spanning a compact range of values (at most LUT_SPARSITY
+    times as many values as there are categories) use a dense lookup table
+    indexed by value. Others use a binary search of the categories for the
+    unique values.
+    """
+
+    def __init__(self, categories: np.ndarray) -> None:
+        self._categories = categories
+        self._lut: Optional[np.ndarray] = None
+        self._lo = 0
+        if len(categories) > 0:
+            self._lo = int(categories[0])
+            span = int(categories[-1]) - self._lo + 1
+            if span <= LUT_SPARSITY * len(categories):
+                # The extra entry at the end is for values out of range
+                self._lut = np.full(span + 1, -1, dtype=CategoricalType)
+                self._lut[categories - self._lo] = np.arange(len(categories))
+
+    def __call__(self, values: np.ndarray) -> np.ndarray:
+        """Get the index of each value, which must be a category."""
+        if len(self._categories) == 0:
+            missing = np.unique(values)
+            index: np.ndarray = np.zeros(values.shape, dtype=CategoricalType)
+        elif self._lut is not None:
+            span = len(self._lut) - 1
+            offsets = np.subtract(values, self._lo, dtype=np.int64)
+            # Negative offsets are huge as unsigned, so also out of range
+            offsets[offsets.view(np.uint64) > span] = span
+            index = self._lut[offsets]
+            missing = np.unique(values[index < 0]) \
+                if index.size > 0 and index.min() < 0 else values[:0]
+        else:
+            # Searching for the sorted unique values keeps to cached parts
+            # of the categories, unlike searching for the values themselves
+            unique, inverse = np.unique(values, return_inverse=True)
+            found = np.searchsorted(self._categories, unique)
+            np.minimum(found, len(self._categories) - 1, out=found)
+            missing = unique[self._categories[found] != unique]
+            index = found[inverse].reshape(values.shape)
+        if len(missing) > 0:
+            raise ValueError("Values {} are not among the categories".format(
+                missing))
+        return index
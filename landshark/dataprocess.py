@@ -23,7 +23,7 @@ import tables
 
 from landshark import patch, tfwrite
 from landshark.basetypes import ArraySource, FixedSlice, IdReader, Worker
-from landshark.hread import H5Features
+from landshark.hread import HDF5_LOCK, H5Features
 from landshark.image import (ImageSpec, image_to_world, indices_strip,
                              world_to_image)
 from landshark.iteration import batch_slices
@@ -46,6 +46,9 @@ class ProcessTrainingArgs(NamedTuple):
     directory: str
     batchsize: int
     nworkers: int
+    executor: str = "processes"
+    retries: int = 0
+    affinity: Optional[List[List[int]]] = None
 
 
 class ProcessQueryArgs(NamedTuple):
@@ -60,6 +63,9 @@ class ProcessQueryArgs(NamedTuple):
     batchsize: int
     nworkers: int
     tag: str
+    executor: str = "processes"
+    retries: int = 0
+    affinity: Optional[List[List[int]]] = None
 
 
 def _direct_read(array: tables.CArray,
@@ -168,14 +174,15 @@ def _process_training(coords: np.ndarray,
     npatches = indices_x.shape[0]
     patchwidth = 2 * halfwidth + 1
     con_marray, cat_marray = None, None
-    if feature_source.continuous:
-        con_marray = _direct_read(feature_source.continuous,
-                                  patch_reads, mask_reads,
-                                  npatches, patchwidth)
-    if feature_source.categorical:
-        cat_marray = _direct_read(feature_source.categorical,
-                                  patch_reads, mask_reads,
-                                  npatches, patchwidth)
+    with HDF5_LOCK:
+        if feature_source.continuous:
+            con_marray = _direct_read(feature_source.continuous,
+                                      patch_reads, mask_reads,
+                                      npatches, patchwidth)
+        if feature_source.categorical:
+            cat_marray = _direct_read(feature_source.categorical,
+                                      patch_reads, mask_reads,
+                                      npatches, patchwidth)
     indices = np.vstack((indices_x, indices_y)).T
     output = DataArrays(con_marray, cat_marray, targets, coords, indices)
     return output
@@ -198,15 +205,17 @@ def _process_query(indices: np.ndarray,
     patchwidth = 2 * halfwidth + 1
     con_marray, cat_marray = None, None
     if feature_source.continuous:
-        con_data_cache = _get_rows(patch_data_slices,
-                                   feature_source.continuous)
+        with HDF5_LOCK:
+            con_data_cache = _get_rows(patch_data_slices,
+                                       feature_source.continuous)
         con_marray = _cached_read(con_data_cache,
                                   feature_source.continuous,
                                   patch_reads, mask_reads, npatches,
                                   patchwidth)
     if feature_source.categorical:
-        cat_data_cache = _get_rows(patch_data_slices,
-                                   feature_source.categorical)
+        with HDF5_LOCK:
+            cat_data_cache = _get_rows(patch_data_slices,
+                                       feature_source.categorical)
         cat_marray = _cached_read(cat_data_cache,
                                   feature_source.categorical,
                                   patch_reads, mask_reads, npatches,
@@ -267,8 +276,11 @@ def write_trainingdata(args: ProcessTrainingArgs) -> None:
     n_rows = len(args.target_src)
     worker = _TrainingDataProcessor(args.feature_path, args.image_spec,
                                     args.halfwidth)
-    tasks = list(batch_slices(args.batchsize, n_rows))
-    out_it = task_list(tasks, args.target_src, worker, args.nworkers)
+    tasks = batch_slices(args.batchsize, n_rows)
+    n_tasks = -(-n_rows // args.batchsize)
+    out_it = task_list(tasks, args.target_src, worker, args.nworkers,
+                       total=n_tasks, executor=args.executor,
+                       retries=args.retries, affinity=args.affinity)
     fold_it = args.folds.iterator(args.batchsize)
     tfwrite.training(out_it, n_rows, args.directory, args.testfold, fold_it)
 
@@ -284,6 +296,8 @@ def write_querydata(args: ProcessQueryArgs) -> None:
                                 args.total_strips, args.batchsize)
     worker = _QueryDataProcessor(args.feature_path, args.image_spec,
                                  args.halfwidth)
-    tasks = list(it)
-    out_it = task_list(tasks, reader_src, worker, args.nworkers)
+    n_tasks = -(-n_total // args.batchsize)
+    out_it = task_list(it, reader_src, worker, args.nworkers, total=n_tasks,
+                       executor=args.executor, retries=args.retries,
+                       affinity=args.affinity)
     tfwrite.query(out_it, n_total, args.directory, args.tag)
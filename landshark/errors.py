@@ -65,6 +65,46 @@ class ConCatNMismatch(Error):
             {} and {} points respectively".format(N_con, N_cat)
 
 
+class ImageSpecMismatch(Error):
+    """Images don't match those of an existing features file."""
+
+    def __init__(self, path: str) -> None:
+        """Construct the object."""
+        self.message = "The images do not have the same coordinates and \
+            CRS as the features in {}".format(path)
+        super().__init__(self.message)
+
+
+class BandNameClash(Error):
+    """Appended bands have the same names as existing ones."""
+
+    def __init__(self, labels: List[str]) -> None:
+        """Construct the object."""
+        self.message = "Bands with these names are already in the \
+            features: {}".format(labels)
+        super().__init__(self.message)
+
+
+class MissingValueMismatch(Error):
+    """Appended bands mark missing data differently to existing ones."""
+
+    def __init__(self, name: str, old: Any, new: Any) -> None:
+        """Construct the object."""
+        self.message = "The appended {} have missing value {} but the \
+            existing ones have {}".format(name, new, old)
+        super().__init__(self.message)
+
+
+class UnknownBands(Error):
+    """Bands to remove are not in the features."""
+
+    def __init__(self, labels: List[str]) -> None:
+        """Construct the object."""
+        self.message = "Bands to remove are not in the features: {}".format(
+            labels)
+        super().__init__(self.message)
+
+
 class PredictionShape(Error):
     """Prediction output is not 1D or 2D."""
 
@@ -72,3 +112,13 @@ class PredictionShape(Error):
         """Construct the object."""
         self.message = "Prediction shape for {} is shaped {}. Predictions \
             must be 1D.".format(name, shape)
+
+
+class WorkerCrashed(Error):
+    """A worker process died while running a task."""
+
+    def __init__(self, pid: int, exitcode: int) -> None:
+        """Construct the object."""
+        self.message = "Worker process {} died with exit code {} (a \
+            negative code is the signal that killed it)".format(pid, exitcode)
+        super().__init__(self.message)
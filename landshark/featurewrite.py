@@ -15,28 +15,70 @@
 # limitations under the License.
 
 import logging
-from typing import List, Optional, Tuple, TypeVar
+import math
+from collections import OrderedDict
+from contextlib import ExitStack
+from typing import (Callable, List, NamedTuple, Optional, Tuple, TypeVar,
+                    Union)
 
 import numpy as np
 import tables
 
+from landshark import errors
 from landshark.basetypes import (ArraySource, CategoricalArraySource,
                                  ContinuousArraySource, CoordinateArraySource,
-                                 IdWorker, Worker)
-from landshark.category import CategoryMapper
+                                 FixedSlice, FixedWindow, IdWorker, Worker)
+from landshark.category import CategoryCounter, CategoryInfo, CategoryMapper
 from landshark.image import ImageSpec
-from landshark.iteration import batch_slices, with_slices
+from landshark.iteration import (MAX_GROWTH, AdaptiveSlices, batch_slices,
+                                 image_batches, slice_size, window_size,
+                                 window_slices)
 from landshark.metadata import (CategoricalFeatureSet, CategoricalTarget,
                                 ContinuousFeatureSet, ContinuousTarget,
                                 FeatureSet, Target)
-from landshark.multiproc import task_list
-from landshark.normalise import Normaliser
+from landshark.multiproc import WorkerPool, task_list
+from landshark.normalise import (CLIP_QUANTILE, Normaliser, Scaling,
+                                 StatCounter, counter_scaling)
+from landshark.util import patch_chunkshape
 
 log = logging.getLogger(__name__)
 
 
 T = TypeVar("T")
 
+# Compressors for the HDF5 arrays, "none" storing them uncompressed
+CODECS = ["none", "blosc:lz4", "blosc:lz4hc", "blosc:zstd", "blosc:blosclz",
+          "blosc:zlib", "zlib"]
+
+# Reordering of the bytes (or bits) of each chunk before compressing it
+SHUFFLES = ["none", "byte", "bit"]
+
+
+class Compression(NamedTuple):
+    """
+    The compression of the HDF5 arrays.
+
+    Bit shuffling needs one of the blosc codecs. A level of 0 (or the
+    codec "none") stores the arrays uncompressed.
+    """
+
+    codec: str
+    level: int
+    shuffle: str
+
+
+# Fast to both write and read, at some cost in size
+DEFAULT_COMPRESSION = Compression("blosc:lz4", 1, "byte")
+
+# Nodes holding the metadata of each kind of feature, rewritten on append
+_METADATA_NODES = {
+    "continuous": ["continuous_labels", "continuous_D", "continuous_means",
+                   "continuous_sds"],
+    "categorical": ["categorical_labels", "categorical_D",
+                    "categorical_counts", "categorical_mappings",
+                    "categorical_nvalues"]
+}
+
 
 def write_feature_metadata(meta: FeatureSet, hfile: tables.File) -> None:
     hfile.root._v_attrs.N = len(meta)
@@ -50,14 +92,19 @@ def write_feature_metadata(meta: FeatureSet, hfile: tables.File) -> None:
 
 def read_feature_metadata(path: str) -> FeatureSet:
     with tables.open_file(path, "r") as hfile:
-        N = hfile.root._v_attrs.N
-        halfwidth = hfile.root._v_attrs.halfwidth
-        image_spec = read_imagespec(hfile)
-        continuous, categorical = None, None
-        if hasattr(hfile.root, "continuous_data"):
-            continuous = _read_continuous_metadata(hfile)
-        if hasattr(hfile.root, "categorical_data"):
-            categorical = _read_categorical_metadata(hfile)
+        m = _read_feature_metadata(hfile)
+    return m
+
+
+def _read_feature_metadata(hfile: tables.File) -> FeatureSet:
+    N = hfile.root._v_attrs.N
+    halfwidth = hfile.root._v_attrs.halfwidth
+    image_spec = read_imagespec(hfile)
+    continuous, categorical = None, None
+    if hasattr(hfile.root, "continuous_data"):
+        continuous = _read_continuous_metadata(hfile)
+    if hasattr(hfile.root, "categorical_data"):
+        categorical = _read_categorical_metadata(hfile)
     m = FeatureSet(continuous, categorical, image_spec, N, halfwidth)
     return m
 
@@ -88,6 +135,8 @@ def _write_continuous_metadata(meta: ContinuousFeatureSet,
                                ) -> None:
     hfile.root.continuous_data.attrs.missing = meta.missing_value
     hfile.root.continuous_data.attrs.normalised = meta.normalised
+    hfile.root.continuous_data.attrs.approximate = meta.approximate
+    hfile.root.continuous_data.attrs.scaling = meta.scaling
     labels = [k for k in meta.columns.keys()]
     D = np.array([v.D for v in meta.columns.values()], dtype=int)
     means = [v.mean for v in meta.columns.values()]
@@ -102,6 +151,9 @@ def _write_continuous_metadata(meta: ContinuousFeatureSet,
 def _read_continuous_metadata(hfile: tables.File) -> ContinuousFeatureSet:
     missing_value = hfile.root.continuous_data.attrs.missing
     normalised = hfile.root.continuous_data.attrs.normalised
+    approximate = getattr(hfile.root.continuous_data.attrs, "approximate",
+                          False)
+    scaling = getattr(hfile.root.continuous_data.attrs, "scaling", "standard")
     labels = [k.decode() for k in hfile.root.continuous_labels.read()]
     stats = None
     if normalised:
@@ -109,7 +161,8 @@ def _read_continuous_metadata(hfile: tables.File) -> ContinuousFeatureSet:
             hfile.root.continuous_means.read(),
             hfile.root.continuous_sds.read()
         )
-    meta = ContinuousFeatureSet(labels, missing_value, stats)
+    meta = ContinuousFeatureSet(labels, missing_value, stats, approximate,
+                                scaling)
     return meta
 
 
@@ -204,28 +257,361 @@ def read_imagespec(hfile: tables.File) -> ImageSpec:
     return imspec
 
 
+def compression_filters(compression: Compression) -> tables.Filters:
+    """Get the PyTables filters applying some compression."""
+    if compression.codec == "none" or compression.level == 0:
+        return tables.Filters(complevel=0)
+    return tables.Filters(complevel=compression.level,
+                          complib=compression.codec,
+                          shuffle=compression.shuffle == "byte",
+                          bitshuffle=compression.shuffle == "bit")
+
+
+def read_compression(array: tables.Leaf) -> Compression:
+    """Get the compression recorded for an array."""
+    attrs = array.attrs
+    if not hasattr(attrs, "codec"):
+        return DEFAULT_COMPRESSION
+    return Compression(str(attrs.codec), int(attrs.complevel),
+                       str(attrs.shuffle))
+
+
+def _create_carray(hfile: tables.File,
+                   name: str,
+                   atom: tables.Atom,
+                   shape: Tuple[int, ...],
+                   compression: Compression,
+                   chunkshape: Optional[Tuple[int, int]] = None
+                   ) -> tables.CArray:
+    """Create an array compressed as requested, recording how."""
+    array = hfile.create_carray(hfile.root, name=name, atom=atom,
+                                shape=shape,
+                                filters=compression_filters(compression),
+                                chunkshape=chunkshape)
+    array.attrs.codec = compression.codec
+    array.attrs.complevel = compression.level
+    array.attrs.shuffle = compression.shuffle
+    return array
+
+
+def feature_parts(hfile: tables.File, name: str) -> List[tables.CArray]:
+    """
+    Get a feature array and the companions holding its appended bands.
+
+    Bands appended to "<name>" are kept in companion arrays "<name>_1",
+    "<name>_2" and so on, so the existing data is never rewritten.
+    """
+    parts = [hfile.get_node("/" + name)]
+    while hasattr(hfile.root, "{}_{}".format(name, len(parts))):
+        parts.append(hfile.get_node("/{}_{}".format(name, len(parts))))
+    return parts
+
+
+def band_selection(hfile: tables.File, name: str) -> Optional[np.ndarray]:
+    """
+    Get the bands (of all the parts together) kept for a feature array.
+
+    Removed bands are just left out of this selection. It is None if every
+    band is kept.
+    """
+    node = name + "_bands"
+    return hfile.get_node("/" + node).read() \
+        if hasattr(hfile.root, node) else None
+
+
+def append_features(path: str,
+                    new_path: Optional[str],
+                    remove: List[str]
+                    ) -> None:
+    """
+    Add the features of one file to those of another, and remove some.
+
+    The arrays of the new file are copied in as companions of the
+    existing arrays (whose chunks are untouched), removed bands are left
+    out of the band selection, and the metadata is rewritten to match.
+
+    Parameters
+    ----------
+    path : str
+        The features file to change.
+    new_path : Optional[str]
+        A features file of the same image to append, if any.
+    remove : List[str]
+        The labels of the bands to remove.
+
+    """
+    with ExitStack() as stack:
+        hfile = stack.enter_context(tables.open_file(path, "a"))
+        new_file = stack.enter_context(tables.open_file(new_path, "r")) \
+            if new_path else None
+        meta = _read_feature_metadata(hfile)
+        new_meta = _read_feature_metadata(new_file) if new_file else None
+        con_old = meta.continuous
+        con_new = new_meta.continuous if new_meta else None
+        cat_old = meta.categorical
+        cat_new = new_meta.categorical if new_meta else None
+        labels = [label for m in (con_old, con_new, cat_old, cat_new) if m
+                  for label in m.columns]
+        unknown = set(remove) - set(labels)
+        if unknown:
+            raise errors.UnknownBands(sorted(unknown))
+        clash = {label for label in labels if labels.count(label) > 1}
+        if clash:
+            raise errors.BandNameClash(sorted(clash))
+        _check_missing("continuous bands", con_old, con_new)
+        _check_missing("categorical bands", cat_old, cat_new)
+
+        if con_old or con_new:
+            columns = _append_array(hfile, new_file, "continuous_data",
+                                    con_old, con_new, remove)
+            meta.continuous = _continuous_set(columns, hfile, con_old,
+                                              con_new)
+        if cat_old or cat_new:
+            columns = _append_array(hfile, new_file, "categorical_data",
+                                    cat_old, cat_new, remove)
+            meta.categorical = _categorical_set(columns, hfile)
+        _rewrite_metadata(hfile, meta)
+
+
+FeatureSets = Union[ContinuousFeatureSet, CategoricalFeatureSet]
+
+
+def _check_missing(name: str,
+                   old: Optional[FeatureSets],
+                   new: Optional[FeatureSets]
+                   ) -> None:
+    """Check appended bands have the missing value of the existing ones.
+
+    All the parts of an array share one missing value, so it cannot
+    change. Either may be None if its bands have no missing data.
+    """
+    if old is None or new is None or old.missing_value is None or \
+            new.missing_value is None:
+        return
+    if not np.array_equal(old.missing_value, new.missing_value,
+                          equal_nan=True):
+        raise errors.MissingValueMismatch(name, old.missing_value,
+                                          new.missing_value)
+
+
+def _append_array(hfile: tables.File,
+                  new_file: Optional[tables.File],
+                  name: str,
+                  old: Optional[FeatureSets],
+                  new: Optional[FeatureSets],
+                  remove: List[str]
+                  ) -> OrderedDict:
+    """Copy in the new array and select the bands kept, giving their info."""
+    columns: OrderedDict = OrderedDict()
+    bands = np.zeros(0, dtype=np.int64)
+    if old is not None:
+        columns.update(old.columns)
+        selected = band_selection(hfile, name)
+        bands = np.arange(len(old)) if selected is None else selected
+    if new is not None:
+        assert new_file is not None
+        if old is None:
+            part, start = name, 0
+        else:
+            parts = feature_parts(hfile, name)
+            part = "{}_{}".format(name, len(parts))
+            start = sum(p.atom.shape[0] for p in parts)
+        log.info("Appending {} bands to {} as {}".format(len(new), name,
+                                                         part))
+        new_file.get_node("/" + name).copy(hfile.root, part,
+                                           chunkshape="keep")
+        columns.update(new.columns)
+        bands = np.concatenate((bands, start + np.arange(len(new))))
+    missing = [m.missing_value for m in (old, new)
+               if m is not None and m.missing_value is not None]
+
+    keep = np.array([label not in remove for label in columns], dtype=bool)
+    for label in np.array(list(columns), dtype=object)[~keep]:
+        log.info("Removing band {} from {}".format(label, name))
+        del columns[label]
+    bands = bands[keep]
+    parts = feature_parts(hfile, name)
+    if hasattr(hfile.root, name + "_bands"):
+        hfile.remove_node("/" + name + "_bands")
+    if len(columns) == 0:
+        for p in parts:
+            p.remove()
+    else:
+        # _check_missing has made sure the parts agree
+        parts[0].attrs.missing = missing[0] if missing else None
+        if not np.array_equal(bands, np.arange(sum(p.atom.shape[0]
+                                                   for p in parts))):
+            hfile.create_array(hfile.root, name=name + "_bands", obj=bands)
+    return columns
+
+
+def _continuous_set(columns: OrderedDict,
+                    hfile: tables.File,
+                    old: Optional[ContinuousFeatureSet],
+                    new: Optional[ContinuousFeatureSet]
+                    ) -> Optional[ContinuousFeatureSet]:
+    if len(columns) == 0:
+        return None
+    first = old if old is not None else new
+    assert first is not None
+    values = list(columns.values())
+    stats = None
+    if first.normalised:
+        stats = (np.array([np.ravel(v.mean)[0] for v in values]),
+                 np.array([np.ravel(v.sd)[0] for v in values]))
+    approximate = any(m.approximate for m in (old, new) if m is not None)
+    return ContinuousFeatureSet(list(columns),
+                                hfile.root.continuous_data.attrs.missing,
+                                stats, approximate, first.scaling)
+
+
+def _categorical_set(columns: OrderedDict,
+                     hfile: tables.File
+                     ) -> Optional[CategoricalFeatureSet]:
+    if len(columns) == 0:
+        return None
+    values = list(columns.values())
+    return CategoricalFeatureSet(list(columns),
+                                 hfile.root.categorical_data.attrs.missing,
+                                 np.array([v.nvalues for v in values]),
+                                 [v.mapping for v in values],
+                                 [v.counts for v in values])
+
+
+def _rewrite_metadata(hfile: tables.File, meta: FeatureSet) -> None:
+    for nodes in _METADATA_NODES.values():
+        for node in nodes:
+            if hasattr(hfile.root, node):
+                hfile.remove_node("/" + node)
+    if meta.continuous:
+        _write_continuous_metadata(meta.continuous, hfile)
+    if meta.categorical:
+        _write_categorical_metadata(meta.categorical, hfile)
+
+
 def write_continuous(source: ContinuousArraySource,
                      hfile: tables.File,
                      n_workers: int,
                      batchrows: Optional[int] = None,
-                     stats: Optional[Tuple[np.ndarray, np.ndarray]] = None
+                     stats: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+                     pool: Optional[WorkerPool] = None,
+                     batchcols: Optional[int] = None,
+                     clip: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+                     chunkshape: Optional[Tuple[int, int]] = None,
+                     compression: Compression = DEFAULT_COMPRESSION
                      ) -> None:
-    transform = Normaliser(*stats, source.missing) if stats else IdWorker()
+    transform = Normaliser(stats[0], stats[1], source.missing, clip) \
+        if stats else IdWorker()
     n_workers = n_workers if stats else 0
     _write_source(source, hfile, tables.Float32Atom(source.shape[-1]),
-                  "continuous_data", transform, n_workers, batchrows)
+                  "continuous_data", transform, n_workers, batchrows, pool,
+                  batchcols, chunkshape=chunkshape,
+                  compression=compression)
 
 
 def write_categorical(source: CategoricalArraySource,
                       hfile: tables.File,
                       n_workers: int,
                       batchrows: Optional[int] = None,
-                      maps: Optional[np.ndarray] = None
+                      maps: Optional[np.ndarray] = None,
+                      pool: Optional[WorkerPool] = None,
+                      batchcols: Optional[int] = None,
+                      chunkshape: Optional[Tuple[int, int]] = None,
+                      compression: Compression = DEFAULT_COMPRESSION
                       ) -> None:
     transform = CategoryMapper(maps, source.missing) if maps else IdWorker()
     n_workers = n_workers if maps else 0
     _write_source(source, hfile, tables.Int32Atom(source.shape[-1]),
-                  "categorical_data", transform, n_workers, batchrows)
+                  "categorical_data", transform, n_workers, batchrows, pool,
+                  batchcols, chunkshape=chunkshape,
+                  compression=compression)
+
+
+def write_continuous_stats(source: ContinuousArraySource,
+                           hfile: tables.File,
+                           n_workers: int,
+                           batchrows: Optional[int] = None,
+                           pool: Optional[WorkerPool] = None,
+                           batchcols: Optional[int] = None,
+                           scaling: str = "standard",
+                           clip_quantile: float = CLIP_QUANTILE,
+                           chunkshape: Optional[Tuple[int, int]] = None,
+                           compression: Compression = DEFAULT_COMPRESSION
+                           ) -> Scaling:
+    """
+    Write the raw continuous data, computing its statistics on the way.
+
+    Together with `normalise_continuous` this normalises the data while
+    decoding the source only once.
+
+    Returns
+    -------
+    scaling : Scaling
+        The scaling of each feature, as from `normalise.get_scaling`.
+
+    """
+    counter = StatCounter(source.shape[-1], scaling != "standard")
+
+    def _update(x: np.ndarray) -> None:
+        counter.update(x.reshape((-1, x.shape[-1])), source.missing)
+
+    _write_source(source, hfile, tables.Float32Atom(source.shape[-1]),
+                  "continuous_data", IdWorker(), n_workers, batchrows, pool,
+                  batchcols, _update, chunkshape=chunkshape,
+                  compression=compression)
+    return counter_scaling(counter, scaling, clip_quantile)
+
+
+def normalise_continuous(hfile: tables.File,
+                         stats: Tuple[np.ndarray, np.ndarray],
+                         batchrows: int,
+                         batchcols: Optional[int] = None,
+                         clip: Optional[Tuple[np.ndarray, np.ndarray]] = None
+                         ) -> None:
+    """Normalise the continuous data already in the file, in place."""
+    array = hfile.root.continuous_data
+    _rewrite(array, Normaliser(stats[0], stats[1], array.attrs.missing, clip),
+             batchrows, batchcols)
+
+
+def write_categorical_maps(source: CategoricalArraySource,
+                           hfile: tables.File,
+                           n_workers: int,
+                           batchrows: Optional[int] = None,
+                           pool: Optional[WorkerPool] = None,
+                           batchcols: Optional[int] = None,
+                           chunkshape: Optional[Tuple[int, int]] = None,
+                           compression: Compression = DEFAULT_COMPRESSION
+                           ) -> CategoryInfo:
+    """
+    Write the raw categorical data, finding its categories on the way.
+
+    Together with `map_categorical` this remaps the data while decoding
+    the source only once.
+
+    Returns
+    -------
+    info : CategoryInfo
+        The categories of each feature and their counts.
+
+    """
+    counter = CategoryCounter(source.shape[-1], source.missing)
+    _write_source(source, hfile, tables.Int32Atom(source.shape[-1]),
+                  "categorical_data", IdWorker(), n_workers, batchrows, pool,
+                  batchcols, counter.update, chunkshape=chunkshape,
+                  compression=compression)
+    return counter.info
+
+
+def map_categorical(hfile: tables.File,
+                    maps: List[np.ndarray],
+                    batchrows: int,
+                    batchcols: Optional[int] = None
+                    ) -> None:
+    """Remap the categorical data already in the file, in place."""
+    array = hfile.root.categorical_data
+    _rewrite(array, CategoryMapper(maps, array.attrs.missing), batchrows,
+             batchcols)
 
 
 def _write_source(src: ArraySource,
@@ -234,38 +620,123 @@ def _write_source(src: ArraySource,
                   name: str,
                   transform: Worker,
                   n_workers: int,
-                  batchrows: Optional[int] = None
+                  batchrows: Optional[int] = None,
+                  pool: Optional[WorkerPool] = None,
+                  batchcols: Optional[int] = None,
+                  observe: Optional[Callable[[np.ndarray], None]] = None,
+                  chunkshape: Optional[Tuple[int, int]] = None,
+                  compression: Compression = DEFAULT_COMPRESSION
                   ) -> None:
     front_shape = src.shape[0:-1]
-    filters = tables.Filters(complevel=1, complib="blosc:lz4")
-    array = hfile.create_carray(hfile.root, name=name,
-                                atom=atom, shape=front_shape, filters=filters)
-    array.attrs.missing = src.missing
     batchrows = batchrows if batchrows else src.native
-    log.info("Writing {} to HDF5 in {}-row batches".format(name, batchrows))
-    _write(src, array, batchrows, n_workers, transform)
+    if batchcols is not None and batchcols >= front_shape[1]:
+        batchcols = None
+    # Slices on the source's block boundaries (where batchrows is), so
+    # no block is decoded twice
+    align = math.gcd(batchrows, src.native) if src.native else 1
+    if chunkshape is None and batchcols is not None:
+        # Square tiles rather than one-row chunks, so each window is
+        # written as a few whole chunks
+        chunkshape = patch_chunkshape(0, src.shape, src.dtype)
+    if chunkshape is not None:
+        # Batches of whole chunks, so no chunk is written more than once,
+        # and of whole blocks too if that fits in the budget
+        chunkshape = (min(chunkshape[0], front_shape[0]),
+                      min(chunkshape[1], front_shape[1]))
+        both = align * chunkshape[0] // math.gcd(align, chunkshape[0])
+        align = both if both <= batchrows else chunkshape[0]
+        batchrows = _whole_units(batchrows, align)
+        if batchcols is not None:
+            batchcols = _whole_units(batchcols, chunkshape[1])
+    array = _create_carray(hfile, name, atom, front_shape, compression,
+                           chunkshape)
+    array.attrs.missing = src.missing
+    log.info("Storing {} in {} chunks".format(
+        name, "x".join(str(c) for c in array.chunkshape)))
+    if batchcols is not None:
+        log.info("Writing {} to HDF5 in {}x{} windows".format(
+            name, batchrows, batchcols))
+    else:
+        log.info("Writing {} to HDF5 in {}-row batches".format(
+            name, batchrows))
+    _write(src, array, batchrows, n_workers, transform, pool, batchcols,
+           observe, align)
+
+
+def _whole_units(n: int, unit: int) -> int:
+    """Round n down to whole units, but to at least one unit."""
+    return max(unit, n // unit * unit)
+
+
+def _write(source: ArraySource,
+           array: tables.CArray,
+           batchrows: int,
+           n_workers: int,
+           transform: Worker,
+           pool: Optional[WorkerPool] = None,
+           batchcols: Optional[int] = None,
+           observe: Optional[Callable[[np.ndarray], None]] = None,
+           align: int = 1
+           ) -> None:
+    if batchcols is not None:
+        # Windows down each strip of columns in turn
+        n_rows, n_cols = source.shape[0:2]
+        tasks = window_slices(batchrows, batchcols, n_rows, n_cols)
+        out_it = task_list(tasks, source, transform, n_workers,
+                           total=n_rows * n_cols, pool=pool,
+                           task_size=window_size, ordered=False)
+    else:
+        n_rows = len(source)
+        # batchrows is what fits in memory, so start below it and let
+        # fast tasks grow up to it
+        start = max(align, batchrows // MAX_GROWTH // align * align)
+        slices = AdaptiveSlices(start, n_rows, n_workers, align=align,
+                                max_size=batchrows)
+        out_it = task_list(slices, source, transform, n_workers,
+                           total=n_rows, pool=pool, feedback=slices.update,
+                           task_size=slice_size, ordered=False)
+    for s, d in out_it:
+        array[_region(s)] = d
+        if observe is not None:
+            observe(d)
+    array.flush()
 
 
-def _write(source: ArraySource, array: tables.CArray,
-           batchrows: int, n_workers: int, transform: Worker) -> None:
-    n_rows = len(source)
-    slices = list(batch_slices(batchrows, n_rows))
-    out_it = task_list(slices, source, transform, n_workers)
-    for s, d in with_slices(out_it):
-        array[s.start:s.stop] = d
+def _rewrite(array: tables.CArray,
+             transform: Worker,
+             batchrows: int,
+             batchcols: Optional[int] = None
+             ) -> None:
+    """Transform an array already written to the file, batch by batch."""
+    shape = array.shape + array.atom.shape
+    # Batches of whole chunks, so no chunk is rewritten more than once
+    batchrows = _whole_units(batchrows, array.chunkshape[0])
+    if batchcols is not None:
+        batchcols = _whole_units(batchcols, array.chunkshape[1])
+    for s in image_batches(batchrows, batchcols, shape):
+        region = _region(s)
+        array[region] = transform(array[region])
     array.flush()
 
 
+def _region(s: Union[FixedSlice, FixedWindow]) -> Tuple[slice, ...]:
+    """Index the part of an array covered by a slice or window."""
+    if isinstance(s, FixedWindow):
+        return (slice(s.rows.start, s.rows.stop),
+                slice(s.cols.start, s.cols.stop))
+    return (slice(s.start, s.stop),)
+
+
 def write_coordinates(array_src: CoordinateArraySource,
                       h5file: tables.File,
-                      batchsize: int
+                      batchsize: int,
+                      compression: Compression = DEFAULT_COMPRESSION
                       ) -> None:
     with array_src:
         shape = array_src.shape[0:1]
         atom = tables.Float64Atom(shape=(array_src.shape[1],))
-        filters = tables.Filters(complevel=1, complib="blosc:lz4")
-        array = h5file.create_carray(h5file.root, name="coordinates",
-                                     atom=atom, shape=shape, filters=filters)
+        array = _create_carray(h5file, "coordinates", atom, shape,
+                               compression)
         _make_str_vlarray(h5file, "coordinates_columns", array_src.columns)
         array.attrs.missing = array_src.missing
         for s in batch_slices(batchsize, array_src.shape[0]):
@@ -299,4 +770,4 @@ def _make_str_vlarray(h5file: tables.File,
     vlarray = h5file.create_vlarray(h5file.root, name=name,
                                     atom=tables.VLStringAtom())
     for a in attribute:
-        vlarray.append(a)
+        vlarray.append(a.encode())
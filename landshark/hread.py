@@ -14,15 +14,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from threading import RLock
 from types import TracebackType
-from typing import Tuple, Union
+from typing import Any, List, Optional, Tuple, Union
 
 import numpy as np
 import tables
 
 from landshark.basetypes import (ArraySource, CategoricalArraySource,
                                  ContinuousArraySource)
-from landshark.featurewrite import read_feature_metadata, read_target_metadata
+from landshark.featurewrite import (band_selection, feature_parts,
+                                    read_feature_metadata,
+                                    read_target_metadata)
+
+# HDF5 is not thread safe (even on separate file handles), so threads
+# sharing a process must hold this lock for all access to the files
+HDF5_LOCK = RLock()
 
 
 class H5ArraySource(ArraySource):
@@ -44,10 +51,11 @@ class H5ArraySource(ArraySource):
             self._dtype = carray.atom.dtype.base
 
     def __enter__(self) -> None:
-        self._hfile = tables.open_file(self._path, "r")
-        self._carray = self._hfile.get_node("/" + self._array_name)
-        if hasattr(self._hfile.root, "coordinates"):
-            self._coords = self._hfile.root.coordinates
+        with HDF5_LOCK:
+            self._hfile = tables.open_file(self._path, "r")
+            self._carray = self._hfile.get_node("/" + self._array_name)
+            if hasattr(self._hfile.root, "coordinates"):
+                self._coords = self._hfile.root.coordinates
         super().__enter__()
 
     def __exit__(self,
@@ -55,7 +63,8 @@ class H5ArraySource(ArraySource):
                  ex_val: Exception,
                  ex_tb: TracebackType
                  ) -> None:
-        self._hfile.close()
+        with HDF5_LOCK:
+            self._hfile.close()
         del(self._carray)
         if hasattr(self, "_coords"):
             del(self._coords)
@@ -69,12 +78,13 @@ class H5ArraySource(ArraySource):
 
         # TODO: Note this is bad because I'm changing the return type.
 
-        data = self._carray[start:end]
-        if hasattr(self, "_coords"):
-            coords = self._coords[start:end]
-            return data, coords
-        else:
-            return data
+        with HDF5_LOCK:
+            data = self._carray[start:end]
+            if hasattr(self, "_coords"):
+                coords = self._coords[start:end]
+                return data, coords
+            else:
+                return data
 
 
 class ContinuousH5ArraySource(H5ArraySource, ContinuousArraySource):
@@ -87,31 +97,83 @@ class CategoricalH5ArraySource(H5ArraySource, CategoricalArraySource):
     _array_name = "categorical_data"
 
 
+class BandStack:
+    """
+    A feature array with appended bands, read as one array.
+
+    Reads the rows of each part (see `featurewrite.feature_parts`) and
+    joins their bands, keeping just the selected ones. Indexing, `atom`,
+    `shape` and `len` behave like those of a single `tables.CArray`.
+    """
+
+    def __init__(self,
+                 parts: List[tables.CArray],
+                 bands: Optional[np.ndarray]
+                 ) -> None:
+        self._parts = parts
+        self._bands = bands
+        nbands = sum(p.atom.shape[0] for p in parts) if bands is None \
+            else len(bands)
+        dtype = parts[0].atom.dtype.base
+        self.atom = tables.Atom.from_dtype(np.dtype((dtype, (nbands,))))
+        self.shape = parts[0].shape
+        self.missing = parts[0].attrs.missing
+
+    def __len__(self) -> int:
+        return len(self._parts[0])
+
+    def __getitem__(self, key: Any) -> np.ndarray:
+        data = np.concatenate([p[key] for p in self._parts], axis=-1)
+        return data if self._bands is None else data[..., self._bands]
+
+
+def feature_array(hfile: tables.File,
+                  name: str
+                  ) -> Union[tables.CArray, BandStack]:
+    """Get a feature array, joined with any bands appended to it."""
+    parts = feature_parts(hfile, name)
+    bands = band_selection(hfile, name)
+    if len(parts) == 1 and bands is None:
+        return parts[0]
+    return BandStack(parts, bands)
+
+
 class H5Features:
-    """Note unlike the array classes this isn't picklable."""
+    """Note unlike the array classes this isn't picklable.
+
+    Reads of the continuous and categorical arrays must hold HDF5_LOCK if
+    other threads may be using HDF5.
+    """
 
     def __init__(self, h5file: str) -> None:
 
         self.continuous, self.categorical, self.coordinates = None, None, None
-        self.metadata = read_feature_metadata(h5file)
-        self._hfile = tables.open_file(h5file, "r")
-        if hasattr(self._hfile.root, "continuous_data"):
-            self.continuous = self._hfile.root.continuous_data
-            assert self.metadata.continuous is not None
-            self.continuous.missing = self.metadata.continuous.missing_value
-        if hasattr(self._hfile.root, "categorical_data"):
-            self.categorical = self._hfile.root.categorical_data
-            assert self.metadata.categorical is not None
-            self.categorical.missing = self.metadata.categorical.missing_value
-        if self.continuous:
-            self._n = len(self.continuous)
-        if self.categorical:
-            self._n = len(self.categorical)
-        if self.continuous and self.categorical:
-            assert len(self.continuous) == len(self.categorical)
+        # Opening the arrays and taking their lengths all touch PyTables
+        with HDF5_LOCK:
+            self.metadata = read_feature_metadata(h5file)
+            self._hfile = tables.open_file(h5file, "r")
+            if hasattr(self._hfile.root, "continuous_data"):
+                self.continuous = feature_array(self._hfile,
+                                                "continuous_data")
+                assert self.metadata.continuous is not None
+                self.continuous.missing = \
+                    self.metadata.continuous.missing_value
+            if hasattr(self._hfile.root, "categorical_data"):
+                self.categorical = feature_array(self._hfile,
+                                                 "categorical_data")
+                assert self.metadata.categorical is not None
+                self.categorical.missing = \
+                    self.metadata.categorical.missing_value
+            if self.continuous:
+                self._n = len(self.continuous)
+            if self.categorical:
+                self._n = len(self.categorical)
+            if self.continuous and self.categorical:
+                assert len(self.continuous) == len(self.categorical)
 
     def __len__(self) -> int:
         return self._n
 
     def __del__(self) -> None:
-        self._hfile.close()
+        with HDF5_LOCK:
+            self._hfile.close()
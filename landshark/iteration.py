@@ -15,14 +15,20 @@
 # limitations under the License.
 
 import itertools
-from typing import Iterator, List, Tuple, TypeVar
+from typing import Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
 
 import numpy as np
 
-from landshark.basetypes import FixedSlice
+from landshark.basetypes import FixedSlice, FixedWindow
 
 T = TypeVar("T")
 
+# Adaptive slices grow until a task takes about this long
+TARGET_TASK_SECONDS = 0.5
+
+# Adaptive slices never grow beyond this multiple of the requested size
+MAX_GROWTH = 4
+
 
 def batch(it: Iterator[T], batchsize: int) -> Iterator[List[T]]:
     """Group iterator into batches."""
@@ -44,6 +50,54 @@ def batch_slices(batchsize: int, total_size: int) -> Iterator[FixedSlice]:
         yield FixedSlice(start, stop)
 
 
+def window_slices(batchrows: int,
+                  batchcols: int,
+                  n_rows: int,
+                  n_cols: int
+                  ) -> Iterator[FixedWindow]:
+    """
+    Cover an image in windows of at most batchrows by batchcols.
+
+    The windows go down each strip of columns in turn, so consecutive
+    windows share the blocks of tiled images.
+    """
+    for cols in batch_slices(batchcols, n_cols):
+        for rows in batch_slices(batchrows, n_rows):
+            yield FixedWindow(rows, cols)
+
+
+def image_batches(batchrows: int,
+                  batchcols: Optional[int],
+                  shape: Tuple[int, ...]
+                  ) -> Iterator[Union[FixedSlice, FixedWindow]]:
+    """
+    Cover an array in batches of whole rows or, if given, windows.
+
+    Windows are only used for images (height, width, bands) wider than
+    batchcols.
+    """
+    if batchcols is not None and len(shape) > 2 and batchcols < shape[1]:
+        return window_slices(batchrows, batchcols, shape[0], shape[1])
+    return batch_slices(batchrows, shape[0])
+
+
+def sample_batches(batches: Iterable[T], fraction: float, seed: int = 0
+                   ) -> List[T]:
+    """
+    Pick a reproducible, stratified random subset of batches.
+
+    The batches are split into (at least 2) runs of about 1 / fraction
+    consecutive batches, and one batch is picked at random from each run,
+    so the sample is spread over the whole image.
+    """
+    items = list(batches)
+    n = min(len(items), max(2, int(round(len(items) * fraction))))
+    edges = np.linspace(0, len(items), n + 1).astype(int)
+    rnd = np.random.RandomState(seed)
+    return [items[rnd.randint(lo, hi)]
+            for lo, hi in zip(edges[:-1], edges[1:])]
+
+
 def with_slices(it: Iterator[np.ndarray]
                 ) -> Iterator[Tuple[FixedSlice, np.ndarray]]:
     """Add slice into vstacked array to each sub array in `it`."""
@@ -52,3 +106,105 @@ def with_slices(it: Iterator[np.ndarray]
         end_idx = start_idx + d.shape[0]
         yield FixedSlice(start_idx, end_idx), d
         start_idx = end_idx
+
+
+class AdaptiveSlices:
+    """
+    Slices of range indices whose size adapts to the measured throughput.
+
+    The slices start at `batchsize`. If tasks finish faster than
+    `target_seconds` (eg cheap rows full of nodata, or tiny batches where
+    per-task overhead dominates), the slices grow towards that target,
+    up to `max_growth` times `batchsize` but never beyond `max_size`
+    (eg the rows that fit in the memory budget). Near the end the slices
+    shrink, so the remaining work is shared by all the workers rather
+    than left to one straggler. Slices are always contiguous and in
+    order, so the concatenated output is unchanged, and (bar the last) a
+    multiple of `align` in size, so they can be kept on the source's
+    block boundaries.
+
+    Pass `update` as the `feedback` argument of `multiproc.task_list`.
+
+    Parameters
+    ----------
+    batchsize : int
+        The requested (starting) slice size.
+    total_size : int
+        The total number of indices to cover.
+    n_workers : int
+        The number of workers sharing the slices. With 0 the tail is not
+        split up.
+    target_seconds : float
+        The task duration to grow towards.
+    max_growth : int
+        The largest slice as a multiple of batchsize.
+    align : int
+        The unit that slice sizes are rounded to, which should divide
+        batchsize.
+    max_size : Optional[int]
+        The largest slice, whatever the growth.
+
+    """
+
+    def __init__(self,
+                 batchsize: int,
+                 total_size: int,
+                 n_workers: int,
+                 target_seconds: float = TARGET_TASK_SECONDS,
+                 max_growth: int = MAX_GROWTH,
+                 align: int = 1,
+                 max_size: Optional[int] = None
+                 ) -> None:
+        self._batchsize = batchsize if max_size is None \
+            else min(batchsize, max_size)
+        self._align = align
+        self._total_size = total_size
+        self._n_workers = n_workers
+        self._target_seconds = target_seconds
+        self._max_size = batchsize * max_growth if max_size is None \
+            else min(batchsize * max_growth, max_size)
+        self._min_size = max(1, batchsize // max_growth)
+        self._rate: Optional[float] = None
+
+    def update(self, s: FixedSlice, seconds: float) -> None:
+        """Record that slice s took the given number of seconds."""
+        rate = (s.stop - s.start) / max(seconds, 1e-6)
+        self._rate = rate if self._rate is None \
+            else 0.5 * (self._rate + rate)
+
+    def _size(self, remaining: int) -> int:
+        size = self._batchsize
+        if self._rate is not None:
+            size = int(np.clip(self._rate * self._target_seconds,
+                               self._batchsize, self._max_size))
+        if self._n_workers > 0:
+            tail = -(-remaining // (2 * self._n_workers))
+            size = min(size, max(tail, self._min_size))
+        return max(self._align, size // self._align * self._align)
+
+    def __iter__(self) -> Iterator[FixedSlice]:
+        start = 0
+        while start < self._total_size:
+            stop = min(start + self._size(self._total_size - start),
+                       self._total_size)
+            yield FixedSlice(start, stop)
+            start = stop
+
+
+def slice_size(s: FixedSlice) -> int:
+    """Get the number of indices in a slice."""
+    return s.stop - s.start
+
+
+def window_size(w: FixedWindow) -> int:
+    """Get the number of pixels in a window."""
+    return slice_size(w.rows) * slice_size(w.cols)
+
+
+def image_batch_size(shape: Tuple[int, ...],
+                     s: Union[FixedSlice, FixedWindow]
+                     ) -> int:
+    """Get the number of points in a batch from `image_batches`."""
+    if isinstance(s, FixedWindow):
+        return window_size(s)
+    return slice_size(s) * int(np.prod(shape[1:-1]))
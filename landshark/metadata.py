@@ -64,8 +64,14 @@ Feature = Union[CategoricalFeature, ContinuousFeature]
 
 class ContinuousFeatureSet:
 
+    # Metadata pickled before these existed had exact standard statistics
+    approximate = False
+    scaling = "standard"
+
     def __init__(self, labels: List[str], missing: ContinuousType,
-                 stats: Optional[Tuple[np.ndarray, np.ndarray]]) -> None:
+                 stats: Optional[Tuple[np.ndarray, np.ndarray]],
+                 approximate: bool = False,
+                 scaling: str = "standard") -> None:
 
         D = len(labels)
         if stats is None:
@@ -75,6 +81,8 @@ class ContinuousFeatureSet:
         else:
             self.normalised = True
             means, sds = stats
+        self.approximate = approximate
+        self.scaling = scaling
 
         self._missing = missing
         # hard-code that each feature has 1 band for now
@@ -100,7 +108,7 @@ class CategoricalFeatureSet:
 
     def __init__(self, labels: List[str], missing: CategoricalType,
                  nvalues: np.ndarray, mappings: List[np.ndarray],
-                 counts: np.ndarray) -> None:
+                 counts: List[np.ndarray]) -> None:
         self._missing = missing
         # hard-code that each feature has 1 band for now
         self._columns = OrderedDict([
@@ -17,121 +17,846 @@
 # Note there's a problem with the mypy annotations for multiprocessing
 # so some types must be ignored or set to Any in this file
 
+import atexit
+import copy
 import logging
+import os
+import pickle
 import queue
-from multiprocessing import Pipe, Process, Queue
-from typing import Any, Dict, Iterator, List
+import sys
+import time
+import traceback
+from collections import deque
+from contextlib import ExitStack
+from itertools import count, islice
+from multiprocessing import Pipe, Process, Queue, connection
+from threading import Thread
+from types import TracebackType
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Sized, Tuple)
 
+import numpy as np
 from tqdm import tqdm
 
 from landshark.basetypes import Reader, Worker
+from landshark.errors import WorkerCrashed
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # python < 3.8, results always go through the queue
+    resource_tracker, shared_memory = None, None  # type: ignore
+
+try:
+    from mpi4py import MPI
+except ImportError:  # only needed for the mpi executor
+    MPI = None  # type: ignore
 
 log = logging.getLogger(__name__)
 
+# Task timing callback, and progress units per task
+Feedback = Callable[[Any, float], None]
+TaskSize = Callable[[Any], int]
+
 # Do not make result queue size 0 if you care about memory
-# Values larger than 1 probably dont help anyway
+# Values larger than 1 probably dont help anyway. Worker processes each
+# send results down their own pipe instead, which blocks similarly
 RESULT_QUEUE_SIZE = 1
 
-# We're assuming the actual request objects are small here
+# We're assuming the actual request objects are small here. The number
+# of requests in each worker's queue is bounded by the in-flight window
 REQ_QUEUE_SIZE = 0
 
+# Default number of tasks submitted but not yet yielded, per worker
+INFLIGHT_PER_WORKER = 2
+
+# Available WorkerPool backends
+EXECUTORS = ["processes", "threads", "mpi"]
+
+# Message tags for the mpi backend
+_MPI_TASK_TAG = 1
+_MPI_RESULT_TAG = 2
+
+# Job ids and reader keys, unique within this (parent) process
+_job_ids = count()
+_reader_keys = count()
+
+# Results at least this big are passed back through shared memory,
+# with only a small descriptor going through the result queue
+SHM_MIN_BYTES = 2 ** 20
+
+
+class _SharedArray(NamedTuple):
+    """Descriptor of an array that has been copied into shared memory."""
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+class _SharedBytes(NamedTuple):
+    """Descriptor of a list of byte strings packed into shared memory."""
+
+    data: _SharedArray
+    offsets: np.ndarray
+
+
+def _block_name(pid: int, job_id: int, task_id: int) -> str:
+    """Name the shared memory block holding the result of a task."""
+    return "landshark_{}_{}_{}".format(pid, job_id, task_id)
+
+
+def _new_block(nbytes: int, name: Optional[str]) -> Any:
+    shm: Any = shared_memory.SharedMemory(name=name, create=True,
+                                          size=nbytes)
+    # The parent process owns (and unlinks) the block from here on. It
+    # knows the name, so it can unlink the block if this worker dies
+    # before handing it over
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _unlink_block(name: str) -> None:
+    """Unlink a shared memory block if it exists."""
+    try:
+        shm: Any = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _share(x: Any, name: Optional[str] = None) -> Any:
+    """Replace a large result with a shared memory descriptor."""
+    if shared_memory is None:
+        return x
+    if type(x) is np.ndarray and x.dtype != object \
+            and x.nbytes >= SHM_MIN_BYTES:
+        shm = _new_block(x.nbytes, name)
+        out = np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)
+        out[...] = x
+        del out
+        shm.close()
+        return _SharedArray(shm.name, x.shape, x.dtype.str)
+    if isinstance(x, list) and len(x) > 0 \
+            and all(isinstance(b, bytes) for b in x):
+        offsets = np.cumsum([0] + [len(b) for b in x])
+        nbytes = int(offsets[-1])
+        if nbytes < SHM_MIN_BYTES:
+            return x
+        shm = _new_block(nbytes, name)
+        for b, start, stop in zip(x, offsets[:-1], offsets[1:]):
+            shm.buf[start:stop] = b
+        shm.close()
+        data = _SharedArray(shm.name, (nbytes,), np.dtype(np.uint8).str)
+        return _SharedBytes(data, offsets)
+    return x
+
+
+def _unshare(x: Any) -> Any:
+    """Recover a result from its shared memory descriptor (if it has one)."""
+    if not isinstance(x, (_SharedArray, _SharedBytes)):
+        return x
+    desc = x.data if isinstance(x, _SharedBytes) else x
+    shm: Any = shared_memory.SharedMemory(name=desc.name)
+    result: Any = None
+    try:
+        if isinstance(x, _SharedBytes):
+            result = [bytes(shm.buf[start:stop])
+                      for start, stop in zip(x.offsets[:-1], x.offsets[1:])]
+        else:
+            src = np.ndarray(x.shape, dtype=np.dtype(x.dtype), buffer=shm.buf)
+            result = src.copy()
+            del src
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
+
+
+class _Job(NamedTuple):
+    """A reader/worker pair that a pool's tasks are run with."""
+
+    job_id: int
+    reader_key: int
+    reader: Reader
+    worker: Worker
+
+
+class _Failure(NamedTuple):
+    """Sent in place of the result of a task that raised (or was lost)."""
+
+    error: BaseException
+    tb: str
+
+
+class _RemoteTraceback(Exception):
+    """Carries the formatted traceback of an exception from a worker."""
+
+    def __init__(self, tb: str) -> None:
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self) -> str:
+        return self.tb
+
+
+def _failure(pickled: bool) -> _Failure:
+    """Describe the exception being handled so it can be sent back."""
+    error = sys.exc_info()[1]
+    assert error is not None
+    if pickled:
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(repr(error))
+    return _Failure(error, traceback.format_exc())
+
+
+def _raise_failure(failure: _Failure) -> None:
+    if failure.tb:
+        raise failure.error from _RemoteTraceback(failure.tb)
+    raise failure.error
+
+
+def _run_tasks(in_queue: Any,
+               out_queue: Any,
+               job_queue: Any,
+               threaded: bool,
+               share: bool
+               ) -> None:
+    """Worker loop shared by all the backends.
+
+    Threads (threaded) copy the jobs they are sent. Processes on the same
+    machine (share) return large results through shared memory. Any
+    exception raised by a reader or worker is sent back in place of the
+    result, and the loop carries on with the next task.
+    """
+    job: Optional[_Job] = None
+    readers: Dict[int, Reader] = {}
+    with ExitStack() as stack:
+        # Block until there is a task, or the shutdown sentinel (None)
+        for job_id, task_id, req in iter(in_queue.get, None):
+            if job is None or job.job_id != job_id:
+                job = _next_job(job, job_id, job_queue, readers, threaded)
+            start = time.perf_counter()
+            result: Any
+            try:
+                if job.reader_key not in readers:
+                    reader = copy.deepcopy(job.reader) if threaded \
+                        else job.reader
+                    stack.enter_context(reader)  # type: ignore
+                    readers[job.reader_key] = reader
+                data: Any = readers[job.reader_key](req)
+                out_data = job.worker(data)
+                result = _share(out_data, _block_name(
+                    os.getpid(), job_id, task_id)) if share else out_data
+            except Exception:
+                result = _failure(pickled=not threaded)
+            seconds = time.perf_counter() - start
+            out_queue.put((task_id, seconds, result))
+
+
+def _next_job(job: Optional[_Job],
+              job_id: int,
+              job_queue: Any,
+              readers: Dict[int, Reader],
+              threaded: bool
+              ) -> _Job:
+    """Get the job with job_id, releasing the previous job's reader."""
+    previous = job
+    while job is None or job.job_id != job_id:
+        job = job_queue.get()
+        if threaded:  # threads get private copies, like processes
+            job = job._replace(worker=copy.deepcopy(job.worker))
+    if previous is not None and previous.reader_key != job.reader_key \
+            and previous.reader_key in readers:
+        # Open readers stay open, but free their caches while idle
+        readers[previous.reader_key].release()
+    return job
+
+
+class _PipeWriter:
+    """Queue-like sending end of a worker process's result pipe."""
+
+    def __init__(self, conn: Any) -> None:
+        self._conn = conn
+
+    def put(self, msg: Any) -> None:
+        self._conn.send(msg)
+
 
 class _Task(Process):
 
     def __init__(self,
-                 datasrc: Reader,
-                 f: Worker,
                  in_queue: Queue,
-                 out_queue: Queue,
-                 shutdown: Any,
-                 blocktime: float = 0.1
+                 out_conn: Any,
+                 job_queue: Queue,
+                 cpus: Optional[List[int]] = None
                  ) -> None:
         self.in_queue = in_queue
-        self.out_queue = out_queue
-        self.shutdown = shutdown
-        self.datasrc = datasrc
-        self.f = f
-        self._blocktime = blocktime
+        self.out_conn = out_conn
+        self.job_queue = job_queue
+        self.cpus = cpus
         super().__init__()
 
     def run(self) -> None:
-        running = True
-        with self.datasrc:
-            while running:
-                if self.shutdown.poll():
-                    running = False
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+        _run_tasks(self.in_queue, _PipeWriter(self.out_conn), self.job_queue,
+                   threaded=False, share=True)
+
+
+class _ThreadTask(Thread):
+
+    def __init__(self,
+                 in_queue: queue.Queue,
+                 out_queue: queue.Queue,
+                 job_queue: queue.Queue
+                 ) -> None:
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.job_queue = job_queue
+        super().__init__(daemon=True)
+
+    def run(self) -> None:
+        _run_tasks(self.in_queue, self.out_queue, self.job_queue,
+                   threaded=True, share=False)
+
+
+class _MPIChannel:
+    """Queue-like point-to-point messages with one other MPI rank."""
+
+    def __init__(self, comm: Any, rank: int, tag: int) -> None:
+        self._comm = comm
+        self._rank = rank
+        self._tag = tag
 
+    def put(self, msg: Any) -> None:
+        self._comm.send(msg, dest=self._rank, tag=self._tag)
+
+    def get(self) -> Any:
+        return self._comm.recv(source=self._rank, tag=self._tag)
+
+
+class _MPIJobs:
+    """Queue-like jobs for one MPI rank, carried by its task messages.
+
+    A job (reader and worker) is often bigger than MPI's eager limit, and
+    a blocking send of it on its own waits until the rank receives it,
+    which the rank only does once it has a task for the job. So rank 0
+    keeps the latest job here to send in one message with the next task,
+    and the worker rank queues the jobs it gets that way.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: Deque[_Job] = deque()
+
+    def put(self, job: _Job) -> None:
+        self._jobs.append(job)
+
+    def get(self) -> _Job:
+        return self._jobs.popleft()
+
+    def take(self) -> Optional[_Job]:
+        """Get the latest job not yet sent, if any, forgetting the rest."""
+        job = self._jobs.pop() if self._jobs else None
+        self._jobs.clear()
+        return job
+
+
+class _MPITaskChannel(_MPIChannel):
+    """Tasks for (or from) one MPI rank, each new job sent with a task."""
+
+    def __init__(self, comm: Any, rank: int, jobs: _MPIJobs) -> None:
+        super().__init__(comm, rank, _MPI_TASK_TAG)
+        self.jobs = jobs
+
+    def put(self, msg: Any) -> None:
+        super().put((self.jobs.take(), msg))
+
+    def get(self) -> Any:
+        job, msg = super().get()
+        if job is not None:
+            self.jobs.put(job)
+        return msg
+
+
+def serve_mpi() -> int:
+    """
+    Turn every MPI rank except 0 into a task server for "mpi" pools.
+
+    Call this once, early, in a program started under mpirun. Rank 0
+    returns the number of worker ranks and runs the program as usual,
+    with any WorkerPool using the "mpi" executor farming tasks out to the
+    other ranks. The other ranks serve those tasks (keeping readers open
+    between task lists) until rank 0 exits, and then exit without
+    returning.
+    """
+    if MPI is None:
+        raise RuntimeError("The mpi executor requires mpi4py")
+    comm = MPI.COMM_WORLD
+    if comm.rank == 0:
+        atexit.register(_stop_mpi_servers, comm)
+        return int(comm.size - 1)
+    jobs = _MPIJobs()
+    _run_tasks(_MPITaskChannel(comm, 0, jobs),
+               _MPIChannel(comm, 0, _MPI_RESULT_TAG), jobs,
+               threaded=False, share=False)
+    sys.exit(0)
+
+
+def _stop_mpi_servers(comm: Any) -> None:
+    for r in range(1, comm.size):
+        comm.send((None, None), dest=r, tag=_MPI_TASK_TAG)
+
+
+class WorkerPool:
+    """
+    A set of worker processes that can be reused by many task lists.
+
+    Readers are entered in each worker the first time they are used, and
+    stay open until the pool is closed. Task lists run on the same pool
+    with the same reader object therefore only pay for opening files (and
+    starting processes) once. Only one task list can run at a time.
+
+    Each task is sent to the worker with the fewest outstanding tasks. An
+    exception raised by a reader or worker is re-raised in the calling
+    process (chained to the original traceback) as soon as it arrives. If
+    a worker process dies instead (killed for running out of memory, say,
+    or a crash in a C library) it is replaced with a fresh one, and its
+    outstanding tasks are either resubmitted, up to `retries` times each,
+    or fail with WorkerCrashed.
+
+    The "threads" executor runs the workers as threads of this process
+    instead. That avoids pickling the results, and suits readers that
+    release the GIL (rasterio, blosc and large NumPy operations). Each
+    thread gets its own copy of the reader and worker.
+
+    The "mpi" executor uses the other ranks of MPI.COMM_WORLD as workers
+    (see `serve_mpi`), so n_workers is ignored. The worker ranks outlive
+    the pool, keeping their readers open for any later "mpi" pool. A rank
+    that dies takes down the whole MPI job, so there is nothing to retry.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of workers. A pool with 0 workers does all the work in the
+        calling process.
+    executor : str
+        One of "processes", "threads" or "mpi".
+    retries : int
+        How many times a task is resubmitted after the worker process
+        running it dies.
+    affinity : Optional[List[List[int]]]
+        CPU sets (eg NUMA nodes) to pin worker processes to, in turn.
+
+    """
+
+    def __init__(self,
+                 n_workers: int,
+                 executor: str = "processes",
+                 retries: int = 0,
+                 affinity: Optional[List[List[int]]] = None
+                 ) -> None:
+        if executor not in EXECUTORS:
+            raise ValueError("Unknown executor {}".format(executor))
+        self.executor = executor
+        self.retries = retries
+        self.affinity = affinity
+        self._procs: List[Any] = []
+        self._result_conns: List[Any] = []
+        if executor == "mpi":
+            if MPI is None:
+                raise RuntimeError("The mpi executor requires mpi4py")
+            comm = MPI.COMM_WORLD
+            n_workers = comm.size - 1
+            self._job_queues: List[Any] = [
+                _MPIJobs() for _ in range(1, comm.size)
+            ]
+            self._task_queues: List[Any] = [
+                _MPITaskChannel(comm, r, self._job_queues[r - 1])
+                for r in range(1, comm.size)
+            ]
+            self._result_queue: Any = _MPIChannel(comm, MPI.ANY_SOURCE,
+                                                  _MPI_RESULT_TAG)
+        else:
+            self._task_queues = []
+            self._job_queues = []
+            self._result_queue = queue.Queue(RESULT_QUEUE_SIZE) \
+                if executor == "threads" else None
+            for _ in range(n_workers):
+                self._task_queues.append(None)
+                self._job_queues.append(None)
+                self._procs.append(None)
+                self._result_conns.append(None)
+                self._start_worker(len(self._procs) - 1)
+        self.n_workers = n_workers
+        # Keys identifying readers to the workers. These are unique across
+        # pools because MPI workers outlive them
+        self._reader_keys: Dict[int, Tuple[Reader, int]] = {}
+        self._busy = False
+        self._job: Optional[_Job] = None
+        # Outstanding tasks: the message, and which worker has it
+        self._pending: Dict[int, Any] = {}
+        self._owner: Dict[int, int] = {}
+        self._load = [0] * n_workers
+        self._attempts: Dict[int, int] = {}
+        self._failed: Deque[Tuple[int, float, _Failure]] = deque()
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, ex_type: type, ex_val: Exception,
+                 ex_tb: TracebackType) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shut down the worker processes."""
+        for _, q in zip(self._procs, self._task_queues):
+            q.put(None)
+        for p in self._procs:
+            p.join()
+        if self.executor == "processes":
+            for task_id in list(self._pending):
+                self._unlink_results(task_id)
+        self._procs = []
+
+    def _start_worker(self, i: int) -> None:
+        """Start a worker in slot i, with fresh queues."""
+        if self.executor == "threads":
+            task_queue: Any = queue.Queue(REQ_QUEUE_SIZE)
+            job_queue: Any = queue.Queue()
+            proc: Any = _ThreadTask(task_queue, self._result_queue,
+                                    job_queue)
+            proc.start()
+        else:
+            task_queue = Queue(REQ_QUEUE_SIZE)
+            job_queue = Queue()
+            recv_conn, send_conn = Pipe(duplex=False)
+            cpus = self.affinity[i % len(self.affinity)] \
+                if self.affinity else None
+            proc = _Task(task_queue, send_conn, job_queue, cpus)
+            proc.start()
+            send_conn.close()  # so the pipe sees EOF if the worker dies
+            self._result_conns[i] = recv_conn
+        self._task_queues[i] = task_queue
+        self._job_queues[i] = job_queue
+        self._procs[i] = proc
+
+    def _send(self, msg: Tuple[int, int, Any]) -> None:
+        """Send a task to the least busy worker."""
+        task_id = msg[1]
+        i = min(range(self.n_workers), key=self._load.__getitem__)
+        self._load[i] += 1
+        self._owner[task_id] = i
+        self._pending[task_id] = msg
+        self._task_queues[i].put(msg)
+
+    def _receive(self) -> Tuple[int, float, Any]:
+        """Get the next (task_id, seconds, result) from any worker."""
+        while not self._failed:
+            if self.executor == "processes":
+                msg = self._receive_process()
+                if msg is None:
+                    continue
+            else:
+                msg = self._result_queue.get()
+            task_id = msg[0]
+            self._load[self._owner.pop(task_id)] -= 1
+            del self._pending[task_id]
+            self._attempts.pop(task_id, None)
+            return msg
+        return self._failed.popleft()
+
+    def _receive_process(self) -> Optional[Tuple[int, float, Any]]:
+        conns = {c: i for i, c in enumerate(self._result_conns)}
+        sentinels = {p.sentinel: i for i, p in enumerate(self._procs)}
+        ready = connection.wait(list(conns) + list(sentinels))
+        for r in ready:
+            if r in conns:
                 try:
-                    task_id, req = self.in_queue.get(True, self._blocktime)
-                    data: Any = self.datasrc(req)
-                    out_data = self.f(data)
-                    self.out_queue.put((task_id, out_data))
-                except queue.Empty:
-                    pass
+                    return r.recv()  # type: ignore
+                except (EOFError, OSError):  # died mid-message
+                    self._replace_worker(conns[r])
+                    return None
+        self._replace_worker(sentinels[ready[0]])
+        return None
+
+    def _replace_worker(self, i: int) -> None:
+        """Restart a dead worker and deal with the tasks it was running."""
+        dead = self._procs[i]
+        dead.join()
+        self._result_conns[i].close()
+        for q in (self._task_queues[i], self._job_queues[i]):
+            q.cancel_join_thread()
+            q.close()
+        lost = sorted(t for t, w in self._owner.items() if w == i)
+        log.warning("Worker process {} died (exit code {}) with {} "
+                    "outstanding task(s)".format(dead.pid, dead.exitcode,
+                                                 len(lost)))
+        for task_id in lost:
+            self._unlink_results(task_id)
+        self._start_worker(i)
+        if self._job is not None:
+            self._job_queues[i].put(self._job)
+        self._load[i] = 0
+        for task_id in lost:
+            del self._owner[task_id]
+            msg = self._pending.pop(task_id)
+            attempts = self._attempts.get(task_id, 0)
+            if attempts < self.retries:
+                log.warning("Retrying task {} (attempt {} of {})".format(
+                    task_id, attempts + 1, self.retries))
+                self._attempts[task_id] = attempts + 1
+                self._send(msg)
+            else:
+                self._attempts.pop(task_id, None)
+                error = WorkerCrashed(dead.pid, dead.exitcode)
+                self._failed.append((task_id, 0.0, _Failure(error, "")))
+
+    def _unlink_results(self, task_id: int) -> None:
+        """Free any result a dead worker shared but never handed over."""
+        job_id = self._pending[task_id][0]
+        pid = self._procs[self._owner[task_id]].pid
+        _unlink_block(_block_name(pid, job_id, task_id))
 
+    def imap(self,
+             task_list: Iterable[Any],
+             reader: Reader,
+             worker: Worker,
+             total: Optional[int] = None,
+             max_inflight: Optional[int] = None,
+             feedback: Optional[Feedback] = None,
+             task_size: Optional[TaskSize] = None,
+             ordered: bool = True
+             ) -> Iterator[Any]:
+        """Run a task list on the pool, see `task_list`."""
+        if self.n_workers == 0:
+            yield from _task_list_0(task_list, reader, worker, total,
+                                    feedback, task_size, ordered)
+            return
+        if self._busy:
+            raise RuntimeError("WorkerPool is already running a task list")
+        self._busy = True
+        try:
+            yield from self._imap(task_list, reader, worker, total,
+                                  max_inflight if max_inflight
+                                  else INFLIGHT_PER_WORKER * self.n_workers,
+                                  feedback, task_size, ordered)
+        finally:
+            self._busy = False
 
-def task_list(task_list: List[Any],
+    def _imap(self,
+              task_list: Iterable[Any],
               reader: Reader,
               worker: Worker,
-              n_workers: int
+              total: Optional[int],
+              max_inflight: int,
+              feedback: Optional[Feedback],
+              task_size: Optional[TaskSize],
+              ordered: bool
               ) -> Iterator[Any]:
+        run = _Run(self, self._start_job(reader, worker), task_list,
+                   feedback)
+        run.submit(max_inflight)
+        try:
+            with tqdm(total=total) as pbar:
+                while run.n_out < run.n_submitted:
+                    done_task, result = run.next_result(ordered)
+                    run.submit(1)
+                    yield _unshare(result) if ordered \
+                        else (done_task, _unshare(result))
+                    pbar.update(task_size(done_task) if task_size else 1)
+        finally:
+            run.discard()
+
+    def _start_job(self, reader: Reader, worker: Worker) -> int:
+        """Send the workers a new reader/worker pair, returning its id."""
+        job_id = next(_job_ids)
+        if id(reader) not in self._reader_keys:
+            self._reader_keys[id(reader)] = (reader, next(_reader_keys))
+        job = _Job(job_id, self._reader_keys[id(reader)][1], reader, worker)
+        self._job = job
+        for q in self._job_queues:
+            q.put(job)
+        return job_id
+
+
+class _Run:
+    """The tasks of one task list on a WorkerPool, in flight and done."""
+
+    def __init__(self,
+                 pool: WorkerPool,
+                 job_id: int,
+                 task_list: Iterable[Any],
+                 feedback: Optional[Feedback]
+                 ) -> None:
+        self._pool = pool
+        self._job_id = job_id
+        self._tasks = iter(task_list)
+        self._feedback = feedback
+        self._cache: Dict[int, Any] = {}
+        self._submitted: Dict[int, Any] = {}
+        self.n_submitted = 0
+        self.n_received = 0
+        self.n_out = 0
+
+    def submit(self, n: int) -> None:
+        """Send up to n more tasks to the pool."""
+        for x in islice(self._tasks, n):
+            self._pool._send((self._job_id, self.n_submitted, x))
+            self._submitted[self.n_submitted] = x
+            self.n_submitted += 1
+
+    def _receive(self) -> int:
+        """Cache the next result to arrive, returning its task id."""
+        done_id, seconds, result = self._pool._receive()
+        self.n_received += 1
+        if isinstance(result, _Failure):
+            _raise_failure(result)
+        self._cache[done_id] = result
+        if self._feedback:
+            self._feedback(self._submitted[done_id], seconds)
+        return int(done_id)
+
+    def next_result(self, ordered: bool) -> Tuple[Any, Any]:
+        """Get the next task (in order, or as done) and its result."""
+        if ordered:
+            while self.n_out not in self._cache:
+                self._receive()
+            done_id = self.n_out
+        else:
+            done_id = self._receive()
+        self.n_out += 1
+        return self._submitted.pop(done_id), self._cache.pop(done_id)
+
+    def discard(self) -> None:
+        """Collect and free the results not yielded, eg if abandoned early.
+
+        This leaves the pool clean for the next task list (or shutdown).
+        """
+        outstanding = list(self._cache.values())
+        for _ in range(self.n_submitted - self.n_received):
+            outstanding.append(self._pool._receive()[2])
+        for result in outstanding:
+            _unshare(result)  # frees any shared memory
+
+
+def task_list(task_list: Iterable[Any],
+              reader: Reader,
+              worker: Worker,
+              n_workers: int,
+              total: Optional[int] = None,
+              max_inflight: Optional[int] = None,
+              pool: Optional[WorkerPool] = None,
+              executor: str = "processes",
+              feedback: Optional[Feedback] = None,
+              task_size: Optional[TaskSize] = None,
+              ordered: bool = True,
+              retries: int = 0,
+              affinity: Optional[List[List[int]]] = None
+              ) -> Iterator[Any]:
+    """
+    Apply reader then worker to each task, yielding results in task order.
+
+    Tasks are pulled lazily from `task_list`, so it can be a generator.
+    At most `max_inflight` tasks are submitted but not yet yielded at
+    any one time, which also bounds the out-of-order result cache.
+
+    With `ordered=False`, (task, result) pairs are yielded as soon as each
+    result arrives instead, so one slow task does not hold up the rest.
+
+    An exception in a reader or worker is raised here as soon as it
+    arrives, and a dead worker process raises WorkerCrashed (after any
+    retries), rather than leaving the task list waiting forever.
+
+    Parameters
+    ----------
+    task_list : Iterable[Any]
+        The (small) task descriptions passed to the reader.
+    reader : Reader
+        Reader called with each task, inside its context manager.
+    worker : Worker
+        Worker applied to the output of the reader.
+    n_workers : int
+        Number of workers. 0 does all the work in this process.
+    total : Optional[int]
+        Number of tasks for progress reporting. Defaults to the length of
+        task_list if it has one.
+    max_inflight : Optional[int]
+        Maximum number of outstanding tasks. Defaults to
+        INFLIGHT_PER_WORKER times the number of workers.
+    pool : Optional[WorkerPool]
+        Run on this existing pool rather than starting n_workers fresh
+        workers (unless n_workers is 0).
+    executor : str
+        "processes", "threads" or "mpi", for the workers started when no
+        pool is given. See `WorkerPool`.
+    feedback : Optional[Callable[[Any, float], None]]
+        Called with each task and the seconds spent reading and working on
+        it, as soon as its result arrives. Lets the task iterator adapt
+        the tasks it has yet to produce (eg `iteration.AdaptiveSlices`).
+    task_size : Optional[Callable[[Any], int]]
+        Progress bar units for each task, if not 1 (total should be in
+        the same units).
+    ordered : bool
+        Yield results in task order (the default), or (task, result)
+        pairs in order of completion.
+    retries : int
+        How many times to resubmit a task whose worker process died, for
+        the workers started when no pool is given.
+    affinity : Optional[List[List[int]]]
+        CPU sets to pin the worker processes started when no pool is given
+        to, in turn.
+
+    """
+    if total is None and isinstance(task_list, Sized):
+        total = len(task_list)
     if n_workers == 0:
-        return _task_list_0(task_list, reader, worker)
+        return _task_list_0(task_list, reader, worker, total, feedback,
+                            task_size, ordered)
+    elif pool is not None:
+        return pool.imap(task_list, reader, worker, total, max_inflight,
+                         feedback, task_size, ordered)
     else:
-        return _task_list_multi(task_list, reader, worker, n_workers)
+        return _task_list_multi(task_list, reader, worker, n_workers,
+                                total, max_inflight, executor, feedback,
+                                task_size, ordered, retries, affinity)
 
 
-def _task_list_0(task_list: List[Any],
+def _task_list_0(task_list: Iterable[Any],
                  reader: Reader,
-                 worker: Worker
+                 worker: Worker,
+                 total: Optional[int],
+                 feedback: Optional[Feedback] = None,
+                 task_size: Optional[TaskSize] = None,
+                 ordered: bool = True
                  ) -> Iterator[Any]:
-    total = len(task_list)
     with reader:
         with tqdm(total=total) as pbar:
             for t in task_list:
+                start = time.perf_counter()
                 data: Any = reader(t)
                 output = worker(data)
-                yield output
-                pbar.update()
+                if feedback:
+                    feedback(t, time.perf_counter() - start)
+                yield output if ordered else (t, output)
+                pbar.update(task_size(t) if task_size else 1)
 
 
-def _task_list_multi(task_list: List[Any],
+def _task_list_multi(task_list: Iterable[Any],
                      reader: Reader,
                      worker: Worker,
-                     n_workers: int
+                     n_workers: int,
+                     total: Optional[int],
+                     max_inflight: Optional[int],
+                     executor: str,
+                     feedback: Optional[Feedback],
+                     task_size: Optional[TaskSize],
+                     ordered: bool,
+                     retries: int,
+                     affinity: Optional[List[List[int]]]
                      ) -> Iterator[Any]:
-    req_queue: Queue = Queue(REQ_QUEUE_SIZE)
-    result_queue: Queue = Queue(RESULT_QUEUE_SIZE)
-    shutdown_recv, shutdown_send = Pipe(False)
-    worker_procs = [_Task(reader, worker, req_queue, result_queue,
-                          shutdown_recv)
-                    for _ in range(n_workers)]
-    cache: Dict[int, Any] = {}
-
-    task_id = 0
-    task_id_out = 0
-    for w in worker_procs:
-        w.start()
-
-    total = len(task_list)
-    for x in task_list:
-        req_queue.put((task_id, x))
-        task_id += 1
-
-    with tqdm(total=total) as pbar:
-        for _ in range(task_id):
-            satisfied = False
-            while not satisfied:
-                if task_id_out in cache:
-                    result = cache.pop(task_id_out)
-                    satisfied = True
-                    task_id_out += 1
-                else:
-                    task_id, result = result_queue.get()
-                    cache[task_id] = result
-            yield result
-            pbar.update()
-
-    shutdown_send.send(0)
-    for w in worker_procs:
-        w.join()
+    with WorkerPool(n_workers, executor, retries, affinity) as pool:
+        yield from pool.imap(task_list, reader, worker, total, max_inflight,
+                             feedback, task_size, ordered)
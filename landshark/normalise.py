@@ -15,47 +15,216 @@
 # limitations under the License.
 
 import logging
-from typing import Optional, Tuple
+from functools import partial
+from typing import List, NamedTuple, Optional, Tuple
 
 import numpy as np
-from tqdm import tqdm
 
 from landshark import iteration
-from landshark.basetypes import ContinuousArraySource, ContinuousType, Worker
+from landshark.basetypes import (ContinuousArraySource, ContinuousType,
+                                 MissingType, Worker)
+from landshark.multiproc import WorkerPool, task_list
 from landshark.util import to_masked
 
 log = logging.getLogger(__name__)
 
+# Standard normal quantile for the two-sided 95% bounds on sampled stats
+CONFIDENCE_Z = 1.96
+
+# Values kept per level of a quantile sketch. The rank error of its
+# quantiles is roughly sqrt(levels) / SKETCH_SIZE, with one level for each
+# doubling of the data beyond this size
+SKETCH_SIZE = 4096
+
+# Ways to scale continuous features: by mean and standard deviation, by
+# median and interquartile range, or by median and interquartile range
+# after clipping the tails to quantiles
+SCALINGS = ["standard", "robust", "clip"]
+
+# Default fraction of each tail clipped by the "clip" scaling
+CLIP_QUANTILE = 0.01
+
+# Interquartile range of the standard normal, so that robustly scaled
+# features have unit spread where they are normally distributed
+NORMAL_IQR = 1.349
+
+
+class QuantileSketch:
+    """
+    Mergeable streaming sketch of the quantiles of each feature.
+
+    Values are kept in levels, where a value at level h stands for 2^h of
+    the original values. A full level is sorted and every other value
+    (from a random start) is promoted to the next level, so the memory
+    used grows only with the logarithm of the number of values.
+    """
+
+    def __init__(self, n_features: int, size: int = SKETCH_SIZE,
+                 seed: int = 0) -> None:
+        """Initialise an empty sketch."""
+        self._size = size
+        self._rnd = np.random.RandomState(seed)
+        self._levels: List[List[np.ndarray]] = [[] for _ in
+                                                range(n_features)]
+
+    def update(self, array: np.ndarray, missing: MissingType = None) -> None:
+        """Add new (points, features) data, leaving out missing values."""
+        assert array.ndim == 2
+        for f, levels in enumerate(self._levels):
+            x = array[:, f]
+            if missing is not None:
+                x = x[x != missing]
+            self._insert(levels, 0, x)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Add in the values of another sketch."""
+        for levels, other_levels in zip(self._levels, other._levels):
+            for h, x in enumerate(other_levels):
+                self._insert(levels, h, x)
+
+    def select(self, bands: slice) -> "QuantileSketch":
+        """Get a sketch of just some of the features."""
+        out = QuantileSketch(0, self._size)
+        out._levels = self._levels[bands]
+        return out
+
+    @staticmethod
+    def stack(sketches: List["QuantileSketch"]) -> "QuantileSketch":
+        """Join sketches of different features into one."""
+        out = QuantileSketch(0, sketches[0]._size)
+        out._levels = [levels for s in sketches for levels in s._levels]
+        return out
+
+    def _insert(self, levels: List[np.ndarray], h: int, x: np.ndarray
+                ) -> None:
+        while x.size > 0:
+            if h == len(levels):
+                levels.append(np.empty(0, dtype=x.dtype))
+            levels[h] = np.concatenate((levels[h], x))
+            if levels[h].size <= self._size:
+                break
+            values = np.sort(levels[h])
+            odd = values.size % 2
+            levels[h] = values[values.size - odd:]
+            x = values[self._rnd.randint(2):values.size - odd:2]
+            h += 1
+
+    def quantiles(self, q: np.ndarray) -> np.ndarray:
+        """
+        Estimate quantiles of each feature.
+
+        Parameters
+        ----------
+        q : np.ndarray
+            The quantiles, between 0 and 1.
+
+        Returns
+        -------
+        values : np.ndarray
+            The (quantiles, features) values, NaN for features without any
+            values. Exact (the lower of two neighbouring values) until the
+            first level fills up.
+
+        """
+        q = np.asarray(q)
+        out = np.full((len(q), len(self._levels)), np.nan)
+        for f, levels in enumerate(self._levels):
+            if sum(x.size for x in levels) == 0:
+                continue
+            values = np.concatenate(levels)
+            weights = np.concatenate([np.full(x.size, 2 ** h, dtype=np.int64)
+                                      for h, x in enumerate(levels)])
+            order = np.argsort(values, kind="stable")
+            ranks = np.cumsum(weights[order])
+            idx = np.searchsorted(ranks, q * ranks[-1], side="left")
+            out[:, f] = values[order[np.minimum(idx, len(values) - 1)]]
+        return out
+
+    @property
+    def count(self) -> np.ndarray:
+        """Get the number of values of each feature."""
+        return np.array([sum(x.size << h for h, x in enumerate(levels))
+                         for levels in self._levels], dtype=np.int64)
+
 
 class StatCounter:
-    """Class that computes online mean and variance."""
+    """
+    Class that computes online mean and variance.
+
+    Counters of separate parts of the data can be merged, so the parts can
+    be counted in parallel. Optionally a `QuantileSketch` of the data is
+    kept as well.
+    """
 
-    def __init__(self, n_features: int) -> None:
+    def __init__(self, n_features: int, quantiles: bool = False) -> None:
         """Initialise the counters."""
         self._mean = np.zeros(n_features)
         self._m2 = np.zeros(n_features)
-        self._n = np.zeros(n_features, dtype=int)
+        self._n = np.zeros(n_features, dtype=np.int64)
+        self.sketch = QuantileSketch(n_features) if quantiles else None
 
-    def update(self, array: np.ma.MaskedArray) -> None:
-        """Update calclulations with new data."""
+    def update(self, array: np.ndarray, missing: MissingType = None) -> None:
+        """Update calculations with new (points, features) data.
+
+        Values equal to missing are left out.
+        """
         assert array.ndim == 2
-        assert array.shape[0] > 1
+        assert array.shape[0] > 0
+        batch = StatCounter(array.shape[1])
+        if missing is None:
+            batch._n[:] = array.shape[0]
+            batch._mean = array.mean(axis=0, dtype=np.float64)
+            dev = array - batch._mean
+        else:
+            valid = array != missing
+            batch._n = np.count_nonzero(valid, axis=0)
+            total = np.sum(array, axis=0, where=valid, dtype=np.float64)
+            np.divide(total, batch._n, out=batch._mean, where=batch._n > 0)
+            dev = np.subtract(array, batch._mean, where=valid,
+                              out=np.zeros(array.shape))
+        batch._m2 = np.einsum("ij,ij->j", dev, dev)
+        self._merge_moments(batch)
+        if self.sketch is not None:
+            self.sketch.update(array, missing)
 
-        new_n = np.ma.count(array, axis=0)
-        new_mean = (np.ma.mean(array, axis=0)).data
-        new_mean[new_n == 0] = 0.  # enforce this condition
-        new_m2 = (np.ma.var(array, axis=0, ddof=0) * new_n).data
+    def merge(self, other: "StatCounter") -> None:
+        """Add in the counts of another counter."""
+        self._merge_moments(other)
+        if self.sketch is not None:
+            assert other.sketch is not None
+            self.sketch.merge(other.sketch)
 
-        add_n = new_n + self._n
-        if any(add_n == 0):  # catch any totally masked images
-            add_n[add_n == 0] = 1
+    def select(self, bands: slice) -> "StatCounter":
+        """Get the counts of just some of the features."""
+        out = StatCounter(0)
+        out._mean = self._mean[bands]
+        out._m2 = self._m2[bands]
+        out._n = self._n[bands]
+        if self.sketch is not None:
+            out.sketch = self.sketch.select(bands)
+        return out
 
-        delta = new_mean - self._mean
-        delta_mean = delta * (new_n / add_n)
+    @staticmethod
+    def stack(counters: List["StatCounter"]) -> "StatCounter":
+        """Join the counts of different features into one counter."""
+        out = StatCounter(0)
+        out._mean = np.concatenate([c._mean for c in counters])
+        out._m2 = np.concatenate([c._m2 for c in counters])
+        out._n = np.concatenate([c._n for c in counters])
+        sketches = [c.sketch for c in counters if c.sketch is not None]
+        if len(sketches) == len(counters):
+            out.sketch = QuantileSketch.stack(sketches)
+        return out
 
+    def _merge_moments(self, other: "StatCounter") -> None:
+        # Chan et al.'s method
+        add_n = self._n + other._n
+        safe_n = np.maximum(add_n, 1)  # catch any totally masked images
+        delta = other._mean - self._mean
+        delta_mean = delta * (other._n / safe_n)
         self._mean += delta_mean
-        self._m2 += new_m2 + (delta * self._n * delta_mean)
-        self._n += new_n
+        self._m2 += other._m2 + delta * self._n * delta_mean
+        self._n = add_n
 
     @property
     def mean(self) -> np.ndarray:
@@ -77,38 +246,267 @@ class StatCounter:
         return self._n
 
 
+class Scaling(NamedTuple):
+    """Centre, scale and optional (lower, upper) clipping of each feature.
+
+    It is approximate if estimated from a sample of the batches.
+    """
+
+    center: np.ndarray
+    scale: np.ndarray
+    clip: Optional[Tuple[np.ndarray, np.ndarray]] = None
+    approximate: bool = False
+
+
 class Normaliser(Worker):
 
     def __init__(self,
                  mean: np.ndarray,
                  sd: np.ndarray,
-                 missing: Optional[ContinuousType]
+                 missing: Optional[ContinuousType],
+                 clip: Optional[Tuple[np.ndarray, np.ndarray]] = None
                  ) -> None:
         self._mean = mean
         self._sd = sd
         self._missing = missing
+        self._clip = clip
 
     def __call__(self, x: np.ndarray) -> np.ndarray:
+        if self._clip is not None:
+            clipped = np.clip(x, *self._clip).astype(x.dtype, copy=False)
+            x = clipped if self._missing is None else \
+                np.where(x == self._missing, x, clipped)
         xm = to_masked(x, self._missing)
         xm -= self._mean
         xm /= self._sd
         return xm.data
 
 
+class _StatWorker(Worker):
+    """Count the statistics of a batch of data."""
+
+    def __init__(self, missing: MissingType, quantiles: bool = False) -> None:
+        self._missing = missing
+        self._quantiles = quantiles
+
+    def __call__(self, x: np.ndarray) -> StatCounter:
+        counter = StatCounter(x.shape[-1], self._quantiles)
+        counter.update(x.reshape((-1, x.shape[-1])), self._missing)
+        return counter
+
+
+class StatBounds(NamedTuple):
+    """Confidence bounds on the statistics of each feature."""
+
+    mean_lo: np.ndarray
+    mean_hi: np.ndarray
+    sd_lo: np.ndarray
+    sd_hi: np.ndarray
+
+
 def get_stats(src: ContinuousArraySource,
-              batchrows: int
+              batchrows: int,
+              batchcols: Optional[int] = None,
+              n_workers: int = 0,
+              pool: Optional[WorkerPool] = None,
+              sample: Optional[float] = None,
+              seed: int = 0
               ) -> Tuple[np.ndarray, np.ndarray]:
-    log.info("Computing continuous feature statistics")
-    n_rows = src.shape[0]
-    n_cols = src.shape[-1]
-    stats = StatCounter(n_cols)
-    with tqdm(total=n_rows) as pbar:
-        with src:
-            for s in iteration.batch_slices(batchrows, n_rows):
-                x = src(s)
-                bs = x.reshape((-1, x.shape[-1]))
-                bm = to_masked(bs, src.missing)
-                stats.update(bm)
-                pbar.update(x.shape[0])
-    mean, sd = stats.mean, stats.sd
-    return mean, sd
+    """
+    Compute the mean and standard deviation of each continuous feature.
+
+    The batches are counted by the workers and the counts merged here.
+    Given a sample fraction, only a stratified random subset of the
+    batches is counted, and the 95% confidence bounds of the estimates
+    are logged.
+
+    Parameters
+    ----------
+    src : ContinuousArraySource
+        The source of the data.
+    batchrows : int
+        The number of rows in each batch.
+    batchcols : Optional[int]
+        If given, read images wider than this in windows of batchrows by
+        batchcols rather than whole rows.
+    n_workers : int
+        The number of workers, 0 to count in this process.
+    pool : Optional[WorkerPool]
+        An existing pool of workers to use.
+    sample : Optional[float]
+        The fraction of the batches to estimate the statistics from, or
+        None to count them all.
+    seed : int
+        The random seed choosing the sampled batches.
+
+    Returns
+    -------
+    mean, sd : Tuple[np.ndarray, np.ndarray]
+        The statistics of each feature, leaving out missing values.
+
+    """
+    counter = count_stats(src, batchrows, batchcols, n_workers, pool, sample,
+                          seed)
+    return counter.mean, counter.sd
+
+
+def get_scaling(src: ContinuousArraySource,
+                batchrows: int,
+                batchcols: Optional[int] = None,
+                n_workers: int = 0,
+                pool: Optional[WorkerPool] = None,
+                sample: Optional[float] = None,
+                seed: int = 0,
+                scaling: str = "standard",
+                clip_quantile: float = CLIP_QUANTILE
+                ) -> Scaling:
+    """
+    Compute how to scale each continuous feature.
+
+    Takes the same arguments as `get_stats`, plus the scaling (one of
+    `SCALINGS`) and the fraction of each tail clipped by the "clip"
+    scaling. The quantiles of the robust scalings come from sketches
+    counted in the same pass as the mean and standard deviation. The
+    scaling is only approximate if the sample left out any batch.
+    """
+    counter, sampled = _count_stats(src, batchrows, batchcols, n_workers,
+                                    pool, sample, seed, scaling != "standard")
+    return counter_scaling(counter, scaling, clip_quantile)._replace(
+        approximate=sampled)
+
+
+def counter_scaling(counter: StatCounter,
+                    scaling: str = "standard",
+                    clip_quantile: float = CLIP_QUANTILE
+                    ) -> Scaling:
+    """
+    Get the scaling of each feature from its counted statistics.
+
+    The robust scalings centre on the median and divide by the
+    interquartile range (relative to that of the normal distribution),
+    falling back to the standard deviation for features whose quartiles
+    are equal. The "clip" scaling first clips each feature to its
+    `clip_quantile` and `1 - clip_quantile` quantiles.
+    """
+    assert scaling in SCALINGS
+    if scaling == "standard":
+        return Scaling(counter.mean, counter.sd)
+    assert counter.sketch is not None
+    q = counter.sketch.quantiles(np.array([0.25, 0.5, 0.75, clip_quantile,
+                                           1.0 - clip_quantile]))
+    iqr = (q[2] - q[0]) / NORMAL_IQR
+    scale = np.where(iqr > 0, iqr, counter.sd)
+    clip = (q[3], q[4]) if scaling == "clip" else None
+    return Scaling(q[1], scale, clip)
+
+
+def count_stats(src: ContinuousArraySource,
+                batchrows: int,
+                batchcols: Optional[int] = None,
+                n_workers: int = 0,
+                pool: Optional[WorkerPool] = None,
+                sample: Optional[float] = None,
+                seed: int = 0,
+                quantiles: bool = False
+                ) -> StatCounter:
+    """
+    Count the statistics of each continuous feature.
+
+    Takes the same arguments as `get_stats`, and whether to sketch the
+    quantiles as well, but returns the merged counter itself.
+    """
+    return _count_stats(src, batchrows, batchcols, n_workers, pool, sample,
+                        seed, quantiles)[0]
+
+
+def _count_stats(src: ContinuousArraySource,
+                 batchrows: int,
+                 batchcols: Optional[int],
+                 n_workers: int,
+                 pool: Optional[WorkerPool],
+                 sample: Optional[float],
+                 seed: int,
+                 quantiles: bool
+                 ) -> Tuple[StatCounter, bool]:
+    """Count the statistics, and whether any batch was left out."""
+    batches = list(iteration.image_batches(batchrows, batchcols, src.shape))
+    batch_size = partial(iteration.image_batch_size, src.shape)
+    n_batches = len(batches)
+    if sample is None:
+        log.info("Computing continuous feature statistics")
+    else:
+        batches = iteration.sample_batches(batches, sample, seed)
+        log.info("Estimating continuous feature statistics from {} of {} "
+                 "batches".format(len(batches), n_batches))
+    fraction = len(batches) / n_batches
+    n_points = sum(batch_size(b) for b in batches)
+
+    stats = StatCounter(src.shape[-1], quantiles)
+    counters = []
+    out_it = task_list(batches, src, _StatWorker(src.missing, quantiles),
+                       n_workers, total=n_points, pool=pool,
+                       task_size=batch_size, ordered=False)
+    for _, counter in out_it:
+        stats.merge(counter)
+        if fraction < 1.0:
+            counter.sketch = None  # only the moments are needed for bounds
+            counters.append(counter)
+    if fraction < 1.0:
+        mean, sd = stats.mean, stats.sd
+        b = sample_bounds(counters, fraction)
+        for i, c in enumerate(src.columns):
+            log.info("{}: mean {:.4g} ({:.4g} to {:.4g}), sd {:.4g} "
+                     "({:.4g} to {:.4g}), 95% bounds".format(
+                         c, mean[i], b.mean_lo[i], b.mean_hi[i], sd[i],
+                         b.sd_lo[i], b.sd_hi[i]))
+    return stats, fraction < 1.0
+
+
+def sample_bounds(counters: List[StatCounter], fraction: float
+                  ) -> StatBounds:
+    """
+    Estimate 95% confidence bounds on statistics from sampled batches.
+
+    Each batch is treated as one cluster of a cluster sample, since
+    neighbouring pixels are far from independent. The standard errors are
+    those of the ratio estimators of the mean and variance, with a finite
+    population correction for the fraction of batches sampled.
+
+    Parameters
+    ----------
+    counters : List[StatCounter]
+        The counts of each sampled batch (at least 2).
+    fraction : float
+        The fraction of all the batches that were sampled.
+
+    Returns
+    -------
+    bounds : StatBounds
+        Lower and upper bounds on the mean and standard deviation.
+
+    """
+    k = len(counters)
+    assert k > 1
+    n = np.array([c._n for c in counters], dtype=float)
+    means = np.array([c._mean for c in counters])
+    m2s = np.array([c._m2 for c in counters])
+    total = StatCounter(n.shape[1])
+    for c in counters:
+        total.merge(c)
+    mean = total._mean
+    var = total._m2 / np.maximum(total._n, 1)
+    # Squared deviations of each batch about the overall mean
+    dev2 = m2s + n * (means - mean) ** 2
+
+    def _se(totals: np.ndarray, estimate: np.ndarray) -> np.ndarray:
+        n_bar = n.mean(axis=0)
+        resid = (totals - estimate * n) / np.maximum(n_bar, 1e-12)
+        se: np.ndarray = np.sqrt((1 - fraction) * np.sum(resid ** 2, axis=0)
+                                 / (k * (k - 1)))
+        return se
+
+    mean_err = CONFIDENCE_Z * _se(n * means, mean)
+    var_err = CONFIDENCE_Z * _se(dev2, var)
+    return StatBounds(mean - mean_err, mean + mean_err,
+                      np.sqrt(np.maximum(var - var_err, 0)),
+                      np.sqrt(var + var_err))
@@ -0,0 +1,306 @@
+"""Work out how many workers and how much memory landshark can use."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import logging
+import math
+import os
+from typing import List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Batch size used when memory is plentiful (and the old default)
+DEFAULT_BATCH_MB = 10.0
+
+# Smallest batch size worth running with
+MIN_BATCH_MB = 0.1
+
+# Fraction of the available memory the batches may take up between them
+MEMORY_FRACTION = 0.5
+
+# Copies of a batch alive at once for each worker: the raw read, masked
+# and transformed versions, the one in transit and the parent's copy
+BATCH_COPIES = 8
+
+# Batches' worth of decoded tif block rows each reading process may keep
+# (see tifread._ImageStackSource)
+TILE_CACHE_BATCHES = 2
+
+# cgroup v1 reports "no limit" as a huge number rather than "max"
+_CGROUP_V1_UNLIMITED = 2 ** 60
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+NUMA_ROOT = "/sys/devices/system/node"
+PROC_ROOT = "/proc"
+
+
+class Resources(NamedTuple):
+    """What this process is allowed to use."""
+
+    cpus: List[int]
+    cpu_quota: Optional[float]
+    memory: Optional[int]
+    numa_nodes: List[List[int]]
+
+
+class WorkerPlan(NamedTuple):
+    """Worker count, batch size and CPU pinning to run with."""
+
+    nworkers: int
+    batchMB: float
+    affinity: Optional[List[List[int]]]
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """Parse a kernel cpu list like "0-3,8,10-11"."""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_dirs(controller: str,
+                 cgroup_root: str,
+                 proc_root: str
+                 ) -> List[str]:
+    """Directories that may hold this process's controller files.
+
+    Inside a container the process's own cgroup is usually mounted at the
+    root, so that is tried after the path listed in /proc/self/cgroup.
+    """
+    dirs = []
+    for line in (_read(os.path.join(proc_root, "self/cgroup")) or
+                 "").splitlines():
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":  # cgroup v2
+            dirs.append(cgroup_root + path)
+        elif controller in controllers.split(","):
+            dirs.append(os.path.join(cgroup_root, controllers) + path)
+    dirs += [cgroup_root, os.path.join(cgroup_root, controller)]
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def _cpu_quota(cgroup_root: str, proc_root: str) -> Optional[float]:
+    """How many CPUs' worth of time the cgroup may use, if limited."""
+    for d in _cgroup_dirs("cpu", cgroup_root, proc_root):
+        v2 = _read(os.path.join(d, "cpu.max"))
+        if v2 is not None:
+            quota, period = v2.split()
+            return None if quota == "max" else int(quota) / int(period)
+        quota_us = _read(os.path.join(d, "cpu.cfs_quota_us"))
+        period_us = _read(os.path.join(d, "cpu.cfs_period_us"))
+        if quota_us is not None and period_us is not None:
+            return None if int(quota_us) < 0 \
+                else int(quota_us) / int(period_us)
+    return None
+
+
+def _cgroup_memory(cgroup_root: str, proc_root: str) -> Optional[int]:
+    """Bytes the cgroup may still allocate, if it is limited."""
+    for d in _cgroup_dirs("memory", cgroup_root, proc_root):
+        for limit_file, usage_file in [
+                ("memory.max", "memory.current"),
+                ("memory.limit_in_bytes", "memory.usage_in_bytes")]:
+            limit = _read(os.path.join(d, limit_file))
+            if limit is None:
+                continue
+            if limit == "max" or int(limit) >= _CGROUP_V1_UNLIMITED:
+                return None
+            usage = _read(os.path.join(d, usage_file)) or "0"
+            return max(0, int(limit) - int(usage))
+    return None
+
+
+def _meminfo_available(proc_root: str) -> Optional[int]:
+    """Bytes available to the whole machine, from /proc/meminfo."""
+    for line in (_read(os.path.join(proc_root, "meminfo")) or
+                 "").splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def detect_resources(cgroup_root: str = CGROUP_ROOT,
+                     numa_root: str = NUMA_ROOT,
+                     proc_root: str = PROC_ROOT
+                     ) -> Resources:
+    """
+    Find the CPUs and memory this process can actually use.
+
+    This takes into account the CPU affinity mask (eg from taskset or a
+    batch scheduler), cgroup v1 or v2 CPU quotas and memory limits (eg
+    from docker or kubernetes), the memory available on the machine and
+    how the allowed CPUs are split into NUMA nodes.
+
+    Parameters
+    ----------
+    cgroup_root : str
+        Where the cgroup filesystem is mounted.
+    numa_root : str
+        The sysfs directory describing the NUMA nodes.
+    proc_root : str
+        Where procfs is mounted.
+
+    Returns
+    -------
+    resources : Resources
+        The allowed CPUs, CPU quota (in CPUs, None if unlimited), available
+        memory in bytes (None if unknown) and the allowed CPUs of each NUMA
+        node.
+
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    memories = [m for m in (_cgroup_memory(cgroup_root, proc_root),
+                            _meminfo_available(proc_root)) if m is not None]
+    memory = min(memories) if memories else None
+
+    nodes = []
+    for d in sorted(glob.glob(os.path.join(numa_root, "node[0-9]*"))):
+        node_cpus = [c for c in parse_cpulist(
+            _read(os.path.join(d, "cpulist")) or "") if c in cpus]
+        if node_cpus:
+            nodes.append(node_cpus)
+
+    return Resources(cpus, _cpu_quota(cgroup_root, proc_root), memory, nodes)
+
+
+def _usable_cpus(res: Resources) -> Tuple[int, str]:
+    """Count the CPUs allowed by both the affinity mask and the quota."""
+    ncpus = len(res.cpus)
+    reason = "{} CPUs in the affinity mask".format(ncpus)
+    if res.cpu_quota is not None and res.cpu_quota < ncpus:
+        ncpus = max(1, int(math.ceil(res.cpu_quota)))
+        reason = "a cgroup CPU quota of {:g} CPUs".format(res.cpu_quota)
+    return ncpus, reason
+
+
+def plan_read_threads(nworkers: int,
+                      resources: Optional[Resources] = None
+                      ) -> int:
+    """
+    Choose how many threads each process reads its files with.
+
+    The usable CPUs are shared out between the parent and the workers,
+    so that a serial (or small) pool can still decode files in parallel.
+
+    Parameters
+    ----------
+    nworkers : int
+        The number of worker processes.
+    resources : Optional[Resources]
+        The resources to plan for. Defaults to `detect_resources()`.
+
+    Returns
+    -------
+    read_threads : int
+        Threads per process, at least 1.
+
+    """
+    res = resources if resources is not None else detect_resources()
+    ncpus, reason = _usable_cpus(res)
+    threads = max(1, ncpus // (nworkers + 1))
+    log.info("Auto: {} read threads per process, from {} shared by {} "
+             "processes".format(threads, reason, nworkers + 1))
+    return threads
+
+
+def plan_workers(nworkers: Optional[int],
+                 batchMB: Optional[float],
+                 resources: Optional[Resources] = None
+                 ) -> WorkerPlan:
+    """
+    Fill in the worker count and batch size that were not given.
+
+    The worker count is the number of CPUs that are both in the affinity
+    mask and paid for by the cgroup quota (no separate workers at all if
+    that is one CPU), reduced if memory will not stretch to a minimal
+    batch for each. Batches (and the tile cache of each process, sized
+    in batches) then share MEMORY_FRACTION of the available memory, up to
+    DEFAULT_BATCH_MB each. Automatically sized pools on
+    machines with several NUMA nodes pin each worker to one node. Every
+    choice is logged with the reason for it.
+
+    Parameters
+    ----------
+    nworkers : Optional[int]
+        Number of workers asked for, or None to choose.
+    batchMB : Optional[float]
+        Batch size in megabytes asked for, or None to choose.
+    resources : Optional[Resources]
+        The resources to plan for. Defaults to `detect_resources()`.
+
+    Returns
+    -------
+    plan : WorkerPlan
+        The worker count, batch size and the CPUs to pin each worker to in
+        turn (None for no pinning).
+
+    """
+    res = resources if resources is not None else detect_resources()
+    budget = None
+    if res.memory is not None:
+        budget = res.memory * MEMORY_FRACTION * 1e-6 / \
+            (BATCH_COPIES + TILE_CACHE_BATCHES)
+        log.info("Memory available: {:0.0f}MB, of which {:0.0f}MB is "
+                 "budgeted for batches and tile caches".format(
+                     res.memory * 1e-6,
+                     budget * (BATCH_COPIES + TILE_CACHE_BATCHES)))
+
+    affinity = None
+    if nworkers is None:
+        ncpus, reason = _usable_cpus(res)
+        nworkers = ncpus if ncpus > 1 else 0
+        if budget is not None:
+            max_workers = max(0, int(budget / MIN_BATCH_MB) - 1)
+            if max_workers < nworkers:
+                nworkers = max_workers
+                reason = "only enough memory for {} batches of {}MB".format(
+                    max_workers + 1, MIN_BATCH_MB)
+        log.info("Auto: {} workers, from {}".format(nworkers, reason))
+        if nworkers > 1 and len(res.numa_nodes) > 1:
+            affinity = res.numa_nodes
+            log.info("Auto: pinning workers to the {} NUMA nodes in "
+                     "turn".format(len(affinity)))
+
+    if batchMB is None:
+        if budget is None:
+            batchMB = DEFAULT_BATCH_MB
+            reason = "available memory unknown"
+        elif budget / (nworkers + 1) >= DEFAULT_BATCH_MB:
+            batchMB = DEFAULT_BATCH_MB
+            reason = "memory is not a constraint"
+        else:
+            batchMB = max(MIN_BATCH_MB, budget / (nworkers + 1))
+            reason = "sharing the memory budget between {} " \
+                "processes".format(nworkers + 1)
+        log.info("Auto: batches of {:0.2f}MB, {}".format(batchMB, reason))
+
+    return WorkerPlan(nworkers, batchMB, affinity)
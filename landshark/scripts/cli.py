@@ -24,6 +24,7 @@ from landshark import __version__, errors
 from landshark.model import QueryConfig, TrainingConfig
 from landshark.model import predict as predict_fn
 from landshark.model import train_test
+from landshark.resources import DEFAULT_BATCH_MB, plan_workers
 from landshark.saver import overwrite_model_dir
 from landshark.scripts.logger import configure_logging
 from landshark.tfread import setup_query, setup_training
@@ -44,17 +45,19 @@ class CliArgs(NamedTuple):
 @click.version_option(version=__version__)
 @click.option("--gpu/--no-gpu", default=False,
               help="Have tensorflow use the GPU")
-@click.option("--batch-mb", type=float, default=10,
+@click.option("--batch-mb", type=float, default=None,
               help="Approximate size in megabytes of data read per "
-              "worker per iteration")
+              "worker per iteration (default: from the memory available, "
+              "at most {:g})".format(DEFAULT_BATCH_MB))
 @click.option("-v", "--verbosity",
               type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]),
               default="INFO", help="Level of logging")
 @click.pass_context
 def cli(ctx: click.Context, gpu: bool, verbosity: str, batch_mb: float) -> int:
     """Train a model and use it to make predictions."""
-    ctx.obj = CliArgs(gpu=gpu, batchMB=batch_mb)
     configure_logging(verbosity)
+    plan = plan_workers(0, batch_mb)
+    ctx.obj = CliArgs(gpu=gpu, batchMB=plan.batchMB)
     return 0
 
 
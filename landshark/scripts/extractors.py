@@ -16,8 +16,7 @@
 
 import logging
 import os
-from multiprocessing import cpu_count
-from typing import NamedTuple, Tuple
+from typing import List, NamedTuple, Optional, Tuple
 
 import click
 
@@ -29,6 +28,8 @@ from landshark.featurewrite import read_feature_metadata, read_target_metadata
 from landshark.hread import CategoricalH5ArraySource, ContinuousH5ArraySource
 from landshark.image import strip_image_spec
 from landshark.kfold import KFolds
+from landshark.multiproc import EXECUTORS, serve_mpi
+from landshark.resources import DEFAULT_BATCH_MB, plan_workers
 from landshark.scripts.logger import configure_logging
 from landshark.util import mb_to_points
 
@@ -40,6 +41,9 @@ class CliArgs(NamedTuple):
 
     nworkers: int
     batchMB: float
+    executor: str
+    retries: int
+    affinity: Optional[List[List[int]]]
 
 
 @click.group()
@@ -47,20 +51,35 @@ class CliArgs(NamedTuple):
 @click.option("-v", "--verbosity",
               type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]),
               default="INFO", help="Level of logging")
-@click.option("--nworkers", type=click.IntRange(0, None), default=cpu_count(),
-              help="Number of additional worker processes")
-@click.option("--batch-mb", type=float, default=10,
+@click.option("--nworkers", type=click.IntRange(0, None), default=None,
+              help="Number of additional worker processes (default: from "
+              "the CPUs and memory available)")
+@click.option("--batch-mb", type=float, default=None,
               help="Approximate size in megabytes of data read per "
-              "worker per iteration")
+              "worker per iteration (default: from the memory available, "
+              "at most {:g})".format(DEFAULT_BATCH_MB))
+@click.option("--executor", type=click.Choice(EXECUTORS),
+              default="processes", help="Run workers as processes, as "
+              "threads (for GIL-releasing reads) or as the other ranks of "
+              "an mpirun job (ignoring --nworkers)")
+@click.option("--retries", type=click.IntRange(0, None), default=0,
+              help="Times to rerun a task whose worker process dies "
+              "(eg is killed for running out of memory)")
 @click.pass_context
 def cli(ctx: click.Context,
         verbosity: str,
         batch_mb: float,
-        nworkers: int
+        nworkers: int,
+        executor: str,
+        retries: int
         ) -> int:
     """Extract features and targets for training, testing and prediction."""
-    ctx.obj = CliArgs(nworkers, batch_mb)
+    if executor == "mpi":
+        nworkers = serve_mpi()  # only MPI rank 0 gets past here
     configure_logging(verbosity)
+    plan = plan_workers(nworkers, batch_mb)
+    ctx.obj = CliArgs(plan.nworkers, plan.batchMB, executor, retries,
+                      plan.affinity)
     return 0
 
 
@@ -92,7 +111,8 @@ def traintest(ctx: click.Context,
     fold, nfolds = split
     catching_f = errors.catch_and_exit(traintest_entrypoint)
     catching_f(targets, fold, nfolds, random_seed, name, halfwidth,
-               ctx.obj.nworkers, features, ctx.obj.batchMB)
+               ctx.obj.nworkers, features, ctx.obj.batchMB, ctx.obj.executor,
+               ctx.obj.retries, ctx.obj.affinity)
 
 
 def traintest_entrypoint(targets: str,
@@ -103,7 +123,10 @@ def traintest_entrypoint(targets: str,
                          halfwidth: int,
                          nworkers: int,
                          features: str,
-                         batchMB: float
+                         batchMB: float,
+                         executor: str = "processes",
+                         retries: int = 0,
+                         affinity: Optional[List[List[int]]] = None
                          ) -> None:
     """Get training data."""
     feature_metadata = read_feature_metadata(features)
@@ -136,7 +159,10 @@ def traintest_entrypoint(targets: str,
                                folds=kfolds,
                                directory=directory,
                                batchsize=points_per_batch,
-                               nworkers=nworkers)
+                               nworkers=nworkers,
+                               executor=executor,
+                               retries=retries,
+                               affinity=affinity)
     write_trainingdata(args)
     training_metadata = meta.Training(targets=target_metadata,
                                       features=feature_metadata,
@@ -168,7 +194,8 @@ def query(ctx: click.Context,
     """Extract query data for making prediction images."""
     catching_f = errors.catch_and_exit(query_entrypoint)
     catching_f(features, ctx.obj.batchMB, ctx.obj.nworkers,
-               halfwidth, strip, name)
+               halfwidth, strip, name, ctx.obj.executor, ctx.obj.retries,
+               ctx.obj.affinity)
 
 
 def query_entrypoint(features: str,
@@ -176,14 +203,17 @@ def query_entrypoint(features: str,
                      nworkers: int,
                      halfwidth: int,
                      strip: Tuple[int, int],
-                     name: str
+                     name: str,
+                     executor: str = "processes",
+                     retries: int = 0,
+                     affinity: Optional[List[List[int]]] = None
                      ) -> int:
     """Entrypoint for extracting query data."""
     strip_idx, totalstrips = strip
     assert strip_idx > 0 and strip_idx <= totalstrips
 
     """Grab a chunk for prediction."""
-    log.info("Using {} worker processes".format(nworkers))
+    log.info("Using {} worker {}".format(nworkers, executor))
 
     dirname = "query_{}_strip{}of{}".format(name, strip_idx, totalstrips)
     directory = os.path.join(os.getcwd(), dirname)
@@ -207,7 +237,8 @@ def query_entrypoint(features: str,
 
     qargs = ProcessQueryArgs(name, features, feature_metadata.image,
                              strip_idx, totalstrips, strip_imspec, halfwidth,
-                             directory, points_per_batch, nworkers, tag)
+                             directory, points_per_batch, nworkers, tag,
+                             executor, retries, affinity)
 
     write_querydata(qargs)
     feature_metadata.image = strip_imspec
@@ -16,8 +16,7 @@
 
 import logging
 import os.path
-from multiprocessing import cpu_count
-from typing import List, NamedTuple, Tuple
+from typing import List, NamedTuple, Optional, Tuple
 
 import click
 import numpy as np
@@ -25,19 +24,33 @@ import tables
 
 from landshark import __version__, errors
 from landshark import metadata as meta
-from landshark.category import get_maps
-from landshark.featurewrite import (write_categorical, write_continuous,
+from landshark.basetypes import ArraySource
+from landshark.category import (CategoryInfo, get_maps, select_categories,
+                                stack_categories)
+from landshark.featurewrite import (CODECS, DEFAULT_COMPRESSION, SHUFFLES,
+                                    Compression, append_features,
+                                    map_categorical, normalise_continuous,
+                                    read_feature_metadata,
+                                    write_categorical, write_categorical_maps,
+                                    write_continuous, write_continuous_stats,
                                     write_coordinates, write_feature_metadata,
                                     write_target_metadata)
 from landshark.fileio import tifnames
-from landshark.normalise import get_stats
+from landshark.image import ImageSpec
+from landshark.multiproc import EXECUTORS, WorkerPool, serve_mpi
+from landshark.normalise import (CLIP_QUANTILE, SCALINGS, Scaling,
+                                 StatCounter, count_stats, counter_scaling,
+                                 get_scaling, get_stats)
+from landshark.resources import (DEFAULT_BATCH_MB, TILE_CACHE_BATCHES,
+                                 plan_read_threads, plan_workers)
 from landshark.scripts.logger import configure_logging
 from landshark.shpread import (CategoricalShpArraySource,
                                ContinuousShpArraySource,
                                CoordinateShpArraySource)
+from landshark.statcache import StatCache, cached_scan
 from landshark.tifread import (CategoricalStackSource, ContinuousStackSource,
                                shared_image_spec)
-from landshark.util import mb_to_points, mb_to_rows
+from landshark.util import mb_to_points, mb_to_window, patch_chunkshape
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +60,10 @@ class CliArgs(NamedTuple):
 
     nworkers: int
     batchMB: float
+    executor: str
+    retries: int
+    affinity: Optional[List[List[int]]]
+    compression: Compression
 
 
 @click.group()
@@ -54,21 +71,55 @@ class CliArgs(NamedTuple):
 @click.option("-v", "--verbosity",
               type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]),
               default="INFO", help="Level of logging")
-@click.option("--nworkers", type=click.IntRange(0, None), default=cpu_count(),
-              help="Number of additional worker processes")
-@click.option("--batch-mb", type=float, default=10,
+@click.option("--nworkers", type=click.IntRange(0, None), default=None,
+              help="Number of additional worker processes (default: from "
+              "the CPUs and memory available)")
+@click.option("--batch-mb", type=float, default=None,
               help="Approximate size in megabytes of data read per "
-              "worker per iteration")
+              "worker per iteration (default: from the memory available, "
+              "at most {:g})".format(DEFAULT_BATCH_MB))
+@click.option("--executor", type=click.Choice(EXECUTORS),
+              default="processes", help="Run workers as processes, as "
+              "threads (for GIL-releasing reads) or as the other ranks of "
+              "an mpirun job (ignoring --nworkers)")
+@click.option("--retries", type=click.IntRange(0, None), default=0,
+              help="Times to rerun a task whose worker process dies "
+              "(eg is killed for running out of memory)")
+@click.option("--codec", type=click.Choice(CODECS),
+              default=DEFAULT_COMPRESSION.codec,
+              help="Compressor of the output HDF5 arrays")
+@click.option("--complevel", type=click.IntRange(0, 9),
+              default=DEFAULT_COMPRESSION.level,
+              help="Compression level, from 0 (none) to 9 (smallest)")
+@click.option("--shuffle", type=click.Choice(SHUFFLES),
+              default=DEFAULT_COMPRESSION.shuffle,
+              help="Shuffle the bytes or bits of the data before "
+              "compressing it (bit shuffling needs a blosc codec)")
 @click.pass_context
 def cli(ctx: click.Context,
         verbosity: str,
         nworkers: int,
-        batch_mb: float
+        batch_mb: float,
+        executor: str,
+        retries: int,
+        codec: str,
+        complevel: int,
+        shuffle: str
         ) -> int:
     """Import features and targets into landshark-compatible formats."""
-    log.info("Using a maximum of {} worker processes".format(nworkers))
-    ctx.obj = CliArgs(nworkers, batch_mb)
+    if shuffle == "bit" and not codec.startswith("blosc:"):
+        raise click.UsageError("--shuffle bit needs a blosc codec")
+    if executor == "mpi":
+        nworkers = serve_mpi()  # only MPI rank 0 gets past here
     configure_logging(verbosity)
+    plan = plan_workers(nworkers, batch_mb)
+    log.info("Using a maximum of {} worker {}".format(plan.nworkers,
+                                                      executor))
+    compression = Compression(codec, complevel, shuffle)
+    log.info("Compressing output with {} level {}, {} shuffle".format(
+        *compression))
+    ctx.obj = CliArgs(plan.nworkers, plan.batchMB, executor, retries,
+                      plan.affinity, compression)
     return 0
 
 
@@ -79,26 +130,78 @@ def cli(ctx: click.Context,
               help="Directory containing continuous geotifs")
 @click.option("--normalise/--no-normalise", is_flag=True, default=True,
               help="Normalise the continuous tif bands")
-@click.option("--name", type=str, required=True,
-              help="Name of output file")
+@click.option("--name", type=str, default=None,
+              help="Name of output file (required unless appending)")
 @click.option("--ignore-crs/--no-ignore-crs", is_flag=True, default=False,
               help="Ignore CRS (projection and datum) information")
+@click.option("--append-to", type=click.Path(exists=True, dir_okay=False),
+              default=None, help="Add the bands of the tifs to this "
+              "existing features file, rather than writing a new one")
+@click.option("--remove", type=str, multiple=True,
+              help="Name of a band to remove from the --append-to file")
+@click.option("--read-threads", type=click.IntRange(1, None), default=None,
+              help="Threads per process reading the tifs of a stack "
+              "(default: the available CPUs, shared between processes "
+              "by pooled stages)")
+@click.option("--decode-once/--decode-twice", is_flag=True, default=False,
+              help="Normalise and remap the imported data in place in the "
+              "output file, rather than decoding the tifs a second time. "
+              "Faster for tifs that are slow to decode")
+@click.option("--stats-sample", type=click.FloatRange(0, 1),
+              default=None, help="Estimate the normalising statistics from "
+              "this fraction of the batches, sampled reproducibly, rather "
+              "than reading all of them")
+@click.option("--scaling", type=click.Choice(SCALINGS), default="standard",
+              help="Normalise by mean and standard deviation, robustly by "
+              "median and interquartile range, or robustly after clipping "
+              "the tails to quantiles")
+@click.option("--clip-quantile", type=click.FloatRange(0, 0.5),
+              default=CLIP_QUANTILE, help="Fraction of each tail to clip "
+              "with --scaling clip")
+@click.option("--stats-cache", type=click.Path(file_okay=False),
+              default=None, help="Directory caching the statistics and "
+              "categories of each tif, so that only new or changed tifs "
+              "are scanned on later imports")
+@click.option("--chunkshape", type=click.IntRange(1, None), nargs=2,
+              default=None, help="Rows and columns of each HDF5 chunk, "
+              "eg square tiles for patch extraction (default: automatic)")
+@click.option("--halfwidth", type=click.IntRange(0, None), default=None,
+              help="Halfwidth of the patches the features will be read in, "
+              "to choose square chunks suited to it")
 @click.pass_context
 def tifs(ctx: click.Context,
          categorical: Tuple[str, ...],
          continuous: Tuple[str, ...],
          normalise: bool,
-         name: str,
-         ignore_crs: bool
+         name: Optional[str],
+         ignore_crs: bool,
+         append_to: Optional[str],
+         remove: Tuple[str, ...],
+         read_threads: Optional[int],
+         decode_once: bool,
+         stats_sample: Optional[float],
+         scaling: str,
+         clip_quantile: float,
+         stats_cache: Optional[str],
+         chunkshape: Optional[Tuple[int, int]],
+         halfwidth: Optional[int]
          ) -> None:
     """Build a tif stack from a set of input files."""
+    if name is None and append_to is None:
+        raise click.UsageError("--name is required unless --append-to is "
+                               "given")
+    if remove and append_to is None:
+        raise click.UsageError("--remove needs --append-to")
     nworkers = ctx.obj.nworkers
     batchMB = ctx.obj.batchMB
     cat_list = list(categorical)
     con_list = list(continuous)
     catching_f = errors.catch_and_exit(tifs_entrypoint)
     catching_f(nworkers, batchMB, cat_list,
-               con_list, normalise, name, ignore_crs)
+               con_list, normalise, name, ignore_crs, ctx.obj.executor,
+               ctx.obj.retries, ctx.obj.affinity, read_threads, decode_once,
+               stats_sample, scaling, clip_quantile, stats_cache, append_to,
+               list(remove), chunkshape, halfwidth, ctx.obj.compression)
 
 
 def tifs_entrypoint(nworkers: int,
@@ -106,78 +209,341 @@ def tifs_entrypoint(nworkers: int,
                     categorical: List[str],
                     continuous: List[str],
                     normalise: bool,
-                    name: str,
-                    ignore_crs: bool
+                    name: Optional[str],
+                    ignore_crs: bool,
+                    executor: str = "processes",
+                    retries: int = 0,
+                    affinity: Optional[List[List[int]]] = None,
+                    read_threads: Optional[int] = None,
+                    decode_once: bool = False,
+                    stats_sample: Optional[float] = None,
+                    scaling: str = "standard",
+                    clip_quantile: float = CLIP_QUANTILE,
+                    stats_cache: Optional[str] = None,
+                    append_to: Optional[str] = None,
+                    remove: Optional[List[str]] = None,
+                    chunkshape: Optional[Tuple[int, int]] = None,
+                    halfwidth: Optional[int] = None,
+                    compression: Compression = DEFAULT_COMPRESSION
                     ) -> None:
     """Entrypoint for tifs without click cruft."""
-    out_filename = os.path.join(os.getcwd(), "features_{}.hdf5".format(name))
-
+    out_filename, name = _output_file(name, append_to)
     con_filenames = tifnames(continuous)
     cat_filenames = tifnames(categorical)
     log.info("Found {} continuous TIF files".format(len(con_filenames)))
     log.info("Found {} categorical TIF files".format(len(cat_filenames)))
-    has_con = len(con_filenames) > 0
-    has_cat = len(cat_filenames) > 0
     all_filenames = con_filenames + cat_filenames
     if not len(all_filenames) > 0:
-        raise errors.NoTifFilesFound()
+        _remove_only(append_to, remove)
+        return
 
-    N_con, N_cat = None, None
-    con_meta, cat_meta = None, None
     spec = shared_image_spec(all_filenames, ignore_crs)
+    if append_to is not None:
+        normalise, scaling = _check_append(append_to, spec, ignore_crs,
+                                           normalise, scaling)
+    cache = _stat_cache(stats_cache, decode_once, stats_sample)
 
-    with tables.open_file(out_filename, mode="w", title=name) as outfile:
-        if has_con:
-            con_source = ContinuousStackSource(spec, con_filenames)
-            ndims_con = con_source.shape[-1]
-            con_rows_per_batch = mb_to_rows(batchMB, spec.width, ndims_con, 0)
-            N_con = con_source.shape[0] * con_source.shape[1]
-            N = N_con
-            log.info("Continuous missing value set to {}".format(
-                con_source.missing))
-            stats = None
-            if normalise:
-                stats = get_stats(con_source, con_rows_per_batch)
-                sd = stats[1]
-                if any(sd == 0.0):
-                    raise errors.ZeroDeviation(sd, con_source.columns)
-                log.info("Writing normalised continuous data to output file")
-            else:
-                log.info("Writing unnormalised continuous data to output file")
-            con_meta = meta.ContinuousFeatureSet(labels=con_source.columns,
-                                                 missing=con_source.missing,
-                                                 stats=stats)
-            write_continuous(con_source, outfile, nworkers, con_rows_per_batch,
-                             stats)
-
-        if has_cat:
-            cat_source = CategoricalStackSource(spec, cat_filenames)
-            N_cat = cat_source.shape[0] * cat_source.shape[1]
-            N = N_cat
-            if N_con and N_cat != N_con:
-                raise errors.ConCatNMismatch(N_con, N_cat)
-
-            ndims_cat = cat_source.shape[-1]
-            cat_rows_per_batch = mb_to_rows(batchMB, spec.width, 0, ndims_cat)
-            log.info("Categorical missing value set to {}".format(
-                cat_source.missing))
-            catdata = get_maps(cat_source, cat_rows_per_batch)
-            maps, counts = catdata.mappings, catdata.counts
-            ncats = np.array([len(m) for m in maps])
-            log.info("Writing mapped categorical data to output file")
-            cat_meta = meta.CategoricalFeatureSet(labels=cat_source.columns,
-                                                  missing=cat_source.missing,
-                                                  nvalues=ncats,
-                                                  mappings=maps,
-                                                  counts=counts)
-            write_categorical(cat_source, outfile, nworkers,
-                              cat_rows_per_batch, maps)
+    # One pool for every stage so workers keep their tifs open throughout
+    with WorkerPool(nworkers, executor, retries, affinity) as pool, \
+            tables.open_file(out_filename, mode="w", title=name) as outfile:
+        stage = _Stage(pool, outfile, nworkers, batchMB, read_threads,
+                       decode_once, cache, chunkshape, halfwidth, compression)
+        N_con, con_meta, cat_meta = None, None, None
+        if con_filenames:
+            con_meta, N = _import_continuous(stage, spec, con_filenames,
+                                             normalise, stats_sample,
+                                             scaling, clip_quantile)
+            N_con = N
+        if cat_filenames:
+            cat_meta, N = _import_categorical(stage, spec, cat_filenames,
+                                              N_con)
         m = meta.FeatureSet(continuous=con_meta, categorical=cat_meta,
                             image=spec, N=N, halfwidth=0)
         write_feature_metadata(m, outfile)
+    if append_to is not None:
+        try:
+            append_features(append_to, out_filename, remove or [])
+        finally:
+            os.remove(out_filename)
     log.info("Tif import complete")
 
 
+class _Stage(NamedTuple):
+    """The settings shared by the continuous and categorical stages."""
+
+    pool: WorkerPool
+    outfile: tables.File
+    nworkers: int
+    batchMB: float
+    read_threads: Optional[int]
+    decode_once: bool
+    cache: Optional[StatCache]
+    chunkshape: Optional[Tuple[int, int]]
+    halfwidth: Optional[int]
+    compression: Compression
+
+    @property
+    def tile_cache_mb(self) -> float:
+        """Memory for the decoded tif blocks each source may keep."""
+        return TILE_CACHE_BATCHES * self.batchMB
+
+
+def _output_file(name: Optional[str],
+                 append_to: Optional[str]
+                 ) -> Tuple[str, Optional[str]]:
+    """Get the file to import into, and the title to give it."""
+    if append_to is None:
+        return os.path.join(os.getcwd(), "features_{}.hdf5".format(name)), \
+            name
+    # import the new bands on their own, then copy them across
+    return append_to + ".append", os.path.basename(append_to)
+
+
+def _remove_only(append_to: Optional[str],
+                 remove: Optional[List[str]]
+                 ) -> None:
+    """Remove bands from a features file when there are no tifs to add."""
+    if append_to is None or not remove:
+        raise errors.NoTifFilesFound()
+    append_features(append_to, None, remove)
+    log.info("Bands removed from {}".format(append_to))
+
+
+def _stat_cache(stats_cache: Optional[str],
+                decode_once: bool,
+                stats_sample: Optional[float]
+                ) -> Optional[StatCache]:
+    if stats_cache is None:
+        return None
+    if decode_once or stats_sample is not None:
+        log.info("Ignoring --stats-cache as the statistics are not "
+                 "scanned in full separately")
+        return None
+    return StatCache(stats_cache)
+
+
+def _import_continuous(stage: _Stage,
+                       spec: ImageSpec,
+                       filenames: List[str],
+                       normalise: bool,
+                       stats_sample: Optional[float],
+                       scaling: str,
+                       clip_quantile: float
+                       ) -> Tuple[meta.ContinuousFeatureSet, int]:
+    """Write the continuous tifs to the output file, and describe them."""
+    # unnormalised data is written by the parent on its own
+    con_threads = _read_threads(stage.read_threads, stage.nworkers,
+                                normalise)
+    con_source = ContinuousStackSource(spec, filenames, con_threads,
+                                       stage.tile_cache_mb)
+    ndims_con = con_source.shape[-1]
+    con_rows, con_cols = mb_to_window(stage.batchMB, spec.width, ndims_con,
+                                      0)
+    con_rows_per_batch = con_source.aligned_rows(con_rows)
+    con_chunks = _chunkshape(con_source, stage.chunkshape, stage.halfwidth)
+    log.info("Continuous missing value set to {}".format(
+        con_source.missing))
+    stats = None
+    approximate = False
+    if normalise and stage.decode_once:
+        if stats_sample is not None:
+            log.info("Ignoring --stats-sample as the statistics are "
+                     "computed exactly while decoding once")
+        log.info("Writing continuous data to output file and "
+                 "computing its statistics")
+        scale = write_continuous_stats(con_source, stage.outfile,
+                                       stage.nworkers, con_rows_per_batch,
+                                       stage.pool, con_cols, scaling,
+                                       clip_quantile, con_chunks,
+                                       stage.compression)
+        stats = scale.center, scale.scale
+        _check_deviation(stats[1], con_source.columns)
+        log.info("Normalising continuous data in output file")
+        normalise_continuous(stage.outfile, stats, con_rows_per_batch,
+                             con_cols, scale.clip)
+    elif normalise:
+        if stage.cache is not None:
+            scale = _cached_scaling(stage.cache, spec, filenames,
+                                    con_threads, stage.tile_cache_mb,
+                                    con_rows, con_cols, stage.nworkers,
+                                    stage.pool, scaling, clip_quantile)
+        else:
+            scale = get_scaling(con_source, con_rows_per_batch, con_cols,
+                                stage.nworkers, stage.pool, stats_sample,
+                                scaling=scaling, clip_quantile=clip_quantile)
+        stats = scale.center, scale.scale
+        approximate = scale.approximate
+        _check_deviation(stats[1], con_source.columns)
+        log.info("Writing normalised continuous data to output file")
+        write_continuous(con_source, stage.outfile, stage.nworkers,
+                         con_rows_per_batch, stats, stage.pool, con_cols,
+                         scale.clip, con_chunks, stage.compression)
+    else:
+        log.info("Writing unnormalised continuous data to output file")
+        write_continuous(con_source, stage.outfile, stage.nworkers,
+                         con_rows_per_batch, None, stage.pool, con_cols,
+                         chunkshape=con_chunks,
+                         compression=stage.compression)
+    con_meta = meta.ContinuousFeatureSet(labels=con_source.columns,
+                                         missing=con_source.missing,
+                                         stats=stats,
+                                         scaling=scaling,
+                                         approximate=approximate)
+    return con_meta, con_source.shape[0] * con_source.shape[1]
+
+
+def _import_categorical(stage: _Stage,
+                        spec: ImageSpec,
+                        filenames: List[str],
+                        N_con: Optional[int]
+                        ) -> Tuple[meta.CategoricalFeatureSet, int]:
+    """Write the categorical tifs to the output file, and describe them."""
+    cat_threads = _read_threads(stage.read_threads, stage.nworkers, True)
+    cat_source = CategoricalStackSource(spec, filenames, cat_threads,
+                                        stage.tile_cache_mb)
+    N_cat = cat_source.shape[0] * cat_source.shape[1]
+    if N_con and N_cat != N_con:
+        raise errors.ConCatNMismatch(N_con, N_cat)
+
+    ndims_cat = cat_source.shape[-1]
+    cat_rows, cat_cols = mb_to_window(stage.batchMB, spec.width, 0,
+                                      ndims_cat)
+    cat_rows_per_batch = cat_source.aligned_rows(cat_rows)
+    cat_chunks = _chunkshape(cat_source, stage.chunkshape, stage.halfwidth)
+    log.info("Categorical missing value set to {}".format(
+        cat_source.missing))
+    if stage.decode_once:
+        log.info("Writing categorical data to output file and "
+                 "finding its categories")
+        catdata = write_categorical_maps(cat_source, stage.outfile,
+                                         stage.nworkers, cat_rows_per_batch,
+                                         stage.pool, cat_cols, cat_chunks,
+                                         stage.compression)
+        log.info("Mapping categorical data in output file")
+        map_categorical(stage.outfile, catdata.mappings, cat_rows_per_batch,
+                        cat_cols)
+    else:
+        if stage.cache is not None:
+            catdata = _cached_maps(stage.cache, spec, filenames, cat_threads,
+                                   stage.tile_cache_mb, cat_rows, cat_cols,
+                                   stage.nworkers, stage.pool)
+        else:
+            catdata = get_maps(cat_source, cat_rows_per_batch, cat_cols,
+                               stage.nworkers, stage.pool)
+        log.info("Writing mapped categorical data to output file")
+        write_categorical(cat_source, stage.outfile, stage.nworkers,
+                          cat_rows_per_batch, catdata.mappings, stage.pool,
+                          cat_cols, cat_chunks, stage.compression)
+    maps, counts = catdata.mappings, catdata.counts
+    ncats = np.array([len(m) for m in maps])
+    cat_meta = meta.CategoricalFeatureSet(labels=cat_source.columns,
+                                          missing=cat_source.missing,
+                                          nvalues=ncats,
+                                          mappings=maps,
+                                          counts=counts)
+    return cat_meta, N_cat
+
+
+def _read_threads(read_threads: Optional[int],
+                  nworkers: int,
+                  pooled: bool
+                  ) -> int:
+    """Choose the read threads of a stage unless they were given.
+
+    Stages that run in the pool share the CPUs with the workers, but
+    stages the parent runs alone read with every usable CPU.
+    """
+    if read_threads is not None:
+        return read_threads
+    return plan_read_threads(nworkers if pooled else 0)
+
+
+def _chunkshape(source: ArraySource,
+                chunkshape: Optional[Tuple[int, int]],
+                halfwidth: Optional[int]
+                ) -> Optional[Tuple[int, int]]:
+    """Get the requested chunks, or those suited to a patch halfwidth."""
+    if chunkshape is None and halfwidth is not None:
+        chunkshape = patch_chunkshape(halfwidth, source.shape, source.dtype)
+    return chunkshape
+
+
+def _check_deviation(sd: np.ndarray, columns: List[str]) -> None:
+    if any(sd == 0.0):
+        raise errors.ZeroDeviation(sd, columns)
+
+
+def _check_append(path: str,
+                  spec: ImageSpec,
+                  ignore_crs: bool,
+                  normalise: bool,
+                  scaling: str
+                  ) -> Tuple[bool, str]:
+    """Check tifs match a features file, and get how it was normalised."""
+    existing = read_feature_metadata(path)
+    if existing.image.width != spec.width or \
+            existing.image.height != spec.height or \
+            not np.allclose(existing.image.x_coordinates,
+                            spec.x_coordinates) or \
+            not np.allclose(existing.image.y_coordinates,
+                            spec.y_coordinates) or \
+            not (ignore_crs or existing.image.crs == spec.crs):
+        raise errors.ImageSpecMismatch(path)
+    con = existing.continuous
+    if con is not None and (con.normalised, con.scaling) != (normalise,
+                                                             scaling):
+        log.info("Normalising like the existing continuous bands ({})".format(
+            con.scaling if con.normalised else "not normalised"))
+        normalise, scaling = con.normalised, con.scaling
+    return normalise, scaling
+
+
+def _cached_scaling(cache: StatCache,
+                    spec: ImageSpec,
+                    filenames: List[str],
+                    read_threads: int,
+                    tile_cache_mb: float,
+                    batchrows: int,
+                    batchcols: Optional[int],
+                    nworkers: int,
+                    pool: WorkerPool,
+                    scaling: str,
+                    clip_quantile: float
+                    ) -> Scaling:
+    quantiles = scaling != "standard"
+
+    def _scan(paths: List[str]) -> StatCounter:
+        src = ContinuousStackSource(spec, paths, read_threads, tile_cache_mb)
+        return count_stats(src, src.aligned_rows(batchrows), batchcols,
+                           nworkers, pool, quantiles=quantiles)
+
+    counter = cached_scan(cache, "continuous", filenames, _scan,
+                          StatCounter.select, StatCounter.stack,
+                          lambda c: c.sketch is not None or not quantiles)
+    return counter_scaling(counter, scaling, clip_quantile)
+
+
+def _cached_maps(cache: StatCache,
+                 spec: ImageSpec,
+                 filenames: List[str],
+                 read_threads: int,
+                 tile_cache_mb: float,
+                 batchrows: int,
+                 batchcols: Optional[int],
+                 nworkers: int,
+                 pool: WorkerPool
+                 ) -> CategoryInfo:
+
+    def _scan(paths: List[str]) -> CategoryInfo:
+        src = CategoricalStackSource(spec, paths, read_threads,
+                                     tile_cache_mb)
+        return get_maps(src, src.aligned_rows(batchrows), batchcols,
+                        nworkers, pool)
+
+    return cached_scan(cache, "categorical", filenames, _scan,
+                       select_categories, stack_categories)
+
+
 @cli.command()
 @click.option("--record", type=str, multiple=True, required=True,
               help="Label of record to extract as a target")
@@ -209,7 +575,7 @@ def targets(ctx: click.Context,
     batchMB = ctx.obj.batchMB
     catching_f = errors.catch_and_exit(targets_entrypoint)
     catching_f(batchMB, shapefile, record_list, name, every, categorical,
-               normalise, random_seed)
+               normalise, random_seed, ctx.obj.compression)
 
 
 def targets_entrypoint(batchMB: float,
@@ -219,7 +585,8 @@ def targets_entrypoint(batchMB: float,
                        every: int,
                        categorical: bool,
                        normalise: bool,
-                       random_seed: int
+                       random_seed: int,
+                       compression: Compression = DEFAULT_COMPRESSION
                        ) -> None:
     """Targets entrypoint without click cruft."""
     log.info("Loading shapefile targets")
@@ -231,7 +598,7 @@ def targets_entrypoint(batchMB: float,
         cocon_src = CoordinateShpArraySource(shapefile, random_seed)
         cocon_batchsize = mb_to_points(batchMB, ndim_con=0,
                                        ndim_cat=0, ndim_coord=2)
-        write_coordinates(cocon_src, h5file, cocon_batchsize)
+        write_coordinates(cocon_src, h5file, cocon_batchsize, compression)
 
         if categorical:
             log.info("Reading shapefile categorical records")
@@ -243,7 +610,7 @@ def targets_entrypoint(batchMB: float,
             mappings, counts = catdata.mappings, catdata.counts
             ncats = np.array([len(m) for m in mappings])
             write_categorical(cat_source, h5file, nworkers, cat_batchsize,
-                              mappings)
+                              mappings, compression=compression)
             cat_meta = meta.CategoricalTarget(N=cat_source.shape[0],
                                               labels=cat_source.columns,
                                               nvalues=ncats,
@@ -259,7 +626,8 @@ def targets_entrypoint(batchMB: float,
                                          ndim_cat=0)
             mean, sd = get_stats(con_source, con_batchsize) \
                 if normalise else None, None
-            write_continuous(con_source, h5file, nworkers, con_batchsize)
+            write_continuous(con_source, h5file, nworkers, con_batchsize,
+                             compression=compression)
             con_meta = meta.ContinuousTarget(N=con_source.shape[0],
                                              labels=con_source.columns,
                                              means=mean,
@@ -0,0 +1,168 @@
+"""Cache of the statistics of each tif, to avoid rescanning unchanged files."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import pickle
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, TypeVar
+
+import rasterio
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Bump to invalidate the caches written by older versions
+CACHE_VERSION = 1
+
+# Bytes read at a time when hashing the contents of a tif
+HASH_CHUNK_BYTES = 1 << 22
+
+
+class _Entry(NamedTuple):
+    version: int
+    size: int
+    mtime_ns: int
+    digest: str
+    value: Any
+
+
+def file_digest(path: str) -> str:
+    """Hash the contents of a file."""
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StatCache:
+    """
+    On-disk cache of the statistics of each band of a set of tifs.
+
+    Each tif has a file in the cache directory for each kind of statistic,
+    keyed by its path, size, modification time and a hash of its contents.
+    A tif whose size and modification time are unchanged is not hashed
+    again; one that has only been touched is hashed, and still hits the
+    cache if its contents are the same.
+
+    Parameters
+    ----------
+    directory : str
+        The directory holding the cache, created if it does not exist.
+
+    """
+
+    def __init__(self, directory: str) -> None:
+        """Open the cache."""
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+
+    def _entry_path(self, path: str, kind: str) -> str:
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self._directory,
+                            "{}.{}.pickle".format(key, kind))
+
+    def load(self, path: str, kind: str) -> Optional[Any]:
+        """Get the cached statistics of a tif, or None if out of date."""
+        entry_path = self._entry_path(path, kind)
+        if not os.path.exists(entry_path):
+            return None
+        try:
+            with open(entry_path, "rb") as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            log.warning("Ignoring unreadable cache entry for {}: {}".format(
+                path, e))
+            return None
+        st = os.stat(path)
+        if entry.version != CACHE_VERSION or entry.size != st.st_size:
+            return None
+        if entry.mtime_ns != st.st_mtime_ns:
+            if entry.digest != file_digest(path):
+                return None
+            self._write(entry_path, entry._replace(mtime_ns=st.st_mtime_ns))
+        return entry.value
+
+    def save(self, path: str, kind: str, value: Any) -> None:
+        """Cache the statistics of a tif."""
+        st = os.stat(path)
+        entry = _Entry(CACHE_VERSION, st.st_size, st.st_mtime_ns,
+                       file_digest(path), value)
+        self._write(self._entry_path(path, kind), entry)
+
+    @staticmethod
+    def _write(entry_path: str, entry: _Entry) -> None:
+        # write then rename, so a crash never leaves a partial entry
+        tmp_path = entry_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)
+
+
+def cached_scan(cache: StatCache,
+                kind: str,
+                paths: List[str],
+                scan: Callable[[List[str]], T],
+                select: Callable[[T, slice], T],
+                stack: Callable[[List[T]], T],
+                usable: Callable[[T], bool] = lambda value: True
+                ) -> T:
+    """
+    Get the statistics of a stack of tifs, scanning only uncached tifs.
+
+    Parameters
+    ----------
+    cache : StatCache
+        The cache of the statistics of each tif.
+    kind : str
+        The name of the kind of statistics in the cache.
+    paths : List[str]
+        The tifs of the stack, in order.
+    scan : Callable[[List[str]], T]
+        Compute the statistics of a stack of some of the tifs.
+    select : Callable[[T, slice], T]
+        Get the statistics of a slice of the bands of a stack.
+    stack : Callable[[List[T]], T]
+        Join the statistics of consecutive stacks.
+    usable : Callable[[T], bool]
+        Whether a cached value has everything needed.
+
+    Returns
+    -------
+    value : T
+        The statistics of all the bands of the stack.
+
+    """
+    values: Dict[str, T] = {}
+    for p in paths:
+        value = cache.load(p, kind)
+        if value is not None and usable(value):
+            values[p] = value
+    fresh = [p for p in paths if p not in values]
+    log.info("Using cached {} statistics of {} of {} tifs".format(
+        kind, len(values), len(paths)))
+    if fresh:
+        result = scan(fresh)
+        start = 0
+        for p in fresh:
+            with rasterio.open(p, "r") as f:
+                stop = start + f.count
+            values[p] = select(result, slice(start, stop))
+            cache.save(p, kind, values[p])
+            start = stop
+    return stack([values[p] for p in paths])
@@ -15,24 +15,34 @@
 # limitations under the License.
 
 import logging
+import math
 import os.path
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
+from threading import Lock
 from types import TracebackType
-from typing import Any, Callable, List, NamedTuple, Tuple
+from typing import Any, Callable, List, NamedTuple, Optional, Set, Tuple
 
 import numpy as np
 import rasterio
 from affine import Affine
 from mypy_extensions import NoReturn
+from rasterio.enums import MaskFlags
 from rasterio.io import DatasetReader
 
 from landshark.basetypes import (ArraySource, CategoricalArraySource,
-                                 ContinuousArraySource)
+                                 ContinuousArraySource, FixedSlice)
 from landshark.image import ImageSpec, pixel_coordinates
+from landshark.resources import DEFAULT_BATCH_MB, TILE_CACHE_BATCHES
 
 log = logging.getLogger(__name__)
 
+# Memory for decoded rows of tif blocks by default, see _ImageStackSource
+TILE_CACHE_MB = TILE_CACHE_BATCHES * DEFAULT_BATCH_MB
+
 # Typechecking aliases
+CacheKey = Tuple[int, int, int, int]  # image, block row, first, last column
 ShpFieldsType = List[Tuple[str, str, int, int]]
 WindowType = Tuple[Tuple[int, int], Tuple[int, int]]
 
@@ -73,17 +83,29 @@ class _ImageStackSource(ArraySource):
     ----------
     path_list : List[str]
         The list of images to stack.
-    block_rows : Union[None, int]
-        Optional integer > 0 that specifies the number of rows read at a time.
-        If not provided then a semi-sensible value is computed.
+    read_threads : int
+        Number of threads reading the images of the stack at the same time
+        (rasterio releases the GIL while decoding).
+    tile_cache_mb : float
+        Memory for keeping decoded rows of blocks (strips or tiles) that a
+        batch only partly covers, so they are not decoded again for the
+        next batch. It is shared by all the images of the stack, and
+        counted against the batch memory budget by `plan_workers`.
 
     """
 
     _type_name = ""
 
-    def __init__(self, image_spec: ImageSpec, path_list: List[str]) -> None:
+    def __init__(self,
+                 image_spec: ImageSpec,
+                 path_list: List[str],
+                 read_threads: int = 1,
+                 tile_cache_mb: float = TILE_CACHE_MB
+                 ) -> None:
         """Construct an instance of ImageStack."""
         self._path_list = path_list
+        self._read_threads = read_threads
+        self._tile_cache_mb = tile_cache_mb
         with ExitStack() as stack:
             all_images = [stack.enter_context(rasterio.open(k, "r"))
                           for k in path_list]
@@ -93,50 +115,201 @@ class _ImageStackSource(ArraySource):
                            image_spec.width, nbands)
             self._missing = self._missing_val if _has_missing(bands) else None
             self._columns = _names(bands)
-            self._native = _block_rows(bands)
+            self._block_heights = _block_heights(bands)
+            self._native = _lcm(self._block_heights)
 
         log.info("Found {} {} bands".format(nbands, self._type_name))
-        log.info("Largest tif block size is {} rows".format(self._native))
+        log.info("Tif blocks are {} rows high, so batches align to {} "
+                 "rows".format(sorted(set(self._block_heights)),
+                               self._native))
+
+    def aligned_rows(self, max_rows: int) -> int:
+        """
+        Choose a batch size that decodes as few tif blocks twice as possible.
+
+        A batch that ends part way through a block means the block is
+        decoded again for the next batch. The best batch is a multiple of
+        every block height (their LCM, `native`). If that does not fit in
+        max_rows, the multiple of one of the block heights that wastes the
+        least decoding is used instead.
+
+        Parameters
+        ----------
+        max_rows : int
+            The largest batch (in rows) the memory budget allows.
+
+        Returns
+        -------
+        rows : int
+            The number of rows per batch, at most max_rows.
+
+        """
+        height = self._shape[0]
+        units = set(self._block_heights) | {self._native}
+        candidates = {max_rows} | {max_rows // u * u for u in units
+                                   if u <= max_rows}
+
+        def _cost(rows: int) -> Tuple[float, int]:
+            return decode_factor(rows, self._block_heights, height), -rows
+
+        rows = min(candidates, key=_cost)
+        log.info("Batches of {} rows (budget {}) decode each tif row {:.2f} "
+                 "times on average ({:.2f} unaligned)".format(
+                     rows, max_rows,
+                     decode_factor(rows, self._block_heights, height),
+                     decode_factor(max_rows, self._block_heights, height)))
+        return rows
 
     def __enter__(self) -> None:
         self._images = [rasterio.open(k, "r") for k in self._path_list]
         self._bands = _bands(self._images)
+        nthreads = min(self._read_threads, len(self._images))
+        self._executor = ThreadPoolExecutor(nthreads) if nthreads > 1 \
+            else None
+        self._image_blocks = [_lcm([b[0] for b in im.block_shapes])
+                              for im in self._images]
+        self._cache_bytes = self._tile_cache_mb * 1e6
+        self._cache_lock = Lock()
+        self._uncached: Set[int] = set()
+        self._block_rows: "OrderedDict[CacheKey, np.ndarray]" = OrderedDict()
+        self._cached_bytes = 0
         super().__enter__()
 
+    def release(self) -> None:
+        """Drop the cached block rows, eg while other sources are read."""
+        with self._cache_lock:
+            self._block_rows.clear()
+            self._cached_bytes = 0
+
     def __exit__(self, ex_type: type, ex_val: Exception,
                  ex_tb: TracebackType) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
         for i in self._images:
             i.close()
         del(self._images)
         del(self._bands)
+        del self._executor
+        del self._block_rows
+        del self._cache_lock
         super().__exit__(ex_type, ex_val, ex_tb)
         pass
 
     def _arrayslice(self, start_row: int, end_row: int) -> np.ndarray:
-        """Create a generator that yields blocks of the image stack."""
-        assert start_row < end_row
-        w = ((start_row, end_row), (0, self._shape[1]))
-        shape = (end_row - start_row, self._shape[1], self.shape[-1])
+        """Read whole rows of the image stack."""
+        return self._arraywindow(FixedSlice(start_row, end_row),
+                                 FixedSlice(0, self._shape[1]))
+
+    def _arraywindow(self, rows: FixedSlice, cols: FixedSlice) -> np.ndarray:
+        """Read a window of rows and columns of the image stack."""
+        assert rows.start < rows.stop and cols.start < cols.stop
+        w = ((rows.start, rows.stop), (cols.start, cols.stop))
+        shape = (rows.stop - rows.start, cols.stop - cols.start,
+                 self.shape[-1])
         out_array = np.empty(shape, dtype=self._dtype)
+        bounds = np.cumsum([0] + [im.count for im in self._images])
+
+        def _read(i: int) -> None:
+            self._read_image(i, w, out_array[..., bounds[i]:bounds[i + 1]])
+
+        if self._executor is not None:
+            # Each image has its own handle and its own bands of the output
+            list(self._executor.map(_read, range(len(self._images))))
+        else:
+            for i in range(len(self._images)):
+                _read(i)
+        return out_array
 
-        start_band = 0
-        for im in self._images:
-            stop_band = start_band + im.count
-            marray = im.read(window=w, masked=True).astype(self._dtype)
-            if self._missing is not None:
-                if any(marray.compressed() == self._missing):
-                    msg = "Mask value {} detected in dataset (image: {})"
-                    raise ValueError(msg.format(self._missing, im))
-                marray.data[marray.mask] = self._missing
-            n_missing = np.sum(marray.mask)
+    def _read_image(self, i: int, w: WindowType, out: np.ndarray) -> None:
+        """Read the bands of image i, going through whole rows of blocks.
+
+        Rows of blocks that the window only partly covers are decoded whole
+        (across the window's columns) and kept, least recently used first
+        out across all the images, so the next window down does not decode
+        them again. GDAL decodes each tile of a block row once. Windows on
+        block boundaries, and block rows too big for the cache (with a
+        warning), are decoded directly.
+        """
+        im = self._images[i]
+        block = self._image_blocks[i]
+        (start, stop), cols = w
+        height = self._shape[0]
+        width = cols[1] - cols[0]
+        block_bytes = block * width * im.count * np.dtype(self._dtype).itemsize
+        aligned = start % block == 0 and (stop % block == 0 or stop == height)
+        if not aligned and block_bytes > self._cache_bytes:
+            self._warn_uncached(i, block_bytes)
+        if aligned or block_bytes > self._cache_bytes:
+            self._decode(im, w, out)
+            return
+
+        for k in range(start // block, -(-stop // block)):
+            key = (i, k, cols[0], cols[1])
+            b_start = k * block
+            rows = self._cached(key)
+            if rows is None:
+                b_stop = min(b_start + block, height)
+                rows = np.empty((b_stop - b_start, width, im.count),
+                                dtype=self._dtype)
+                self._decode(im, ((b_start, b_stop), cols), rows)
+                self._keep(key, rows)
+            lo, hi = max(start, b_start), min(stop, b_start + block)
+            out[lo - start:hi - start] = rows[lo - b_start:hi - b_start]
+
+    def _cached(self, key: CacheKey) -> Optional[np.ndarray]:
+        """Get a cached block row, marking it most recently used."""
+        with self._cache_lock:
+            rows = self._block_rows.get(key)
+            if rows is not None:
+                self._block_rows.move_to_end(key)
+            return rows
+
+    def _keep(self, key: CacheKey, rows: np.ndarray) -> None:
+        """Cache a block row, dropping the least recently used to fit."""
+        with self._cache_lock:
+            while self._block_rows and \
+                    self._cached_bytes + rows.nbytes > self._cache_bytes:
+                _, old = self._block_rows.popitem(last=False)
+                self._cached_bytes -= old.nbytes
+            self._block_rows[key] = rows
+            self._cached_bytes += rows.nbytes
+
+    def _warn_uncached(self, i: int, block_bytes: int) -> None:
+        with self._cache_lock:
+            if i in self._uncached:
+                return
+            self._uncached.add(i)
+        log.warning("Rows of blocks of {} take {:0.1f}MB, more than the "
+                    "{:0.1f}MB tile cache, so blocks that batches only "
+                    "partly cover are decoded again".format(
+                        self._path_list[i], block_bytes * 1e-6,
+                        self._tile_cache_mb))
+
+    def _decode(self, im: DatasetReader, w: WindowType, out: np.ndarray
+                ) -> None:
+        """Decode the bands of one image straight into their output bands.
+
+        GDAL converts to the output type and writes through the strides of
+        the (band, row, column) view, so nothing is copied afterwards.
+        """
+        bands = np.moveaxis(out, -1, 0)
+        im.read(window=w, out=bands)
+        if self._missing is None:
+            return
+        collisions = bands == self._missing
+        invalid = None
+        if not _all_valid(im):
+            invalid = im.read_masks(window=w) == 0
+            np.logical_and(collisions, ~invalid, out=collisions)
+        if collisions.any():
+            msg = "Mask value {} detected in dataset (image: {})"
+            raise ValueError(msg.format(self._missing, im))
+        if invalid is not None:
+            n_missing = np.count_nonzero(invalid)
             if n_missing > 0:
                 log.debug(("Tif slice contains {} "
                            "missing pixels").format(n_missing))
-            data = marray.data
-            data = np.moveaxis(data, 0, -1)
-            out_array[..., start_band:stop_band] = data
-            start_band = stop_band
-        return out_array
+                np.copyto(bands, self._missing, where=invalid)
 
 
 class ContinuousStackSource(_ImageStackSource, ContinuousArraySource):
@@ -212,6 +385,11 @@ def _has_missing(bands: List[Band]) -> bool:
     return missing
 
 
+def _all_valid(image: DatasetReader) -> bool:
+    """Check if an image has no nodata values, mask band or alpha."""
+    return all(MaskFlags.all_valid in f for f in image.mask_flag_enums)
+
+
 def _bands(images: List[DatasetReader]) -> List[Band]:
     """Get bands from list of images."""
     bandlist = []
@@ -222,13 +400,44 @@ def _bands(images: List[DatasetReader]) -> List[Band]:
     return bandlist
 
 
-def _block_rows(bands: List[Band]) -> int:
-    """Choose a sensible (global) blocksize based on input images' blocks."""
-    block_list = []
-    for b in bands:
-        block = b.image.block_shapes[b.idx - 1]
-        if not block[0] <= block[1]:
-            raise ValueError("No support for column-wise blocks")
-        block_list.append(block[0])
-    blockrows = int(np.amax(block_list))  # LCM would be more efficient but meh
-    return blockrows
+def _block_heights(bands: List[Band]) -> List[int]:
+    """Get the height in rows of the blocks (strips or tiles) of each band."""
+    return [int(b.image.block_shapes[b.idx - 1][0]) for b in bands]
+
+
+def _lcm(values: List[int]) -> int:
+    """Lowest common multiple of some positive integers."""
+    result = 1
+    for v in values:
+        result = result * v // math.gcd(result, v)
+    return result
+
+
+def decode_factor(rows: int, block_heights: List[int], height: int) -> float:
+    """
+    Compute how many times each row is decoded when reading in batches.
+
+    Parameters
+    ----------
+    rows : int
+        The number of rows in each batch.
+    block_heights : List[int]
+        The block height of each band.
+    height : int
+        The height of the image.
+
+    Returns
+    -------
+    factor : float
+        Rows decoded over rows in the image, averaged over the bands. This
+        is 1 when every batch boundary is on a block boundary.
+
+    """
+    starts = np.arange(0, height, rows)
+    stops = np.minimum(starts + rows, height)
+    decoded = 0
+    for b, nbands in Counter(block_heights).items():
+        first = starts // b * b
+        last = np.minimum(-(-stops // b) * b, height)
+        decoded += nbands * int(np.sum(last - first))
+    return decoded / (height * len(block_heights))
@@ -15,14 +15,23 @@
 # limitations under the License.
 
 import logging
+import math
+from typing import Tuple
 
 import numpy as np
 
 from landshark.basetypes import (CategoricalType, ContinuousType,
-                                 CoordinateType, MissingType)
+                                 CoordinateType, MissingType, NumericalType)
 
 log = logging.getLogger(__name__)
 
+# Smallest side of a square chunk, so the number of chunks (and the cost
+# of indexing them) stays reasonable on large images
+MIN_TILE_SIDE = 16
+
+# Largest uncompressed chunk of a square tile, in bytes
+MAX_TILE_BYTES = 1 << 20
+
 
 def to_masked(array: np.ndarray,
               missing_value: MissingType
@@ -70,3 +79,83 @@ def mb_to_rows(batchMB: float,
     log.info("Batch size set to {} rows, total {:0.2f}MB".format(
         nrows, point_mbytes * row_width * nrows))
     return nrows
+
+
+def mb_to_window(batchMB: float,
+                 row_width: int,
+                 ndim_con: int,
+                 ndim_cat: int
+                 ) -> Tuple[int, int]:
+    """
+    Size the windows an image is read in to fit a batch size.
+
+    Whole rows are used whenever one fits in the batch. Rows too wide for
+    that are split into roughly square windows instead, so the memory used
+    does not grow with the width of the image.
+
+    Parameters
+    ----------
+    batchMB : float
+        The batch size in megabytes.
+    row_width : int
+        The width of the image in pixels.
+    ndim_con : int
+        Number of continuous bands.
+    ndim_cat : int
+        Number of categorical bands.
+
+    Returns
+    -------
+    rows, cols : Tuple[int, int]
+        The window height and width. cols is row_width if whole rows fit.
+
+    """
+    bytes_con = np.dtype(ContinuousType).itemsize * ndim_con
+    bytes_cat = np.dtype(CategoricalType).itemsize * ndim_cat
+    point_mbytes = (bytes_con + bytes_cat) * 1e-6
+    npoints = batchMB / point_mbytes
+    if npoints >= row_width:
+        return mb_to_rows(batchMB, row_width, ndim_con, ndim_cat), row_width
+    log.info("Batch size of {}MB requested".format(batchMB))
+    nrows = max(1, int(math.sqrt(npoints)))
+    ncols = max(1, int(npoints / nrows))
+    log.info("Rows of {} pixels do not fit, batch size set to {}x{} "
+             "windows, total {:0.2f}MB".format(
+                 row_width, nrows, ncols, point_mbytes * nrows * ncols))
+    return nrows, ncols
+
+
+def patch_chunkshape(halfwidth: int,
+                     shape: Tuple[int, ...],
+                     dtype: NumericalType
+                     ) -> Tuple[int, int]:
+    """
+    Choose square chunks of an image for reading patches of a halfwidth.
+
+    Each row of a patch is a separate read, which decompresses every chunk
+    it touches. The side of the chunk is the patch width rounded up to a
+    power of two (but at least MIN_TILE_SIDE), so a patch spans at most
+    2x2 chunks and neighbouring patches share them. Images with many bands
+    get smaller chunks so each stays under MAX_TILE_BYTES.
+
+    Parameters
+    ----------
+    halfwidth : int
+        The halfwidth of the patches that will be extracted.
+    shape : Tuple[int, ...]
+        The shape of the image, (height, width, bands).
+    dtype : NumericalType
+        The type of the image data.
+
+    Returns
+    -------
+    chunkshape : Tuple[int, int]
+        The chunk height and width, no larger than the image.
+
+    """
+    patchwidth = 2 * halfwidth + 1
+    side = max(MIN_TILE_SIDE, 1 << (patchwidth - 1).bit_length())
+    pixel_bytes = np.dtype(dtype).itemsize * shape[-1]
+    max_side = max(1, int(math.sqrt(MAX_TILE_BYTES / pixel_bytes)))
+    side = min(side, max_side)
+    return min(side, shape[0]), min(side, shape[1])
@@ -55,6 +55,9 @@ setup(
         "tensorflow>=1.8"
     ],
     extras_require={
+        "mpi": [
+            "mpi4py>=3.0",
+        ],
         "dev": [
             "jedi>=0.10.2",
             "pytest>=3.1.3",
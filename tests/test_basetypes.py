@@ -58,3 +58,12 @@ def test_array_source():
     assert s.shape == x.shape
     assert basetypes.ContinuousArraySource._dtype == basetypes.ContinuousType
     assert basetypes.CoordinateArraySource._dtype == basetypes.CoordinateType
+
+
+def test_array_source_window():
+    x = np.arange(60, dtype=basetypes.CategoricalType).reshape((4, 5, 3))
+    s = NpyCatArraySource(x, None, ["a", "b", "c"])
+    w = basetypes.FixedWindow(basetypes.FixedSlice(1, 3),
+                              basetypes.FixedSlice(2, 4))
+    with s:
+        np.testing.assert_array_equal(s(w), x[1:3, 2:4])
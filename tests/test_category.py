@@ -15,6 +15,7 @@
 # limitations under the License.
 
 import numpy as np
+import pytest
 
 from landshark import category
 from landshark.basetypes import CategoricalArraySource, CategoricalType
@@ -46,10 +47,24 @@ def test_category_accumulator():
     acc.update(in_data, in_counts)
     acc.update(in_data_2, in_counts_2)
 
-    assert set(acc.counts.keys()) == {1, 2, 3}
-    assert acc.counts[1] == 1
-    assert acc.counts[2] == 4
-    assert acc.counts[3] == 1
+    np.testing.assert_array_equal(acc.values, [1, 2, 3])
+    np.testing.assert_array_equal(acc.counts, [1, 4, 1])
+
+
+def test_category_accumulator_merge():
+    rnd = np.random.RandomState(1)
+    acc, parts = category._CategoryAccumulator(-1), []
+    for _ in range(4):
+        part = category._CategoryAccumulator(-1)
+        part.update(*np.unique(rnd.randint(-1, 50, size=30),
+                               return_counts=True))
+        acc.merge(part)
+        parts.append(part)
+    values = np.concatenate([p.values for p in parts])
+    counts = np.concatenate([p.counts for p in parts])
+    np.testing.assert_array_equal(acc.values, np.unique(values))
+    for v, c in zip(acc.values, acc.counts):
+        assert c == counts[values == v].sum()
 
 
 class NPCatArraySource(CategoricalArraySource):
@@ -64,14 +79,15 @@ class NPCatArraySource(CategoricalArraySource):
         return self._data[start:stop]
 
 
-def test_get_categories(mocker):
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_get_categories(n_workers):
     rnd = np.random.RandomState(seed=666)
     x = rnd.randint(0, 10, size=(20, 3), dtype=CategoricalType)
     missing_in = -1
     columns = ["1", "2", "3"]
     source = NPCatArraySource(x, missing_in, columns)
     batchsize = 3
-    res = category.get_maps(source, batchsize)
+    res = category.get_maps(source, batchsize, n_workers=n_workers)
     mappings, counts = res.mappings, res.counts
     for m, c, x in zip(mappings, counts, x.T):
         assert set(x) == set(m)
@@ -90,3 +106,44 @@ def test_categorical_transform():
                     [2, 0],
                     [0, 1]], dtype=CategoricalType)
     assert np.all(out == ans)
+
+
+def _unique_remap(cats, x):
+    """Remap with np.unique, as CategoryMapper used to."""
+    _, remap = np.unique(np.hstack((cats, x)), return_inverse=True)
+    return remap[len(cats):]
+
+
+@pytest.mark.parametrize("spacing", [1, 3, 1000])
+@pytest.mark.parametrize("missing", [None, -1])
+def test_category_mapper(spacing, missing):
+    rnd = np.random.RandomState(3)
+    cats = [np.arange(-5, 20) * spacing, np.array([7, 9000000])]
+    cats = [c[c != missing] for c in cats]
+    x = np.stack([rnd.choice(c, size=(6, 8)) for c in cats], axis=-1)
+    if missing is not None:
+        x[rnd.rand(6, 8) < 0.2] = missing
+    x = x.astype(CategoricalType)
+    out = category.CategoryMapper(cats, missing)(x)
+    assert out.dtype == x.dtype
+    for i, c in enumerate(cats):
+        valid = x[..., i] != missing
+        np.testing.assert_array_equal(out[..., i][valid],
+                                      _unique_remap(c, x[..., i][valid]))
+        assert np.all(out[..., i][~valid] == missing)
+
+
+@pytest.mark.parametrize("cats", [np.arange(10), np.array([0, 5, 10 ** 6])])
+def test_category_mapper_all_missing(cats):
+    x = np.full((3, 4, 1), -1, dtype=CategoricalType)
+    out = category.CategoryMapper([cats], -1)(x)
+    np.testing.assert_array_equal(out, x)
+
+
+@pytest.mark.parametrize("cats", [np.arange(10), np.array([0, 5, 10 ** 6]),
+                                  np.array([], dtype=int)])
+def test_category_mapper_unknown(cats):
+    x = np.array([[0], [11]], dtype=CategoricalType)
+    mapper = category.CategoryMapper([cats], None)
+    with pytest.raises(ValueError, match="11"):
+        mapper(x)
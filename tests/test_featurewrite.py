@@ -0,0 +1,201 @@
+"""Tests for the featurewrite module."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+import tables
+from affine import Affine
+
+from landshark import errors
+from landshark.featurewrite import (DEFAULT_COMPRESSION, Compression,
+                                    append_features, feature_parts,
+                                    read_compression)
+from landshark.hread import H5Features
+from landshark.scripts import importers
+from landshark.scripts.importers import targets_entrypoint, tifs_entrypoint
+
+SHAPEFILE = os.path.join(os.path.dirname(__file__), "..", "integration",
+                         "data", "targets", "geochem_sites.shp")
+
+
+def _write_tif(path, data, nodata, origin=100.0):
+    count, height, width = data.shape
+    with rasterio.open(str(path), "w", driver="GTiff", height=height,
+                       width=width, count=count, dtype=data.dtype,
+                       nodata=nodata,
+                       transform=Affine(1.0, 0.0, origin, 0.0, -1.0, 200.0)
+                       ) as f:
+        f.write(data)
+
+
+@pytest.fixture
+def layers(tmp_path, monkeypatch):
+    """Directories of continuous (a, b) and categorical (c) tifs."""
+    monkeypatch.chdir(tmp_path)
+    rnd = np.random.RandomState(5)
+    for d, count, dtype, nodata in [("a", 1, np.float32, -1.0),
+                                    ("b", 2, np.float32, -1.0),
+                                    ("c", 1, np.uint8, 255)]:
+        (tmp_path / d).mkdir()
+        data = rnd.randint(0, 9, size=(count, 17, 13)).astype(dtype)
+        data[:, rnd.rand(17, 13) < 0.1] = nodata
+        _write_tif(tmp_path / d / (d + ".tif"), data, nodata)
+    return tmp_path
+
+
+def _import(name, continuous, categorical=(), **kwargs):
+    tifs_entrypoint(0, 0.001, list(categorical), list(continuous), True,
+                    name, True, **kwargs)
+
+
+def _read(path):
+    features = H5Features(str(path))
+    meta = features.metadata
+    out = (list(meta.continuous.columns) if meta.continuous else [],
+           list(meta.categorical.columns) if meta.categorical else [],
+           features.continuous[:] if features.continuous else None,
+           features.categorical[:] if features.categorical else None,
+           features.continuous[3, 2:9] if features.continuous else None)
+    del features
+    return out
+
+
+def test_append(layers):
+    _import("full", ["a", "b"], ["c"])
+    _import("part", ["a"])
+    path = str(layers / "features_part.hdf5")
+    _import(None, ["b"], ["c"], append_to=path)
+    full, part = _read("features_full.hdf5"), _read(path)
+    assert part[:2] == full[:2] == (["a", "b.band1", "b.band2"], ["c"])
+    for f, p in zip(full[2:], part[2:]):
+        np.testing.assert_array_equal(f, p)
+    with tables.open_file(path) as hfile:
+        assert len(feature_parts(hfile, "continuous_data")) == 2
+        assert hfile.root.continuous_data.attrs.normalised
+
+    append_features(path, None, ["b.band1", "c"])
+    labels, cat_labels, con, cat, rows = _read(path)
+    assert labels == ["a", "b.band2"]
+    assert cat_labels == [] and cat is None
+    np.testing.assert_array_equal(con, full[2][..., [0, 2]])
+    np.testing.assert_array_equal(rows, full[4][..., [0, 2]])
+    with tables.open_file(path) as hfile:
+        assert not hasattr(hfile.root, "categorical_data")
+        np.testing.assert_array_equal(hfile.root.continuous_data_bands[:],
+                                      [0, 2])
+
+    # appending and removing in one go
+    _import(None, [], ["c"], append_to=path, remove=["b.band2"])
+    labels, cat_labels, con, cat, _ = _read(path)
+    assert labels == ["a"] and cat_labels == ["c"]
+    np.testing.assert_array_equal(con, full[2][..., :1])
+    np.testing.assert_array_equal(cat, full[3])
+
+
+def test_append_mismatch(layers):
+    _import("part", ["a"])
+    path = str(layers / "features_part.hdf5")
+    with pytest.raises(errors.BandNameClash):
+        _import(None, ["a"], append_to=path)
+    with pytest.raises(errors.UnknownBands):
+        append_features(path, None, ["z"])
+    (layers / "d").mkdir()
+    _write_tif(layers / "d" / "d.tif", np.ones((1, 17, 13), np.float32),
+               -1.0, origin=101.0)
+    with pytest.raises(errors.ImageSpecMismatch):
+        _import(None, ["d"], append_to=path)
+    assert _read(path)[0] == ["a"]
+
+
+def test_append_missing_mismatch(layers):
+    _import("part", ["a"])
+    _import("more", ["b"])
+    path = str(layers / "features_part.hdf5")
+    with tables.open_file(str(layers / "features_more.hdf5"), "a") as f:
+        f.root.continuous_data.attrs.missing = np.float32(-5.0)
+    with pytest.raises(errors.MissingValueMismatch):
+        append_features(path, str(layers / "features_more.hdf5"), [])
+    assert _read(path)[0] == ["a"]
+
+
+@pytest.mark.parametrize("decode_once", [False, True])
+def test_chunkshape(layers, decode_once):
+    _import("auto", ["a", "b"], ["c"])
+    _import("tiles", ["a", "b"], ["c"], chunkshape=(4, 5),
+            decode_once=decode_once)
+    _import("patches", ["a", "b"], ["c"], halfwidth=1,
+            decode_once=decode_once)
+    auto = _read("features_auto.hdf5")
+    for name, chunks in [("tiles", (4, 5)), ("patches", (16, 13))]:
+        path = "features_{}.hdf5".format(name)
+        for a, t in zip(auto[2:], _read(path)[2:]):
+            np.testing.assert_array_equal(a, t)
+        with tables.open_file(path) as hfile:
+            assert hfile.root.continuous_data.chunkshape == chunks
+            assert hfile.root.categorical_data.chunkshape == chunks
+
+
+@pytest.mark.parametrize("record, categorical",
+                         [("Na_ppm_i_1", False), ("SAMPLETYPE", True)])
+def test_targets(tmp_path, monkeypatch, record, categorical):
+    monkeypatch.chdir(tmp_path)
+    targets_entrypoint(0.001, SHAPEFILE, [record], "t", 1, categorical,
+                       False, 666)
+    name = "categorical_data" if categorical else "continuous_data"
+    with tables.open_file("targets_t.hdf5") as hfile:
+        array = getattr(hfile.root, name)
+        assert array.shape == (1026,) and len(array.chunkshape) == 1
+        assert hfile.root.coordinates.shape == (1026,)
+
+
+def test_compression(layers):
+    _import("default", ["a", "b"], ["c"])
+    expected = _read("features_default.hdf5")
+    for compression in [Compression("blosc:zstd", 5, "bit"),
+                        Compression("zlib", 3, "byte"),
+                        Compression("none", 0, "none")]:
+        _import("c", ["a", "b"], ["c"], compression=compression)
+        for e, r in zip(expected, _read("features_c.hdf5")):
+            np.testing.assert_array_equal(e, r)
+        with tables.open_file("features_c.hdf5") as hfile:
+            for array in [hfile.root.continuous_data,
+                          hfile.root.categorical_data]:
+                assert read_compression(array) == compression
+                assert array.filters.complevel == compression.level
+                assert array.filters.bitshuffle == (compression.shuffle ==
+                                                    "bit")
+    with tables.open_file("features_default.hdf5") as hfile:
+        assert read_compression(hfile.root.continuous_data) == \
+            DEFAULT_COMPRESSION
+        assert hfile.root.continuous_data.filters.complib == "blosc:lz4"
+
+
+@pytest.mark.parametrize("normalise", [True, False])
+def test_read_threads(layers, monkeypatch, normalise):
+    # unnormalised data is read by the parent alone, with every CPU
+    planned = []
+
+    def _plan(nworkers):
+        planned.append(nworkers)
+        return 1
+
+    monkeypatch.setattr(importers, "plan_read_threads", _plan)
+    tifs_entrypoint(2, 0.001, [], ["a"], normalise, "t", True,
+                    executor="threads")
+    assert planned == ([2] if normalise else [0])
@@ -17,7 +17,9 @@
 import numpy as np
 import pytest
 
-from landshark.iteration import batch, batch_slices, with_slices
+from landshark.iteration import (AdaptiveSlices, batch, batch_slices,
+                                 image_batches, sample_batches, slice_size,
+                                 window_size, window_slices, with_slices)
 
 batch_params = [
     (10, 5),
@@ -56,3 +58,80 @@ def test_with_slices(N):
     n_rows_sum = np.insert(np.cumsum(n_rows), 0, 0)
     assert start == tuple(n_rows_sum[:-1])
     assert stop == tuple(n_rows_sum[1:])
+
+
+@pytest.mark.parametrize("N,B,W", [(1000, 10, 0), (1000, 10, 4), (7, 3, 2)])
+def test_adaptive_slices_cover(N, B, W):
+    rnd = np.random.RandomState(666)
+    slices = AdaptiveSlices(B, N, W)
+    ixs = []
+    for s in slices:
+        ixs.extend(range(s.start, s.stop))
+        slices.update(s, rnd.uniform(0, 1))
+    assert ixs == list(range(N))
+
+
+def test_adaptive_slices_grow_and_split_tail():
+    slices = AdaptiveSlices(10, 10000, 2, target_seconds=1., max_growth=4)
+    sizes = []
+    for s in slices:
+        sizes.append(slice_size(s))
+        slices.update(s, 0.001)  # very fast, so overhead dominates
+    assert sizes[0] == 10
+    assert max(sizes) == 40
+    assert sizes[-1] < 10
+
+
+def test_adaptive_slices_within_budget():
+    slices = AdaptiveSlices(3, 10000, 2, target_seconds=1., max_growth=4,
+                            align=3, max_size=10)
+    sizes = []
+    for s in slices:
+        sizes.append(slice_size(s))
+        slices.update(s, 0.001)
+    assert max(sizes) == 9
+    # a budget below the batch size caps the first slice too
+    slices = AdaptiveSlices(20, 100, 0, max_size=8)
+    assert all(slice_size(s) <= 8 for s in slices)
+
+
+def test_adaptive_slices_aligned():
+    slices = AdaptiveSlices(12, 1001, 3, target_seconds=1., max_growth=4,
+                            align=4)
+    starts = []
+    for s in slices:
+        starts.append(s.start)
+        slices.update(s, 0.001)
+    assert all(start % 4 == 0 for start in starts)
+    assert s.stop == 1001
+
+
+def test_window_slices():
+    covered = np.zeros((23, 17), dtype=int)
+    windows = list(window_slices(5, 4, 23, 17))
+    for w in windows:
+        assert window_size(w) <= 20
+        covered[w.rows.start:w.rows.stop, w.cols.start:w.cols.stop] += 1
+    assert np.all(covered == 1)
+    # down each strip of columns in turn
+    assert [w.cols.start for w in windows[:5]] == [0] * 5
+
+
+def test_image_batches():
+    assert list(image_batches(5, None, (23, 17, 3))) == \
+        list(batch_slices(5, 23))
+    assert list(image_batches(5, 17, (23, 17, 3))) == \
+        list(batch_slices(5, 23))
+    assert list(image_batches(5, 4, (23, 3))) == list(batch_slices(5, 23))
+    assert len(list(image_batches(5, 4, (23, 17, 3)))) == 5 * 5
+
+
+def test_sample_batches():
+    batches = list(range(100))
+    sample = sample_batches(batches, 0.1, seed=3)
+    assert sample == sample_batches(iter(batches), 0.1, seed=3)
+    assert sample != sample_batches(batches, 0.1, seed=4)
+    # one from each run of 10
+    assert [b // 10 for b in sample] == list(range(10))
+    assert len(sample_batches(batches, 0.0)) == 2
+    assert sample_batches(batches, 1.0) == batches
@@ -0,0 +1,320 @@
+"""Tests for the multiproc module."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from landshark import multiproc
+from landshark.basetypes import IdReader, IdWorker, Reader, Worker
+from landshark.errors import WorkerCrashed
+
+LOCAL_EXECUTORS = ["processes", "threads"]
+
+MPI_SCRIPT = """
+import numpy as np
+from mpi4py import MPI
+from landshark import multiproc
+from landshark.basetypes import IdReader
+from tests.test_multiproc import _Ones, _Padded
+multiproc.serve_mpi()
+assert MPI.COMM_WORLD.rank == 0
+for _ in range(2):
+    worker = {}
+    out = list(multiproc.task_list(range(1, 30), IdReader(), worker, 3,
+                                   executor="mpi"))
+    for t, o in zip(range(1, 30), out):
+        np.testing.assert_array_equal(o, worker(t))
+print("ok")
+"""
+
+
+class _Ones(Worker):
+    """Make a (large-ish) array of ones tagged with the task."""
+
+    def __init__(self, ncols: int) -> None:
+        self.ncols = ncols
+
+    def __call__(self, x):
+        return np.full((x, self.ncols), x, dtype=np.float32)
+
+
+class _Padded(_Ones):
+    """Ones, from a worker that pickles to (well over) nbytes."""
+
+    def __init__(self, ncols: int, nbytes: int) -> None:
+        super().__init__(ncols)
+        self.padding = np.zeros(nbytes, dtype=np.uint8)
+
+
+class _Records(Worker):
+    """Make a list of byte strings like the serialised patch records."""
+
+    def __call__(self, x):
+        return [bytes([i % 256]) * x for i in range(x)]
+
+
+class _Fails(Worker):
+    """Raise on one task."""
+
+    def __init__(self, bad: int) -> None:
+        self.bad = bad
+
+    def __call__(self, x):
+        if x == self.bad:
+            raise ValueError("bad task {}".format(x))
+        return x
+
+
+class _Dies(Worker):
+    """Kill the worker process on one task, the first n times it is run."""
+
+    def __init__(self, bad: int, marker: str, n: int) -> None:
+        self.bad = bad
+        self.marker = marker
+        self.n = n
+
+    def __call__(self, x):
+        if x == self.bad:
+            with open(self.marker, "a") as f:
+                f.write("x")
+            with open(self.marker) as f:
+                if len(f.read()) <= self.n:
+                    os._exit(3)
+        return x
+
+
+class _CountingReader(Reader):
+    """Report which process read the task and how often it was entered."""
+
+    def __init__(self) -> None:
+        self.n_enter = 0
+
+    def __enter__(self):
+        self.n_enter += 1
+
+    def __call__(self, index):
+        return os.getpid(), self.n_enter, index
+
+
+class _ReleasingReader(IdReader):
+    """Count the releases of (the copies of) each reader by name."""
+
+    released = []
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def release(self):
+        self.released.append(self.name)
+
+
+@pytest.fixture
+def small_shm(monkeypatch):
+    """Force everything bar tiny results through shared memory."""
+    monkeypatch.setattr(multiproc, "SHM_MIN_BYTES", 16)
+
+
+def test_share_array_roundtrip(small_shm):
+    x = np.arange(100, dtype=np.int32).reshape((10, 10))
+    desc = multiproc._share(x)
+    assert isinstance(desc, multiproc._SharedArray)
+    y = multiproc._unshare(desc)
+    np.testing.assert_array_equal(x, y)
+    assert y.dtype == x.dtype
+
+
+def test_share_bytes_roundtrip(small_shm):
+    x = [b"abc", b"", b"defghijklmnopqrstuvwxyz"]
+    desc = multiproc._share(x)
+    assert isinstance(desc, multiproc._SharedBytes)
+    assert multiproc._unshare(desc) == x
+
+
+def test_share_small_passthrough():
+    x = np.ones(3)
+    assert multiproc._share(x) is x
+    assert multiproc._unshare(x) is x
+
+
+@pytest.mark.parametrize("executor", LOCAL_EXECUTORS)
+@pytest.mark.parametrize("n_workers", [0, 1, 3])
+def test_task_list_arrays(small_shm, n_workers, executor):
+    tasks = list(range(1, 20))
+    out = list(multiproc.task_list(tasks, IdReader(), _Ones(5), n_workers,
+                                   executor=executor))
+    assert len(out) == len(tasks)
+    for t, o in zip(tasks, out):
+        np.testing.assert_array_equal(o, _Ones(5)(t))
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_task_list_records(small_shm, n_workers):
+    tasks = list(range(1, 20))
+    out = list(multiproc.task_list(tasks, IdReader(), _Records(), n_workers))
+    assert out == [_Records()(t) for t in tasks]
+
+
+@pytest.mark.parametrize("executor", LOCAL_EXECUTORS)
+@pytest.mark.parametrize("n_workers", [0, 3])
+def test_task_list_unordered(small_shm, n_workers, executor):
+    tasks = list(range(1, 20))
+    out = list(multiproc.task_list(tasks, IdReader(), _Ones(5), n_workers,
+                                   executor=executor, ordered=False))
+    assert sorted(t for t, _ in out) == tasks
+    for t, o in out:
+        np.testing.assert_array_equal(o, _Ones(5)(t))
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_task_list_streaming(n_workers):
+    pulled = []
+
+    def tasks():
+        for i in range(1, 50):
+            pulled.append(i)
+            yield i
+
+    window = 3
+    out_it = multiproc.task_list(tasks(), IdReader(), _Ones(2), n_workers,
+                                 max_inflight=window)
+    for t, o in enumerate(out_it, start=1):
+        assert len(pulled) <= t + window
+        np.testing.assert_array_equal(o, _Ones(2)(t))
+    assert len(pulled) == 49
+
+
+@pytest.mark.parametrize("executor", LOCAL_EXECUTORS)
+def test_pool_reuses_readers(executor):
+    reader = _CountingReader()
+    with multiproc.WorkerPool(2, executor) as pool:
+        for _ in range(3):
+            out = list(multiproc.task_list(range(20), reader, IdWorker(), 2,
+                                           pool=pool))
+            assert [o[2] for o in out] == list(range(20))
+            assert all(o[1] == 1 for o in out)
+
+
+def test_pool_releases_idle_readers():
+    first, second = _ReleasingReader("first"), _ReleasingReader("second")
+    _ReleasingReader.released.clear()
+    with multiproc.WorkerPool(1, "threads") as pool:
+        for reader in [first, first, second, first]:
+            list(multiproc.task_list(range(5), reader, IdWorker(), 1,
+                                     pool=pool))
+    # only when a task list uses another reader
+    assert _ReleasingReader.released == ["first", "second"]
+
+
+@pytest.mark.parametrize("executor", LOCAL_EXECUTORS)
+def test_pool_abandoned_task_list(executor):
+    with multiproc.WorkerPool(2, executor) as pool:
+        first = pool.imap(range(1, 50), IdReader(), _Ones(2))
+        next(first)
+        first.close()
+        out = list(pool.imap(range(1, 10), IdReader(), _Ones(3)))
+    assert len(out) == 9
+    for t, o in zip(range(1, 10), out):
+        np.testing.assert_array_equal(o, _Ones(3)(t))
+
+
+class _Affinity(Worker):
+    """Report the CPUs the worker may run on."""
+
+    def __call__(self, x):
+        return sorted(os.sched_getaffinity(0))
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"),
+                    reason="needs sched_getaffinity")
+def test_pool_pins_workers():
+    cpu = min(os.sched_getaffinity(0))
+    out = multiproc.task_list(range(4), IdReader(), _Affinity(), 2,
+                              affinity=[[cpu]])
+    assert list(out) == [[cpu]] * 4
+
+
+@pytest.mark.parametrize("executor", LOCAL_EXECUTORS)
+def test_worker_exception_forwarded(executor):
+    with multiproc.WorkerPool(2, executor) as pool:
+        with pytest.raises(ValueError, match="bad task 7") as e:
+            list(pool.imap(range(20), IdReader(), _Fails(7)))
+        assert "raise ValueError" in str(e.value.__cause__)
+        # the pool survives to run the next task list
+        assert list(pool.imap(range(5), IdReader(), IdWorker())) == \
+            list(range(5))
+
+
+def test_worker_crash_detected(tmp_path):
+    marker = str(tmp_path / "crashes")
+    with multiproc.WorkerPool(2) as pool:
+        with pytest.raises(WorkerCrashed):
+            list(pool.imap(range(20), IdReader(), _Dies(5, marker, 1)))
+        assert all(p.is_alive() for p in pool._procs)
+        assert list(pool.imap(range(5), IdReader(), IdWorker())) == \
+            list(range(5))
+
+
+def test_worker_crash_retried(tmp_path):
+    marker = str(tmp_path / "crashes")
+    out = multiproc.task_list(range(20), IdReader(), _Dies(5, marker, 2), 2,
+                              retries=2)
+    assert list(out) == list(range(20))
+    with open(marker) as f:
+        assert len(f.read()) == 3
+
+
+def _shm_blocks():
+    return {f for f in os.listdir("/dev/shm") if f.startswith("landshark_")}
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_worker_crash_frees_shared_result(small_shm, monkeypatch):
+    share = multiproc._share
+
+    def _share_and_die(x, name=None):
+        share(x, name)
+        os._exit(3)
+
+    before = _shm_blocks()
+    monkeypatch.setattr(multiproc, "_share", _share_and_die)
+    with multiproc.WorkerPool(1) as pool:
+        with pytest.raises(WorkerCrashed):
+            list(pool.imap(range(1, 3), IdReader(), _Ones(4)))
+    assert _shm_blocks() == before
+
+
+@pytest.mark.skipif(shutil.which("mpirun") is None, reason="needs mpirun")
+@pytest.mark.parametrize("worker", ["_Ones(4)", "_Padded(4, 1 << 17)"])
+def test_task_list_mpi(worker):
+    # jobs over MPI's eager limit must not wait for a task to be received
+    pytest.importorskip("mpi4py")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = ["mpirun", "-n", "4", sys.executable, "-c",
+           MPI_SCRIPT.replace("{}", worker, 1)]
+    version = subprocess.run(["mpirun", "--version"], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT).stdout.decode()
+    if "Open MPI" in version:  # allow 4 ranks on small CI boxes
+        cmd[1:1] = ["--oversubscribe"] + \
+            (["--allow-run-as-root"] if os.geteuid() == 0 else [])
+    out = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, timeout=120)
+    assert out.returncode == 0, out.stderr.decode()
+    assert out.stdout.decode().strip() == "ok"
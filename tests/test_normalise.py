@@ -0,0 +1,191 @@
+"""Tests for the normalise module."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+import numpy as np
+import pytest
+
+from landshark.basetypes import ContinuousArraySource, ContinuousType
+from landshark.normalise import (Normaliser, QuantileSketch, StatCounter,
+                                 get_scaling, get_stats, sample_bounds)
+
+MISSING = np.finfo(ContinuousType).min
+
+
+class NPConArraySource(ContinuousArraySource):
+    def __init__(self, x, missing, columns):
+        self._shape = x.shape
+        self._native = 1
+        self._missing = missing
+        self._columns = columns
+        self._data = x
+
+    def _arrayslice(self, start, stop):
+        return self._data[start:stop]
+
+
+def _data(shape, missing=MISSING):
+    rnd = np.random.RandomState(0)
+    x = rnd.normal(5.0, 3.0, size=shape).astype(ContinuousType)
+    if missing is not None:
+        x[rnd.rand(*shape) < 0.2] = missing
+    return x
+
+
+def _expected(x):
+    m = np.ma.masked_equal(x.reshape((-1, x.shape[-1])), MISSING)
+    return m.mean(axis=0).data, m.std(axis=0).data
+
+
+@pytest.mark.parametrize("missing", [None, MISSING])
+def test_stat_counter(missing):
+    x = _data((100, 3), missing)
+    counter = StatCounter(3)
+    for i in range(0, 100, 7):
+        counter.update(x[i:i + 7], missing)
+    mean, sd = _expected(x)
+    np.testing.assert_allclose(counter.mean, mean, rtol=1e-6)
+    np.testing.assert_allclose(counter.sd, sd, rtol=1e-6)
+
+
+def test_stat_counter_merge():
+    x = _data((100, 3))
+    x[:50, 1] = MISSING  # one part missing entirely in a column
+    whole, first, second = StatCounter(3), StatCounter(3), StatCounter(3)
+    whole.update(x, MISSING)
+    first.update(x[:50], MISSING)
+    second.update(x[50:], MISSING)
+    first.merge(second)
+    np.testing.assert_array_equal(first.count, whole.count)
+    np.testing.assert_allclose(first.mean, whole.mean, rtol=1e-10)
+    np.testing.assert_allclose(first.sd, whole.sd, rtol=1e-10)
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_get_stats(n_workers):
+    x = _data((40, 9, 2))
+    source = NPConArraySource(x, MISSING, ["a", "b"])
+    mean, sd = get_stats(source, 6, 4, n_workers)
+    np.testing.assert_allclose(mean, _expected(x)[0], rtol=1e-6)
+    np.testing.assert_allclose(sd, _expected(x)[1], rtol=1e-6)
+
+
+def test_sampled_stats(caplog):
+    x = _data((200, 5, 2))
+    source = NPConArraySource(x, MISSING, ["a", "b"])
+    caplog.set_level(logging.INFO)
+    mean, sd = get_stats(source, 4, sample=0.5, seed=1)
+    assert "95% bounds" in caplog.text
+    assert np.all(mean != _expected(x)[0])
+    np.testing.assert_allclose(mean, _expected(x)[0], rtol=0.1)
+    np.testing.assert_allclose(sd, _expected(x)[1], rtol=0.1)
+    again = get_stats(source, 4, sample=0.5, seed=1)
+    np.testing.assert_array_equal(mean, again[0])
+    np.testing.assert_array_equal(sd, again[1])
+
+
+@pytest.mark.parametrize("rows, sample, approximate",
+                         [(200, 0.5, True), (200, 1.0, False),
+                          (8, 0.1, False), (200, None, False)])
+def test_scaling_approximate(rows, sample, approximate):
+    # only approximate if the sample actually left out batches
+    x = _data((rows, 5, 2))
+    source = NPConArraySource(x, MISSING, ["a", "b"])
+    scale = get_scaling(source, 4, sample=sample)
+    assert scale.approximate == approximate
+
+
+def test_sample_bounds():
+    x = _data((200, 5, 2))
+    counters = []
+    for i in range(0, 200, 4):
+        counter = StatCounter(2)
+        counter.update(x[i:i + 4].reshape((-1, 2)), MISSING)
+        counters.append(counter)
+    mean, sd = _expected(x)
+    # nothing is uncertain when every batch is counted
+    b = sample_bounds(counters, 1.0)
+    np.testing.assert_allclose(b.mean_lo, mean, rtol=1e-6)
+    np.testing.assert_allclose(b.sd_hi, sd, rtol=1e-6)
+    # the exact values are within the bounds from every other batch
+    b = sample_bounds(counters[::2], 0.5)
+    assert np.all((b.mean_lo < mean) & (mean < b.mean_hi))
+    assert np.all((b.sd_lo < sd) & (sd < b.sd_hi))
+    wider = sample_bounds(counters[::10], 0.1)
+    assert np.all(wider.mean_hi - wider.mean_lo > b.mean_hi - b.mean_lo)
+
+
+def test_quantile_sketch_exact():
+    x = _data((300, 2))
+    sketch = QuantileSketch(2)
+    sketch.update(x, MISSING)
+    q = np.array([0.0, 0.1, 0.5, 0.75, 1.0])
+    for f in range(2):
+        values = x[:, f][x[:, f] != MISSING]
+        np.testing.assert_array_equal(
+            sketch.quantiles(q)[:, f],
+            np.quantile(values, q, method="inverted_cdf"))
+
+
+def test_quantile_sketch_bounded():
+    rnd = np.random.RandomState(1)
+    x = rnd.standard_cauchy(size=(200000, 1))
+    whole, first, second = (QuantileSketch(1, size=256) for _ in range(3))
+    for i in range(0, 200000, 10000):
+        whole.update(x[i:i + 10000])
+        (first if i < 100000 else second).update(x[i:i + 10000])
+    first.merge(second)
+    q = np.linspace(0.01, 0.99, 13)
+    for sketch in (whole, first):
+        assert sketch.count[0] == 200000
+        assert sum(v.size for v in sketch._levels[0]) <= 256 * 10
+        # measure the error in rank rather than value
+        ranks = np.searchsorted(np.sort(x[:, 0]), sketch.quantiles(q)[:, 0])
+        np.testing.assert_allclose(ranks / 200000, q, atol=0.02)
+
+
+def test_normaliser_clip():
+    x = np.array([[-50.0, 1.0], [0.0, MISSING], [MISSING, 3.0], [8.0, 2.0]],
+                 dtype=ContinuousType)
+    clip = (np.array([-1.0, 1.5]), np.array([5.0, 2.5]))
+    out = Normaliser(np.zeros(2), np.full(2, 2.0), MISSING, clip)(x)
+    assert out.dtype == ContinuousType
+    np.testing.assert_array_equal(out, [[-0.5, 0.75], [0.0, MISSING],
+                                        [MISSING, 1.25], [2.5, 1.0]])
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_get_scaling(n_workers):
+    x = _data((40, 9, 2))
+    x[:, :, 1] = 3.0  # no spread between the quartiles
+    x[0, 0, 1] = 4.0
+    source = NPConArraySource(x, MISSING, ["a", "b"])
+    standard = get_scaling(source, 6, 4, n_workers)
+    np.testing.assert_allclose(standard.center, _expected(x)[0], rtol=1e-6)
+    assert standard.clip is None
+    robust = get_scaling(source, 6, 4, n_workers, scaling="robust")
+    values = x[..., 0][x[..., 0] != MISSING]
+    q = np.quantile(values, [0.25, 0.5, 0.75], method="inverted_cdf")
+    assert robust.center[0] == q[1]
+    assert robust.scale[0] == pytest.approx((q[2] - q[0]) / 1.349)
+    assert robust.scale[1] == pytest.approx(_expected(x)[1][1])
+    assert robust.clip is None
+    clipped = get_scaling(source, 6, 4, n_workers, scaling="clip",
+                          clip_quantile=0.05)
+    lower, upper = clipped.clip
+    assert lower[0] == np.quantile(values, 0.05, method="inverted_cdf")
+    assert upper[0] == np.quantile(values, 0.95, method="inverted_cdf")
@@ -0,0 +1,123 @@
+"""Tests for the resources module."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from landshark import resources
+from landshark.resources import (DEFAULT_BATCH_MB, MIN_BATCH_MB, Resources,
+                                 detect_resources, parse_cpulist,
+                                 plan_workers)
+
+GB = 2 ** 30
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(str(path), "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def fake_sys(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1, 2, 3, 5},
+                        raising=False)
+    _write(tmp_path / "proc/meminfo",
+           "MemTotal: 67108864 kB\nMemAvailable: 33554432 kB\n")
+    _write(tmp_path / "node/node0/cpulist", "0-3\n")
+    _write(tmp_path / "node/node1/cpulist", "4-7\n")
+    return tmp_path
+
+
+def test_parse_cpulist():
+    assert parse_cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpulist("") == []
+
+
+def test_detect_cgroup_v2(fake_sys):
+    _write(fake_sys / "proc/self/cgroup", "0::/job\n")
+    _write(fake_sys / "cgroup/job/cpu.max", "250000 100000\n")
+    _write(fake_sys / "cgroup/job/memory.max", str(4 * GB))
+    _write(fake_sys / "cgroup/job/memory.current", str(GB))
+    res = detect_resources(str(fake_sys / "cgroup"), str(fake_sys / "node"),
+                           str(fake_sys / "proc"))
+    assert res.cpus == [0, 1, 2, 3, 5]
+    assert res.cpu_quota == 2.5
+    assert res.memory == 3 * GB
+    assert res.numa_nodes == [[0, 1, 2, 3], [5]]
+
+
+def test_detect_cgroup_v1_unlimited(fake_sys):
+    _write(fake_sys / "proc/self/cgroup", "4:memory:/elsewhere\n1:cpu:/\n")
+    _write(fake_sys / "cgroup/cpu/cpu.cfs_quota_us", "-1\n")
+    _write(fake_sys / "cgroup/cpu/cpu.cfs_period_us", "100000\n")
+    _write(fake_sys / "cgroup/memory/memory.limit_in_bytes",
+           "9223372036854771712\n")
+    _write(fake_sys / "cgroup/memory/memory.usage_in_bytes", str(GB))
+    res = detect_resources(str(fake_sys / "cgroup"), str(fake_sys / "node"),
+                           str(fake_sys / "proc"))
+    assert res.cpu_quota is None
+    assert res.memory == 32 * GB  # from meminfo
+
+
+def test_plan_follows_quota_and_numa():
+    res = Resources(list(range(16)), 6.0, 64 * GB,
+                    [list(range(8)), list(range(8, 16))])
+    plan = plan_workers(None, None, res)
+    assert plan.nworkers == 6
+    assert plan.batchMB == DEFAULT_BATCH_MB
+    assert plan.affinity == res.numa_nodes
+
+
+def test_plan_single_cpu_is_serial():
+    plan = plan_workers(None, None, Resources([0], None, None, [[0]]))
+    assert plan.nworkers == 0
+    assert plan.batchMB == DEFAULT_BATCH_MB
+    assert plan.affinity is None
+
+
+def test_plan_shrinks_batches_to_memory():
+    memory = 200 * 10 ** 6
+    plan = plan_workers(None, None, Resources(list(range(4)), None, memory,
+                                              [list(range(4))]))
+    # each process holds its batches and its tile cache
+    copies = resources.BATCH_COPIES + resources.TILE_CACHE_BATCHES
+    budget = memory * resources.MEMORY_FRACTION * 1e-6 / copies
+    assert plan.nworkers == 4
+    assert plan.batchMB == pytest.approx(budget / 5)
+    assert plan.batchMB * 5 * copies < memory * 1e-6
+
+
+def test_plan_limits_workers_to_memory():
+    memory = 8 * 10 ** 6
+    plan = plan_workers(None, None, Resources(list(range(64)), None, memory,
+                                              []))
+    assert plan.nworkers < 64
+    assert plan.batchMB == pytest.approx(MIN_BATCH_MB)
+
+
+def test_plan_keeps_given_values():
+    res = Resources(list(range(16)), 2.0, 10 ** 6, [[0], [1]])
+    plan = plan_workers(3, 25.0, res)
+    assert plan == (3, 25.0, None)
+
+
+def test_plan_read_threads():
+    res = Resources(list(range(16)), 8.0, None, [])
+    assert resources.plan_read_threads(0, res) == 8
+    assert resources.plan_read_threads(3, res) == 2
+    assert resources.plan_read_threads(16, res) == 1
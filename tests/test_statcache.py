@@ -0,0 +1,125 @@
+"""Tests for the statcache module."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+from landshark.category import get_maps, select_categories, stack_categories
+from landshark.normalise import StatCounter, count_stats
+from landshark.statcache import StatCache, cached_scan
+from landshark.tifread import (CategoricalStackSource, ContinuousStackSource,
+                               shared_image_spec)
+
+
+def _write_tif(path, data, nodata):
+    count, height, width = data.shape
+    with rasterio.open(str(path), "w", driver="GTiff", height=height,
+                       width=width, count=count, dtype=data.dtype,
+                       nodata=nodata,
+                       transform=Affine(1.0, 0.0, 100.0, 0.0, -1.0, 200.0)
+                       ) as f:
+        f.write(data)
+
+
+@pytest.fixture
+def tifs(tmp_path):
+    """Three tifs, the second with 2 bands."""
+    rnd = np.random.RandomState(1)
+    paths = []
+    for i, count in enumerate([1, 2, 1]):
+        data = rnd.randint(0, 6, size=(count, 19, 11)).astype(np.int16)
+        path = str(tmp_path / "layer{}.tif".format(i))
+        _write_tif(path, data, nodata=5)
+        paths.append(path)
+    return paths
+
+
+def test_cache_keys(tmp_path, tifs):
+    cache = StatCache(str(tmp_path / "cache"))
+    path = tifs[0]
+    assert cache.load(path, "thing") is None
+    cache.save(path, "thing", [1, 2])
+    assert cache.load(path, "thing") == [1, 2]
+    assert cache.load(path, "other") is None
+    assert cache.load(tifs[1], "thing") is None
+    # the same contents with a new time are hashed and still match
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert cache.load(path, "thing") == [1, 2]
+    # but different contents of the same size are not
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 1]))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+    assert cache.load(path, "thing") is None
+
+
+def test_cached_stats(tmp_path, tifs):
+    spec = shared_image_spec(tifs, ignore_crs=True)
+    cache = StatCache(str(tmp_path / "cache"))
+    scanned = []
+
+    def _scan(paths):
+        scanned.append(paths)
+        return count_stats(ContinuousStackSource(spec, paths), 4, 5,
+                           quantiles=True)
+
+    def _stats():
+        return cached_scan(cache, "continuous", tifs, _scan,
+                           StatCounter.select, StatCounter.stack)
+
+    expected = count_stats(ContinuousStackSource(spec, tifs), 4,
+                           quantiles=True)
+    for _ in range(2):
+        counter = _stats()
+        np.testing.assert_array_equal(counter.count, expected.count)
+        np.testing.assert_allclose(counter.mean, expected.mean)
+        np.testing.assert_allclose(counter.sd, expected.sd)
+        np.testing.assert_array_equal(counter.sketch.quantiles([0.5]),
+                                      expected.sketch.quantiles([0.5]))
+    assert scanned == [tifs]
+
+    data = np.full((1, 19, 11), 3, dtype=np.int16)
+    _write_tif(tifs[1], data, nodata=5)
+    assert _stats().count[1] == 19 * 11
+    assert scanned == [tifs, [tifs[1]]]
+
+
+def test_cached_maps(tmp_path, tifs):
+    spec = shared_image_spec(tifs, ignore_crs=True)
+    cache = StatCache(str(tmp_path / "cache"))
+    expected = get_maps(CategoricalStackSource(spec, tifs), 4)
+    cached_scan(cache, "categorical", tifs[:2],
+                lambda p: get_maps(CategoricalStackSource(spec, p), 4),
+                select_categories, stack_categories)
+    scanned = []
+
+    def _scan(paths):
+        scanned.append(paths)
+        return get_maps(CategoricalStackSource(spec, paths), 4)
+
+    info = cached_scan(cache, "categorical", tifs, _scan,
+                       select_categories, stack_categories)
+    assert scanned == [tifs[2:]]
+    for m, e in zip(info.mappings + info.counts,
+                    expected.mappings + expected.counts):
+        np.testing.assert_array_equal(m, e)
@@ -0,0 +1,315 @@
+"""Tests for the tifread module."""
+
+# Copyright 2019 CSIRO (Data61)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+import rasterio
+import tables
+from affine import Affine
+
+from landshark import featurewrite
+from landshark.basetypes import FixedSlice, FixedWindow
+from landshark.category import get_maps
+from landshark.featurewrite import (map_categorical, normalise_continuous,
+                                    write_categorical, write_categorical_maps,
+                                    write_continuous, write_continuous_stats)
+from landshark.iteration import AdaptiveSlices, window_slices
+from landshark.normalise import get_stats
+from landshark.tifread import (CategoricalStackSource, ContinuousStackSource,
+                               decode_factor, shared_image_spec)
+from landshark.util import MIN_TILE_SIDE
+
+HEIGHT = 37
+WIDTH = 23
+
+
+def _write_tif(path, data, nodata=None, **profile):
+    """Write a (bands, height, width) array as a GeoTIFF."""
+    count, height, width = data.shape
+    with rasterio.open(str(path), "w", driver="GTiff", height=height,
+                       width=width, count=count, dtype=data.dtype,
+                       nodata=nodata,
+                       transform=Affine(1.0, 0.0, 100.0, 0.0, -1.0, 200.0),
+                       **profile) as f:
+        f.write(data)
+
+
+@pytest.fixture
+def con_stack(tmp_path):
+    """Three continuous tifs (one of them 2-band) with some nodata."""
+    rnd = np.random.RandomState(42)
+    paths, bands = [], []
+    for i, (count, dtype) in enumerate([(1, np.float32), (2, np.float64),
+                                        (1, np.int16)]):
+        data = rnd.randint(0, 100, size=(count, HEIGHT, WIDTH)).astype(dtype)
+        data[:, rnd.rand(HEIGHT, WIDTH) < 0.1] = -999
+        path = tmp_path / "con{}.tif".format(i)
+        _write_tif(path, data, nodata=-999, blockysize=4 * (i + 1))
+        paths.append(str(path))
+        bands.append(np.moveaxis(data, 0, -1))
+    return paths, np.concatenate(bands, axis=-1)
+
+
+@pytest.fixture
+def cat_stack(tmp_path):
+    """Two categorical tifs, one without nodata."""
+    rnd = np.random.RandomState(7)
+    paths, bands = [], []
+    for i, nodata in enumerate([255, None]):
+        data = rnd.randint(0, 5, size=(1, HEIGHT, WIDTH)).astype(np.uint8)
+        if nodata is not None:
+            data[:, :3] = nodata
+        path = tmp_path / "cat{}.tif".format(i)
+        _write_tif(path, data, nodata=nodata, blockysize=8)
+        paths.append(str(path))
+        bands.append(np.moveaxis(data, 0, -1))
+    return paths, np.concatenate(bands, axis=-1)
+
+
+def _expected(data, source):
+    out = data.astype(source.dtype)
+    nodata = -999 if np.dtype(source.dtype).kind == "f" else 255
+    out[data == nodata] = source.missing
+    return out
+
+
+@pytest.mark.parametrize("read_threads", [1, 4])
+def test_continuous_stack(con_stack, read_threads):
+    paths, data = con_stack
+    spec = shared_image_spec(paths, ignore_crs=True)
+    source = ContinuousStackSource(spec, paths, read_threads)
+    assert source.shape == (HEIGHT, WIDTH, 4)
+    with source:
+        out = source(slice(5, 30))
+    np.testing.assert_array_equal(out, _expected(data, source)[5:30])
+
+
+@pytest.mark.parametrize("read_threads", [1, 4])
+def test_categorical_stack(cat_stack, read_threads):
+    paths, data = cat_stack
+    spec = shared_image_spec(paths, ignore_crs=True)
+    source = CategoricalStackSource(spec, paths, read_threads)
+    with source:
+        out = source(slice(0, HEIGHT))
+    np.testing.assert_array_equal(out, _expected(data, source))
+
+
+def test_missing_value_collision(con_stack, tmp_path):
+    paths, _ = con_stack
+    data = np.ones((1, HEIGHT, WIDTH), dtype=np.float32)
+    data[0, 3, 4] = np.finfo(np.float32).min
+    path = str(tmp_path / "collide.tif")
+    _write_tif(path, data, blockysize=4)
+    spec = shared_image_spec(paths + [path], ignore_crs=True)
+    source = ContinuousStackSource(spec, paths + [path])
+    with source:
+        source(slice(4, 8))
+        with pytest.raises(ValueError, match="Mask value"):
+            source(slice(0, 4))
+
+
+def test_dataset_mask(con_stack, tmp_path):
+    paths, data = con_stack
+    masked = np.full((1, HEIGHT, WIDTH), 7.0, dtype=np.float32)
+    path = str(tmp_path / "masked.tif")
+    _write_tif(path, masked, blockysize=4)
+    mask = np.full((HEIGHT, WIDTH), 255, dtype=np.uint8)
+    mask[10:12, :5] = 0
+    with rasterio.open(path, "r+") as f:
+        f.write_mask(mask)
+    spec = shared_image_spec(paths + [path], ignore_crs=True)
+    source = ContinuousStackSource(spec, paths + [path])
+    with source:
+        out = source(slice(0, HEIGHT))
+    np.testing.assert_array_equal(out[..., :-1], _expected(data, source))
+    assert np.all(out[..., -1][mask == 0] == source.missing)
+    assert np.all(out[..., -1][mask != 0] == 7.0)
+
+
+def test_decode_factor():
+    assert decode_factor(8, [4, 8], 32) == 1.0
+    assert decode_factor(6, [4], 24) == pytest.approx(32 / 24)
+    # the partial block at the bottom is only as tall as the image
+    assert decode_factor(5, [5], 12) == 1.0
+
+
+def test_aligned_rows(con_stack):
+    paths, _ = con_stack
+    spec = shared_image_spec(paths, ignore_crs=True)
+    source = ContinuousStackSource(spec, paths)
+    assert source.native == 24  # blocks of 4, 8 and 12 rows
+    assert source.aligned_rows(30) == 24
+    rows = source.aligned_rows(20)
+    assert rows <= 20
+    assert decode_factor(rows, [4, 8, 8, 12], HEIGHT) <= \
+        decode_factor(20, [4, 8, 8, 12], HEIGHT)
+
+
+@pytest.mark.parametrize("tile_cache_mb", [0, 1])
+def test_tiled_reads(tmp_path, tile_cache_mb, mocker):
+    rnd = np.random.RandomState(3)
+    data = rnd.rand(2, HEIGHT, WIDTH).astype(np.float32)
+    path = str(tmp_path / "tiled.tif")
+    # tiles taller than they are wide, which used to be refused
+    _write_tif(path, data, tiled=True, blockxsize=16, blockysize=32)
+    spec = shared_image_spec([path], ignore_crs=True)
+    source = ContinuousStackSource(spec, [path], tile_cache_mb=tile_cache_mb)
+    assert source.native == 32
+    decode = mocker.spy(source, "_decode")
+    with source:
+        out = np.concatenate([source(slice(i, min(i + 5, HEIGHT)))
+                              for i in range(0, HEIGHT, 5)])
+    np.testing.assert_array_equal(out, np.moveaxis(data, 0, -1))
+    # with a cache each of the 2 rows of tiles is only decoded once
+    assert decode.call_count == (2 if tile_cache_mb else 8)
+
+
+def test_tile_cache_shared(tmp_path, mocker, caplog):
+    rnd = np.random.RandomState(4)
+    paths, bands = [], []
+    for name, count in [("wide", 6), ("narrow", 1)]:
+        data = rnd.rand(count, HEIGHT, WIDTH).astype(np.float32)
+        paths.append(str(tmp_path / (name + ".tif")))
+        _write_tif(paths[-1], data, tiled=True, blockxsize=16, blockysize=32)
+        bands.append(np.moveaxis(data, 0, -1))
+    spec = shared_image_spec(paths, ignore_crs=True)
+    # room for a row of tiles of both, but not for half each of the wide
+    row_bytes = 32 * WIDTH * 7 * 4
+    source = ContinuousStackSource(spec, paths,
+                                   tile_cache_mb=row_bytes * 1.2e-6)
+    decode = mocker.spy(source, "_decode")
+    with source:
+        out = np.concatenate([source(slice(i, min(i + 5, HEIGHT)))
+                              for i in range(0, HEIGHT, 5)])
+        assert source._block_rows
+        source.release()
+        assert not source._block_rows
+    np.testing.assert_array_equal(out, np.concatenate(bands, axis=-1))
+    assert decode.call_count == 4
+    assert "tile cache" not in caplog.text
+
+    small = ContinuousStackSource(spec, paths, tile_cache_mb=0.001)
+    with small:
+        for i in range(0, HEIGHT, 5):
+            small(slice(i, min(i + 5, HEIGHT)))
+    # warned once for each image whose block rows do not fit
+    assert caplog.text.count("tile cache") == 2
+
+
+@pytest.mark.parametrize("tile_cache_mb", [0, 1])
+def test_window_reads(con_stack, tile_cache_mb):
+    paths, data = con_stack
+    spec = shared_image_spec(paths, ignore_crs=True)
+    source = ContinuousStackSource(spec, paths, tile_cache_mb=tile_cache_mb)
+    expected = _expected(data, source)
+    with source:
+        for w in window_slices(5, 7, HEIGHT, WIDTH):
+            np.testing.assert_array_equal(
+                source(w), expected[w.rows.start:w.rows.stop,
+                                    w.cols.start:w.cols.stop])
+        # a cached block row is not reused for other columns
+        w = FixedWindow(FixedSlice(1, 3), FixedSlice(0, WIDTH))
+        np.testing.assert_array_equal(source(w), expected[1:3])
+
+
+@pytest.mark.parametrize("batchrows, align, max_size",
+                         [(48, 48, 48), (40, 16, 32), (8, 16, 16)])
+def test_write_alignment(con_stack, tmp_path, mocker, batchrows, align,
+                         max_size):
+    # slices of whole 16-row chunks, and of whole 24-row blocks (native)
+    # where both fit in batchrows, which is only exceeded for one chunk
+    paths, data = con_stack
+    spec = shared_image_spec(paths, ignore_crs=True)
+    source = ContinuousStackSource(spec, paths)
+    slices = mocker.patch.object(featurewrite, "AdaptiveSlices",
+                                 wraps=AdaptiveSlices)
+    with tables.open_file(str(tmp_path / "aligned.hdf5"), "w") as f:
+        write_continuous(source, f, 0, batchrows, chunkshape=(16, 16))
+        out = f.root.continuous_data.read()
+    np.testing.assert_array_equal(out, _expected(data, source))
+    assert slices.call_args[1]["align"] == align
+    assert slices.call_args[1]["max_size"] == max_size
+
+
+def test_windowed_import(con_stack, cat_stack, tmp_path):
+    con_paths, con_data = con_stack
+    cat_paths, cat_data = cat_stack
+    spec = shared_image_spec(con_paths + cat_paths, ignore_crs=True)
+    con_source = ContinuousStackSource(spec, con_paths)
+    cat_source = CategoricalStackSource(spec, cat_paths)
+    stats = get_stats(con_source, 5, 7)
+    rows_stats = get_stats(con_source, 5)
+    np.testing.assert_allclose(stats[0], rows_stats[0], rtol=1e-5)
+    np.testing.assert_allclose(stats[1], rows_stats[1], rtol=1e-5)
+    maps = get_maps(cat_source, 5, 7)
+    rows_maps = get_maps(cat_source, 5)
+    for m, n in zip(maps.counts, rows_maps.counts):
+        np.testing.assert_array_equal(m, n)
+
+    def _write(name, batchcols):
+        with tables.open_file(str(tmp_path / name), "w") as f:
+            write_continuous(con_source, f, 0, 5, stats, None, batchcols)
+            write_categorical(cat_source, f, 0, 5, maps.mappings, None,
+                              batchcols)
+            return (f.root.continuous_data.chunkshape,
+                    f.root.continuous_data.read(),
+                    f.root.categorical_data.read())
+
+    _, con_rows, cat_rows = _write("rows.hdf5", None)
+    chunkshape, con_windows, cat_windows = _write("windows.hdf5", 7)
+    assert chunkshape == (MIN_TILE_SIDE, MIN_TILE_SIDE)
+    np.testing.assert_array_equal(con_windows, con_rows)
+    np.testing.assert_array_equal(cat_windows, cat_rows)
+
+
+@pytest.mark.parametrize("batchcols", [None, 7])
+def test_decode_once(con_stack, cat_stack, tmp_path, batchcols, mocker):
+    con_paths, _ = con_stack
+    cat_paths, _ = cat_stack
+    spec = shared_image_spec(con_paths + cat_paths, ignore_crs=True)
+    con_source = ContinuousStackSource(spec, con_paths)
+    cat_source = CategoricalStackSource(spec, cat_paths)
+    decode = mocker.spy(con_source, "_decode")
+    stats = get_stats(con_source, 5, batchcols)
+    maps = get_maps(cat_source, 5, batchcols)
+    stats_pass = decode.call_count
+    with tables.open_file(str(tmp_path / "twice.hdf5"), "w") as f:
+        write_continuous(con_source, f, 0, 5, stats, None, batchcols)
+        write_categorical(cat_source, f, 0, 5, maps.mappings, None,
+                          batchcols)
+        con_twice = f.root.continuous_data.read()
+        cat_twice = f.root.categorical_data.read()
+
+    # the writes may decode in larger (chunk aligned) windows
+    write_pass = decode.call_count - stats_pass
+    assert 0 < write_pass <= stats_pass
+    with tables.open_file(str(tmp_path / "once.hdf5"), "w") as f:
+        once_stats = write_continuous_stats(con_source, f, 0, 5, None,
+                                            batchcols)
+        normalise_continuous(f, once_stats, 5, batchcols)
+        once_maps = write_categorical_maps(cat_source, f, 0, 5, None,
+                                           batchcols)
+        map_categorical(f, once_maps.mappings, 5, batchcols)
+        con_once = f.root.continuous_data.read()
+        cat_once = f.root.categorical_data.read()
+    assert decode.call_count == stats_pass + 2 * write_pass
+
+    np.testing.assert_allclose(once_stats[0], stats[0], rtol=1e-5)
+    np.testing.assert_allclose(once_stats[1], stats[1], rtol=1e-5)
+    np.testing.assert_allclose(con_once, con_twice, rtol=1e-5, atol=1e-5)
+    for m, n in zip(once_maps.mappings, maps.mappings):
+        np.testing.assert_array_equal(m, n)
+    np.testing.assert_array_equal(cat_once, cat_twice)